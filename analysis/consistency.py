@@ -1,8 +1,41 @@
-# Function to determine the condition
-def compare_inf_sql(row):
-    if row['inf_sql_1'] == row['inf_sql_2'] == row['inf_sql_3']:
+import re
+import numpy as np
+import pandas as pd
+
+inf_sql_pattern = re.compile(r'^inf_sql_\d+$')
+
+def consistency_category(num_distinct, num_samples):
+    # Every inferred query is the same, every one differs, or at least two are equal
+    if num_distinct == 1:
         return 'all_equal'
-    elif row['inf_sql_1'] == row['inf_sql_2'] or row['inf_sql_1'] == row['inf_sql_3'] or row['inf_sql_2'] == row['inf_sql_3']:
-        return 'two_equal'
+    elif num_distinct == num_samples:
+        return 'all_different'
     else:
-        return 'all_different'
\ No newline at end of file
+        return 'two_equal'
+
+# Function to determine the condition
+def compare_inf_sql(row):
+    sqls = [row[column] for column in row.index if inf_sql_pattern.match(column)]
+    return consistency_category(len(set(sqls)), len(sqls))
+
+def sql_agreement(long):
+    """
+    Returns the agreement between the inferred queries of each NLQ of findings in long format:
+    number of samples, distinct queries, count and share of the most frequent (modal) query,
+    Shannon entropy in bits of the query distribution and consistency category.
+    """
+    counts = long.groupby(['nlq_id', 'sql'], dropna=False, sort=False).size()
+    by_nlq = counts.groupby(level='nlq_id', sort=False)
+    samples = by_nlq.transform('sum')
+    shares = counts / samples
+
+    agreement = pd.DataFrame({
+        'samples': by_nlq.sum(),
+        'distinct_sql': by_nlq.size(),
+        'modal_count': by_nlq.max(),
+        'sql_entropy': (-shares * np.log2(shares)).groupby(level='nlq_id', sort=False).sum().abs()
+    })
+    agreement['modal_agreement'] = agreement['modal_count'] / agreement['samples']
+    agreement['consistency'] = [consistency_category(num_distinct, num_samples)
+                                for num_distinct, num_samples in zip(agreement['distinct_sql'], agreement['samples'])]
+    return agreement
@@ -1,40 +1,46 @@
-# Function to classify SQLite errors
-def classify_sqlite_error(error_message):
-    
-    # Check for the specific "No error." message
-    if "No error." in error_message:
-        return "No error."
-
-    # Common syntax errors
-    syntax_errors = [
-        "syntax error",
-        "near",
-        "incomplete input"
-    ]
+import re
+import numpy as np
+import pandas as pd
 
-    # Common semantic errors
-    semantic_errors = [
-        "no such table",
-        "no such column",
-        "datatype mismatch",
-        "unique constraint failed",
-        "foreign key constraint failed",
-        "check constraint failed",
-        "ambiguous column name"
-    ]
+# Common syntax errors
+syntax_errors = [
+    "syntax error",
+    "near",
+    "incomplete input"
+]
 
-    # Convert the error message to lowercase for comparison
-    error_message = error_message.lower()
+# Common semantic errors
+semantic_errors = [
+    "no such table",
+    "no such column",
+    "datatype mismatch",
+    "unique constraint failed",
+    "foreign key constraint failed",
+    "check constraint failed",
+    "ambiguous column name"
+]
 
-    # Check if the error is syntactic
-    for syntax_error in syntax_errors:
-        if syntax_error in error_message:
-            return "Syntactic"
+# Compiled patterns for each category, checked in this order
+error_patterns = [
+    ("No error.", re.compile(re.escape("No error."))),
+    ("Timeout", re.compile(re.escape("Timeout:"))),
+    ("Truncated", re.compile(re.escape("Truncated:"))),
+    ("Syntactic", re.compile('|'.join(re.escape(error) for error in syntax_errors), re.IGNORECASE)),
+    ("Semantic", re.compile('|'.join(re.escape(error) for error in semantic_errors), re.IGNORECASE))
+]
 
-    # Check if the error is semantic
-    for semantic_error in semantic_errors:
-        if semantic_error in error_message:
-            return "Semantic"
+# Function to classify SQLite errors
+def classify_sqlite_error(error_message):
+    for category, pattern in error_patterns:
+        if pattern.search(error_message):
+            return category
 
     # If the error type is not recognized
-    return "Unknown"
\ No newline at end of file
+    return "Unknown"
+
+# Function to classify a whole column of SQLite errors
+def classify_sqlite_errors(error_messages):
+    error_messages = error_messages.astype(str)
+    conditions = [error_messages.str.contains(pattern, regex=True).to_numpy() for _, pattern in error_patterns]
+    categories = [category for category, _ in error_patterns]
+    return pd.Series(np.select(conditions, categories, default="Unknown"), index=error_messages.index)
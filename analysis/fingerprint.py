@@ -0,0 +1,96 @@
+import json
+import hashlib
+import functools
+
+# Fingerprint fields recorded for each result set, as <prefix>_<field> columns
+fingerprint_fields = ['hash', 'hash_unordered', 'rows', 'columns', 'types']
+
+# Multiset hashes are sums of row hashes modulo 2^128
+hash_bits = 128
+
+_digest = functools.partial(hashlib.blake2b, digest_size=hash_bits // 8)
+
+# SQLite storage class of each Python value type
+type_names = {bool: 'integer', int: 'integer', float: 'real', str: 'text', bytes: 'blob'}
+
+# Rows are encoded as JSON lists, values without a JSON type as their str(). The common types
+# are encoded column by column with the functions the json module uses for them.
+_encode_value = json.JSONEncoder(default=str).encode
+value_encoders = {int: int.__repr__, str: json.encoder.encode_basestring_ascii, type(None): lambda value: 'null'}
+
+def _canonical_value(value):
+    # Integral floats hash like integers so 1 and 1.0 match, and NaN matches NaN
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value.is_integer():
+            return int(value)
+    return value
+
+def _type_name(value_type):
+    return 'null' if value_type is type(None) else type_names.get(value_type, value_type.__name__)
+
+def _column_signature(value_types, column):
+    names = {_type_name(value_type) for value_type in value_types if value_type is not float}
+    if float in value_types:
+        # NaN is a missing value
+        for value in column:
+            if type(value) is float:
+                names.add('real' if value == value else 'null')
+    return '|'.join(sorted(names))
+
+def _encode_column(column, value_types):
+    if len(value_types) == 1:
+        value_type, = value_types
+        return list(map(value_encoders.get(value_type, _encode_value), column))
+    return [value_encoders.get(type(value), _encode_value)(value) for value in column]
+
+def result_fingerprint(result):
+    """
+    Fingerprints a result set: an ordered hash, an order-insensitive multiset hash of its rows,
+    the row and column counts and the column type signature. The result is walked column by
+    column, and only the columns holding floats are canonicalized value by value.
+    """
+    columns = list(zip(*result))
+    value_types = [set(map(type, column)) for column in columns]
+    encoded_columns = []
+    for column, types in zip(columns, value_types):
+        if float in types:
+            column = [_canonical_value(value) for value in column]
+            types = set(map(type, column))
+        encoded_columns.append(_encode_column(column, types))
+    if encoded_columns:
+        rows = ['[' + row + ']' for row in map(', '.join, zip(*encoded_columns))]
+    else:
+        rows = ['[]'] * len(result)
+
+    ordered = _digest()
+    if rows:
+        ordered.update(('\n'.join(rows) + '\n').encode('utf-8'))
+    multiset = sum(int.from_bytes(_digest(row.encode('utf-8')).digest(), 'big') for row in rows) % (1 << hash_bits)
+
+    return {
+        'hash': ordered.hexdigest(),
+        'hash_unordered': f'{multiset:0{hash_bits // 4}x}',
+        'rows': len(result),
+        'columns': len(columns),
+        'types': ','.join(map(_column_signature, value_types, columns))
+    }
+
+def fingerprint_columns(prefix, result, suffix=''):
+    return {f'{prefix}_{field}{suffix}': value for field, value in result_fingerprint(result).items()}
+
+def add_result_fingerprints(data, num_iterations):
+    """
+    Adds the exp_<field> and inf_<field>_<i> fingerprint columns for findings
+    written without them, computed from the response columns.
+    """
+    suffixes = [('exp_response', '')] + [(f'inf_response_{i}', f'_{i}') for i in range(1, num_iterations + 1)]
+    for response_col, suffix in suffixes:
+        prefix = response_col.split('_')[0]
+        if all(f'{prefix}_{field}{suffix}' in data.columns for field in fingerprint_fields):
+            continue
+        fingerprints = [result_fingerprint(result) for result in data[response_col].tolist()]
+        for field in fingerprint_fields:
+            data[f'{prefix}_{field}{suffix}'] = [fingerprint[field] for fingerprint in fingerprints]
+    return data
@@ -0,0 +1,154 @@
+import re
+import math
+import numpy as np
+import pandas as pd
+from analysis.error_analysis import classify_sqlite_errors
+from analysis.match_analysis import calculate_long_matches
+from analysis.consistency import sql_agreement
+from analysis.self_consistency import majority_vote
+
+# Fields of each repetition in the wide findings, named inf_<field>_<repetition>
+repetition_pattern = re.compile(r'^inf_(.+)_(\d+)$')
+
+# Expected fields repeated on every row of the long format
+expected_fields = ['exp_sql', 'exp_hash', 'exp_hash_unordered', 'exp_rows', 'exp_columns']
+
+match_names = ['match_sql', 'match_result', 'match_result_unordered', 'match_rows', 'match_columns']
+error_types = ['Syntactic', 'Semantic', 'Timeout', 'Truncated', 'Unknown', 'No error.']
+
+# Normal quantile of two-sided 95% confidence intervals
+z_95 = 1.959964
+
+def repetition_numbers(columns):
+    """
+    Returns the repetition numbers present in the wide findings columns, in order.
+    """
+    return sorted({int(match.group(2)) for match in map(repetition_pattern.match, columns)
+                   if match is not None and match.group(1) == 'sql'})
+
+def to_long(data, num_repetitions=None):
+    """
+    Returns wide findings in long format, one row per (nlq_id, repetition), with the fields of
+    each repetition without their inf_ prefix and repetition suffix (sql, error, time_ms, hash, ...)
+    and the expected fields of the NLQ. Only the first `num_repetitions` are kept when given.
+    """
+    numbers = repetition_numbers(data.columns)
+    if num_repetitions is not None:
+        numbers = [number for number in numbers if number <= num_repetitions]
+    fields = []
+    for column in data.columns:
+        match = repetition_pattern.match(column)
+        if match is not None and int(match.group(2)) == numbers[0] and match.group(1) != 'response':
+            fields.append(match.group(1))
+
+    nlq_ids = data['nlq_id'].to_numpy() if 'nlq_id' in data.columns else data.index.to_numpy()
+    frames = []
+    for number in numbers:
+        frame = {'nlq_id': nlq_ids, 'repetition': np.full(len(data), number)}
+        for field in fields:
+            column = f'inf_{field}_{number}'
+            frame[field] = data[column].to_numpy() if column in data.columns else np.full(len(data), None)
+        for field in expected_fields:
+            frame[field] = data[field].to_numpy()
+        frames.append(pd.DataFrame(frame))
+    return pd.concat(frames, ignore_index=True)
+
+def pass_at_k(num_samples, num_correct, k):
+    """
+    Unbiased estimate of the probability that at least one of k samples drawn without
+    replacement from `num_samples`, of which `num_correct` are correct, is correct.
+    """
+    if k > num_samples:
+        return np.nan
+    if num_samples - num_correct < k:
+        return 1.0
+    return 1.0 - math.comb(num_samples - num_correct, k) / math.comb(num_samples, k)
+
+def mean_interval(values):
+    """
+    Returns the mean of per-NLQ values with a normal 95% confidence interval. Averaging within
+    each NLQ first keeps the repetitions of one NLQ, which are correlated, from narrowing the interval.
+    """
+    values = pd.Series(values, dtype=float).dropna()
+    if values.empty:
+        return np.nan, np.nan, np.nan
+    mean = values.mean()
+    half_width = z_95 * values.std(ddof=1) / math.sqrt(len(values)) if len(values) > 1 else 0.0
+    return mean, max(mean - half_width, 0.0), min(mean + half_width, 1.0)
+
+def wilson_interval(successes, trials):
+    """
+    Returns the Wilson 95% confidence interval of a proportion.
+    """
+    if trials == 0:
+        return np.nan, np.nan
+    p = successes / trials
+    denominator = 1 + z_95 ** 2 / trials
+    center = (p + z_95 ** 2 / (2 * trials)) / denominator
+    half_width = z_95 * math.sqrt(p * (1 - p) / trials + z_95 ** 2 / (4 * trials ** 2)) / denominator
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+class RepetitionAnalysis:
+    """
+    Aggregates findings in long format batch by batch, for any number of repetitions.
+    Every NLQ must be in a single batch, as when batches are slices of the wide findings.
+    Keeps one row per NLQ with its agreement, correct samples, majority vote answer and pass@k,
+    the counts of each repetition and the times, and optionally the long rows themselves.
+    """
+    def __init__(self, ks=(1,), keep_rows=True):
+        self.ks = ks
+        self.keep_rows = keep_rows
+        self._nlqs = []
+        self._counts = []
+        self._times = []
+        self._rows = []
+
+    def add(self, long):
+        long = pd.concat([long, calculate_long_matches(long)], axis=1)
+        long['category_error'] = classify_sqlite_errors(long['error'].astype(str))
+
+        # One group-by pass per NLQ and one per repetition
+        nlqs = sql_agreement(long)
+        for name in match_names:
+            nlqs[f'{name}_count'] = long.groupby('nlq_id', sort=False)[name].sum()
+
+        # Answer chosen by majority vote over the results of the samples, compared with the expected result
+        vote = majority_vote(long)
+        expected = long.drop_duplicates('nlq_id').set_index('nlq_id')
+        nlqs['vote_repetition'] = vote['vote_repetition']
+        nlqs['vote_share'] = vote['vote_share']
+        nlqs['vote_match_result'] = (vote['vote_hash'] == expected['exp_hash']).astype(bool)
+        nlqs['vote_match_result_unordered'] = (vote['vote_hash_unordered'] == expected['exp_hash_unordered']).astype(bool)
+        self._nlqs.append(nlqs)
+
+        counts = long.groupby('repetition')[match_names].sum()
+        counts['samples'] = long.groupby('repetition').size()
+        categories = pd.crosstab(long['repetition'], long['category_error']).reindex(columns=error_types, fill_value=0)
+        self._counts.append(counts.join(categories))
+
+        self._times.append(long[['repetition', 'time_ms', 'exec_time_ms']])
+        if self.keep_rows:
+            self._rows.append(long.drop(columns=[field for field in expected_fields if field != 'exp_sql']))
+
+    def nlq_table(self):
+        """
+        Returns one row per NLQ with its agreement, correct samples, majority vote and pass@k for each k.
+        """
+        nlqs = pd.concat(self._nlqs)
+        for k in self.ks:
+            nlqs[f'pass@{k}'] = [pass_at_k(int(samples), int(correct), k)
+                                 for samples, correct in zip(nlqs['samples'], nlqs['match_result_count'])]
+        return nlqs
+
+    def repetition_table(self):
+        """
+        Returns one row per repetition with the number of samples, matches and errors of each category.
+        """
+        counts = pd.concat(self._counts)
+        return counts.groupby(level=0).sum().sort_index()
+
+    def time_table(self):
+        return pd.concat(self._times, ignore_index=True)
+
+    def rows(self):
+        return pd.concat(self._rows, ignore_index=True) if self._rows else pd.DataFrame()
@@ -1,6 +1,10 @@
+import numpy as np
+import pandas as pd
+from analysis.sql_extraction import canonical_sql, canonical_sql_values
+
 # Function to calculate matches
 def calculate_sql_matches(row, inf_sql_col, exp_sql_col):
-    return row[inf_sql_col] == row[exp_sql_col]
+    return canonical_sql(row[inf_sql_col]) == canonical_sql(row[exp_sql_col])
 
 def calculate_result_matches(row, inf_response_col, exp_response_col):
     return row[inf_response_col] == row[exp_response_col]
@@ -11,4 +15,20 @@ def calculate_record_matches(row, inf_response_col, exp_response_col):
 def calculate_column_matches(row, inf_response_col, exp_response_col):
     if len(row[inf_response_col]) > 0 and len(row[exp_response_col]) > 0:
         return len(row[inf_response_col][0]) == len(row[exp_response_col][0])
-    return False
\ No newline at end of file
+    return False
+
+def calculate_long_matches(long):
+    """
+    Calculates the match columns of findings in long format, one row per (nlq_id, repetition),
+    from the sql and fingerprint columns of each row and the exp_* columns of its NLQ.
+    """
+    rows = long['rows'].to_numpy()
+    exp_rows = long['exp_rows'].to_numpy()
+    return pd.DataFrame({
+        'match_sql': np.asarray(canonical_sql_values(long['sql'].to_numpy()), dtype=object)
+                     == np.asarray(canonical_sql_values(long['exp_sql'].to_numpy()), dtype=object),
+        'match_result': long['hash'].to_numpy() == long['exp_hash'].to_numpy(),
+        'match_result_unordered': long['hash_unordered'].to_numpy() == long['exp_hash_unordered'].to_numpy(),
+        'match_rows': rows == exp_rows,
+        'match_columns': (rows > 0) & (exp_rows > 0) & (long['columns'].to_numpy() == long['exp_columns'].to_numpy())
+    }, index=long.index).astype(bool)
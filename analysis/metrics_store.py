@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import pandas as pd
+
+class MetricsStore:
+    """
+    SQLite file holding the analyzed metrics of every experiment: the summary metrics,
+    the metrics of each iteration and a signature of the findings they were computed from.
+    It also records a hash of the inputs of each generated plot, so the general analysis
+    only draws again the plots whose inputs changed.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS experiments ("
+            "id_experiment TEXT PRIMARY KEY, name TEXT NOT NULL, findings_signature TEXT, "
+            "num_iterations INTEGER, num_nlqs INTEGER, analyzed_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS summary_metrics ("
+            "id_experiment TEXT NOT NULL, metric TEXT NOT NULL, position INTEGER NOT NULL, value REAL, "
+            "PRIMARY KEY (id_experiment, metric));"
+            "CREATE TABLE IF NOT EXISTS iteration_metrics ("
+            "id_experiment TEXT NOT NULL, iteration INTEGER NOT NULL, metric TEXT NOT NULL, value REAL, "
+            "PRIMARY KEY (id_experiment, iteration, metric));"
+            "CREATE TABLE IF NOT EXISTS plots (filename TEXT PRIMARY KEY, inputs_hash TEXT NOT NULL, created REAL NOT NULL);"
+        )
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def upsert_experiment(self, id_experiment, name, summary, iterations=None, findings_signature=None,
+                          num_iterations=None, num_nlqs=None):
+        """
+        Replaces the metrics of an experiment. `summary` maps each summary metric to its value,
+        in display order, and `iterations` is a DataFrame with one row per iteration (numbered from 1)
+        and one column per metric.
+        """
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO experiments (id_experiment, name, findings_signature, num_iterations, num_nlqs, analyzed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (id_experiment, name, findings_signature, num_iterations, num_nlqs, time.time())
+            )
+            self._connection.execute("DELETE FROM summary_metrics WHERE id_experiment = ?", (id_experiment,))
+            self._connection.executemany(
+                "INSERT INTO summary_metrics (id_experiment, metric, position, value) VALUES (?, ?, ?, ?)",
+                [(id_experiment, metric, position, _to_float(value)) for position, (metric, value) in enumerate(summary.items())]
+            )
+            self._connection.execute("DELETE FROM iteration_metrics WHERE id_experiment = ?", (id_experiment,))
+            if iterations is not None:
+                self._connection.executemany(
+                    "INSERT INTO iteration_metrics (id_experiment, iteration, metric, value) VALUES (?, ?, ?, ?)",
+                    [(id_experiment, int(iteration), metric, _to_float(value))
+                     for iteration, row in iterations.iterrows() for metric, value in row.items()]
+                )
+
+    def findings_signature(self, id_experiment):
+        """
+        Returns (findings signature, number of iterations) of the last analysis of an experiment, or None.
+        """
+        return self._connection.execute(
+            "SELECT findings_signature, num_iterations FROM experiments WHERE id_experiment = ?", (id_experiment,)
+        ).fetchone()
+
+    def experiments(self, name_like=None):
+        """
+        Returns the IDs of the stored experiments, only those whose name contains `name_like` when given.
+        """
+        query = "SELECT id_experiment FROM experiments"
+        if name_like is not None:
+            return [row[0] for row in self._connection.execute(query + " WHERE instr(name, ?) > 0 ORDER BY id_experiment", (name_like,))]
+        return [row[0] for row in self._connection.execute(query + " ORDER BY id_experiment")]
+
+    def summary_metrics(self, ids_experiments=None, name_like=None):
+        """
+        Returns the summary metrics as a DataFrame with one row per metric and one column per experiment.
+        """
+        if ids_experiments is None:
+            ids_experiments = self.experiments(name_like)
+        rows = self._query_in(
+            "SELECT metric, position, id_experiment, value FROM summary_metrics WHERE id_experiment IN ({})", ids_experiments)
+        metrics = pd.DataFrame(rows, columns=['Metric', 'position', 'id_experiment', 'value'])
+        order = metrics.groupby('Metric')['position'].min().sort_values().index
+        table = metrics.pivot(index='Metric', columns='id_experiment', values='value').reindex(order)
+        table.columns.name = None
+        return table[[id_experiment for id_experiment in ids_experiments if id_experiment in table.columns]]
+
+    def iteration_metrics(self, ids_experiments=None, name_like=None):
+        """
+        Returns the metrics of each iteration in long format: id_experiment, iteration, metric and value.
+        """
+        if ids_experiments is None:
+            ids_experiments = self.experiments(name_like)
+        rows = self._query_in(
+            "SELECT id_experiment, iteration, metric, value FROM iteration_metrics WHERE id_experiment IN ({}) "
+            "ORDER BY id_experiment, iteration", ids_experiments)
+        return pd.DataFrame(rows, columns=['id_experiment', 'iteration', 'metric', 'value'])
+
+    def _query_in(self, query, values):
+        return self._connection.execute(query.format(', '.join('?' * len(values))), list(values)).fetchall()
+
+    def plot_hash(self, filename):
+        row = self._connection.execute("SELECT inputs_hash FROM plots WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_plot_hash(self, filename, inputs_hash):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO plots (filename, inputs_hash, created) VALUES (?, ?, ?)",
+                                     (filename, inputs_hash, time.time()))
+
+def _to_float(value):
+    # NumPy scalars and missing values are stored as plain floats and NULL
+    return None if pd.isna(value) else float(value)
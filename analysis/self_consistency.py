@@ -0,0 +1,39 @@
+import pandas as pd
+
+# Columns of the answer chosen by majority vote for each NLQ, from the fields of its winning sample
+vote_fields = {'repetition': 'vote_repetition', 'sql': 'vote_sql', 'hash': 'vote_hash', 'hash_unordered': 'vote_hash_unordered'}
+
+def majority_vote(long):
+    """
+    Returns the answer chosen by majority vote among the samples of each NLQ of findings in long format,
+    one row per nlq_id. Every sample votes for its order-insensitive result hash, a failed query voting
+    for its error result as match_result compares it, the most voted result wins, ties going to the result
+    of the earliest repetition, and the winning sample is its earliest repetition. vote_share is the share
+    of the samples behind the answer.
+    """
+    votes = long.groupby(['nlq_id', 'hash_unordered'], dropna=False, sort=False).agg(
+        votes=('repetition', 'size'), repetition=('repetition', 'min')).reset_index()
+    votes = votes.sort_values(['nlq_id', 'votes', 'repetition'], ascending=[True, False, True], kind='stable')
+    winners = votes.drop_duplicates('nlq_id')
+
+    chosen = winners[['nlq_id', 'repetition', 'votes']].merge(long, on=['nlq_id', 'repetition'], how='left')
+    chosen = chosen.set_index('nlq_id')
+    chosen['vote_share'] = chosen['votes'] / long.groupby('nlq_id').size()
+
+    vote = chosen[list(vote_fields)].rename(columns=vote_fields)
+    vote['vote_repetition'] = vote['vote_repetition'].astype('Int64')
+    vote['vote_share'] = chosen['vote_share']
+    vote = vote.reindex(pd.unique(long['nlq_id']))
+    vote['vote_share'] = vote['vote_share'].fillna(0.0)
+    vote.index.name = 'nlq_id'
+    return vote
+
+def add_majority_vote(findings, long):
+    """
+    Adds the majority vote columns to wide findings, given the same findings in long format.
+    """
+    vote = majority_vote(long)
+    nlq_ids = findings['nlq_id'] if 'nlq_id' in findings.columns else findings.index
+    for column in vote.columns:
+        findings[column] = vote[column].reindex(nlq_ids).set_axis(findings.index)
+    return findings
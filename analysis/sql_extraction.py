@@ -0,0 +1,124 @@
+import re
+
+# Fenced code block, with an optional language tag on its first line, possibly left unterminated
+fence_pattern = re.compile(r'```+[ \t]*(?:[\w+-]+[ \t]*(?=\r?\n))?(.*?)(?:```|\Z)', re.DOTALL)
+
+statement_keywords = r'(?:SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER|PRAGMA|EXPLAIN|VALUES)'
+
+# Start of a statement: a keyword opening a line (after an optional `sql` tag), otherwise the first upper case keyword
+line_start_pattern = re.compile(r'^[ \t]*(?:sql(?:ite)?[ \t]+)?(' + statement_keywords + r')\b', re.IGNORECASE | re.MULTILINE)
+keyword_pattern = re.compile(r'\b' + statement_keywords + r'\b')
+
+# SQLite tokens, tried in this order. Quotes must be closed to form a literal or a quoted identifier,
+# and backtick identifiers cannot hold spaces, so stray Markdown backticks end up as `other`.
+token_pattern = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`(?:[^`\s]|``)+`|\[[^\]\n]*\])
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<space>\s+)
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[^\W\d]\w*)
+  | (?P<parameter>[?:@$]\w*)
+  | (?P<operator>\|\||<<|>>|<=|>=|==|!=|<>|->>|->|[-+*/%<>=~&|(),.;])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Literals and quoted identifiers, captured to be kept as written, and comments, dropped by the split.
+# Splitting on them leaves the rest of the statement in a few runs where whitespace is collapsed in C.
+literal_pattern = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`\s]|``)+`|\[[^\]\n]*\])|--[^\n]*|/\*.*?(?:\*/|\Z)""", re.DOTALL)
+space_pattern = re.compile(r'\s+')
+
+# End of a statement outside literals: a semicolon, or for bare text a blank line or a closing inline-code backtick
+fenced_end_pattern = re.compile(r';')
+bare_end_pattern = re.compile(r';|`|\n[ \t]*\n')
+
+identifier_pattern = re.compile(r'[^\W\d]\w*')
+
+def tokenize(sql, pos=0):
+    """
+    Yields the (kind, text) tokens of a SQL string from `pos`, kind being the name of a group of `token_pattern`.
+    """
+    for match in token_pattern.finditer(sql, pos):
+        yield match.lastgroup, match.group()
+
+def _statement_start(block):
+    match = line_start_pattern.search(block)
+    if match is not None:
+        return match.start(1)
+    match = keyword_pattern.search(block)
+    return match.start() if match is not None else 0
+
+def _select_block(response):
+    # First fenced block holding a statement, otherwise the first fenced block, otherwise the whole response
+    first = None
+    for match in fence_pattern.finditer(response):
+        block = match.group(1)
+        if keyword_pattern.search(block) or line_start_pattern.search(block):
+            return block, True
+        if first is None:
+            first = block
+    if first is not None:
+        return first, True
+    return response, False
+
+def extract_sql(response):
+    """
+    Returns the first SQL statement of a model response on a single line. The statement is taken
+    from the first fenced code block, or from the bare text, starting at its first statement keyword
+    and ending at its first semicolon outside literals (kept), at a blank line or at a closing
+    inline-code backtick of bare text. Whitespace and comments outside string literals and quoted
+    identifiers become single spaces, and the literals themselves are left as written.
+    """
+    block, fenced = _select_block(str(response))
+    end_pattern = fenced_end_pattern if fenced else bare_end_pattern
+    pieces = []
+    text = []
+    for position, part in enumerate(literal_pattern.split(block[_statement_start(block):])):
+        if position % 2:
+            # Odd parts are the literals, or None where a comment was removed
+            if part is None:
+                text.append(' ')
+            else:
+                pieces.append(space_pattern.sub(' ', ''.join(text)))
+                pieces.append(part)
+                text = []
+            continue
+        if fenced:
+            part = part.replace('`', '')
+        end = end_pattern.search(part)
+        if end is not None:
+            text.append(part[:end.end()] if end.group() == ';' else part[:end.start()])
+            break
+        text.append(part)
+    pieces.append(space_pattern.sub(' ', ''.join(text)))
+    return ''.join(pieces).strip()
+
+def canonical_sql(sql):
+    """
+    Returns a canonical form of a SQL statement used to compare queries: keywords and identifiers
+    in lower case, quotes removed from identifiers that do not need them, one space between tokens,
+    no comments and no trailing semicolon. String literals keep their case and whitespace.
+    """
+    if not isinstance(sql, str):
+        return sql
+    tokens = []
+    for kind, text in tokenize(sql):
+        if kind == 'space' or kind == 'comment':
+            continue
+        if kind == 'word':
+            text = text.lower()
+        elif kind == 'quoted':
+            name = text[1:-1]
+            if identifier_pattern.fullmatch(name):
+                text = name.lower()
+        tokens.append(text)
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return ' '.join(tokens)
+
+def canonical_sql_values(values):
+    """
+    Returns the canonical form of each SQL statement of a column, computed once per distinct statement.
+    """
+    forms = {value: canonical_sql(value) for value in set(values)}
+    return [forms[value] for value in values]
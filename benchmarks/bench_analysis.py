@@ -0,0 +1,101 @@
+"""
+Benchmark of the analysis run by run_analysis.py (findings in long format aggregated by
+RepetitionAnalysis) against the previous row-by-row analysis of the wide findings.
+
+    python -m benchmarks.bench_analysis 10000
+
+The long-format analysis needs the result fingerprints, which are computed when the queries
+are executed (or when older findings without them are loaded), so their cost is reported
+on its own and in the end-to-end comparison.
+"""
+import sys
+import time
+import random
+import pandas as pd
+
+from analysis.error_analysis import classify_sqlite_error
+from analysis.match_analysis import calculate_sql_matches, calculate_result_matches, calculate_record_matches, calculate_column_matches
+from analysis.fingerprint import add_result_fingerprints
+from analysis.consistency import compare_inf_sql
+from analysis.long_analysis import RepetitionAnalysis, to_long, error_types
+
+# Benchmark parameters
+default_num_rows = 10000
+num_iterations = 3
+
+errors = [
+    "No error.",
+    "['Execution failed on sql ...: (sqlite3.OperationalError) near \"FROM\": syntax error']",
+    "['Execution failed on sql ...: (sqlite3.OperationalError) no such column: f.name']",
+    "['Timeout: query exceeded 30 s']"
+]
+queries = ["SELECT COUNT(*) FROM film;", "SELECT title FROM film;", "SELECT name FROM category;"]
+
+def random_result():
+    num_result_rows = random.randint(0, 20)
+    num_columns = random.randint(1, 4)
+    return [[random.randint(0, 3) for _ in range(num_columns)] for _ in range(num_result_rows)]
+
+def build_data(num_rows):
+    data = {'exp_sql': [random.choice(queries) for _ in range(num_rows)],
+            'exp_response': [random_result() for _ in range(num_rows)]}
+    for i in range(1, num_iterations + 1):
+        data[f'inf_sql_{i}'] = [random.choice(queries) for _ in range(num_rows)]
+        data[f'inf_response_{i}'] = [random.choice([response, random_result()]) for response in data['exp_response']]
+        data[f'inf_error_{i}'] = [random.choice(errors) for _ in range(num_rows)]
+        data[f'inf_time_ms_{i}'] = [random.uniform(100, 2000) for _ in range(num_rows)]
+        data[f'inf_exec_time_ms_{i}'] = [random.uniform(1, 50) for _ in range(num_rows)]
+    return pd.DataFrame(data)
+
+def row_wise(data):
+    for i in range(1, num_iterations + 1):
+        data[f'match_sql_{i}'] = data.apply(lambda row: calculate_sql_matches(row, f'inf_sql_{i}', 'exp_sql'), axis=1)
+        data[f'match_result_{i}'] = data.apply(lambda row: calculate_result_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
+        data[f'match_rows_{i}'] = data.apply(lambda row: calculate_record_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
+        data[f'match_columns_{i}'] = data.apply(lambda row: calculate_column_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
+        data[f'category_error_{i}'] = data[f'inf_error_{i}'].apply(classify_sqlite_error)
+    data['consistency'] = data.apply(compare_inf_sql, axis=1)
+    return data
+
+def long_format(data):
+    # As run_analysis.py, which adds each batch of findings the same way
+    analysis = RepetitionAnalysis([1], keep_rows=True)
+    analysis.add(to_long(data, num_iterations))
+    return analysis.nlq_table(), analysis.repetition_table(), analysis.rows()
+
+def check_same_metrics(row_result, long_result):
+    # Both analyses must count the same matches and errors in each iteration and find the same consistency
+    nlqs, counts, _ = long_result
+    for i in range(1, num_iterations + 1):
+        for match in ['match_sql', 'match_result', 'match_rows', 'match_columns']:
+            assert row_result[f'{match}_{i}'].sum() == counts.loc[i, match], (match, i)
+        categories = row_result[f'category_error_{i}'].value_counts()
+        assert all(categories.get(category, 0) == counts.loc[i, category] for category in error_types), i
+    assert (row_result['consistency'].to_numpy() == nlqs['consistency'].reindex(row_result.index).to_numpy()).all()
+
+def timed(function, data):
+    start_time = time.perf_counter()
+    result = function(data)
+    return result, (time.perf_counter() - start_time) * 1000
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    rows = int(argv[0]) if argv else default_num_rows
+    random.seed(0)
+
+    data = build_data(rows)
+    row_result, row_ms = timed(row_wise, data.copy())
+    fingerprinted, fingerprint_ms = timed(lambda d: add_result_fingerprints(d, num_iterations), data.copy())
+    long_result, long_ms = timed(long_format, fingerprinted)
+    check_same_metrics(row_result, long_result)
+
+    # Findings written without fingerprints pay for both steps when they are analyzed
+    total_ms = fingerprint_ms + long_ms
+    print(f"Rows: {rows}, iterations: {num_iterations}")
+    print(f"Row-wise apply:              {row_ms:10.1f} ms")
+    print(f"Long-format analysis:        {long_ms:10.1f} ms ({row_ms / long_ms:.1f}x faster, given the fingerprints)")
+    print(f"Fingerprints:                {fingerprint_ms:10.1f} ms (at execution, or when loading findings without them)")
+    print(f"Fingerprints + long format:  {total_ms:10.1f} ms ({row_ms / total_ms:.1f}x the row-wise speed, end to end)")
+
+if __name__ == '__main__':
+    main()
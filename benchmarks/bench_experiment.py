@@ -0,0 +1,158 @@
+"""
+Offline benchmark of the experiment loop against the local mock server.
+
+    python -m benchmarks.bench_experiment --experiment 5-2 --mode async --latency lognormal:300:0.5
+
+Reports NLQs/sec, the p50/p95 loop overhead per (NLQ, repetition) outside the
+inference calls, the memory high-water mark, and the attempts, backoff and failures
+of the request layer when faults are injected:
+
+    python -m benchmarks.bench_experiment --error-rate 0.1 --server-error-rate 0.05 --hang-rate 0.01 --hang 5 --timeout 2
+
+With --n-sampling the repetitions of each NLQ are requested in one call with `n`, and
+with --reject-n as well the server rejects `n` so they fall back to one call each.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import run_experiment
+from experiments import experiments
+from experiment.journal import ResultJournal, read_journal
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout_s=30):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Mock server did not start on port {port}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the experiment loop against the local mock server.')
+    parser.add_argument('--experiment', default='5-2')
+    parser.add_argument('--mode', choices=['sync', 'async'], default='async')
+    parser.add_argument('--latency', default='fixed:50')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests rejected with 429')
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help='fraction of requests failing with 500 or 503')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that hang before answering')
+    parser.add_argument('--hang', type=float, default=5, help='seconds a hanging request waits')
+    parser.add_argument('--outage', help="'start_s:duration_s' window where every request fails with 503")
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request is abandoned and retried')
+    parser.add_argument('--hedge', action='store_true', help='send a second copy of requests slower than the p95 latency')
+    parser.add_argument('--n-sampling', action='store_true', help='request the repetitions of each NLQ in one call with n')
+    parser.add_argument('--reject-n', action='store_true', help='reject requests with n like a model that does not accept it')
+    parser.add_argument('--records', type=int, default=80)
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--requests-per-minute', type=float, default=1e6, help='client-side request budget, high by default to measure the loop')
+    parser.add_argument('--tokens-per-minute', type=float, default=1e9, help='client-side token budget, high by default to measure the loop')
+    args = parser.parse_args(argv)
+
+    # Start the mock server in its own process so it does not share the GIL with the pipeline
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.mock_openai_server', '--port', str(port),
+                               '--latency', args.latency, '--error-rate', str(args.error_rate), '--seed', '0',
+                               '--server-error-rate', str(args.server_error_rate), '--hang-rate', str(args.hang_rate),
+                               '--hang', str(args.hang)] + (['--outage', args.outage] if args.outage else [])
+                              + (['--reject-n'] if args.reject_n else []),
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+
+        # The OpenAI client reads these variables when it is created on first use
+        os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{port}/v1'
+        os.environ['OPENAI_API_KEY'] = 'mock'
+        # Write to a temporary directory, without the response cache or client-side rate limits
+        output_dir = tempfile.mkdtemp(prefix='bench_experiment_')
+        run_experiment.config['output_path'] = output_dir + '/'
+        run_experiment.use_response_cache = False
+        run_experiment.execution_mode = args.mode
+        run_experiment.num_records = args.records
+        run_experiment.num_repetitions = args.repetitions
+        run_experiment.requests_per_minute = args.requests_per_minute
+        run_experiment.tokens_per_minute = args.tokens_per_minute
+        run_experiment.request_timeout_s = args.timeout
+        run_experiment.hedge_requests = args.hedge
+        run_experiment.n_sampling = args.n_sampling
+        run_experiment.n_sampling_models.add(run_experiment.config[experiments[args.experiment]['model']])
+
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        artifacts = run_experiment.load_shared_artifacts()
+        startup_s = time.perf_counter() - start_time
+
+        # Time spent inside generate_completion and the time of each journal write
+        inference_s = [0.0]
+        write_times = []
+        generate_completion = run_experiment.generate_completion
+        write_repetition = ResultJournal.write_repetition
+
+        def timed_generate_completion(*call_args):
+            call_start = time.perf_counter()
+            try:
+                return generate_completion(*call_args)
+            finally:
+                inference_s[0] += time.perf_counter() - call_start
+
+        def timed_write_repetition(self, *call_args):
+            write_repetition(self, *call_args)
+            write_times.append((time.perf_counter(), inference_s[0]))
+
+        run_experiment.generate_completion = timed_generate_completion
+        ResultJournal.write_repetition = timed_write_repetition
+
+        loop_start = time.perf_counter()
+        run_experiment.run_experiment(args.experiment, artifacts, show_progress=False)
+        total_s = time.perf_counter() - loop_start
+        _, peak_python_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Overhead of each (NLQ, repetition): time between journal writes minus the time spent in inference
+        overheads_ms = []
+        previous_time, previous_inference = loop_start, 0.0
+        for write_time, inference in write_times:
+            overheads_ms.append(((write_time - previous_time) - (inference - previous_inference)) * 1000)
+            previous_time, previous_inference = write_time, inference
+
+        # Attempts, backoff and failures recorded by the request layer for each (NLQ, repetition)
+        journal_path = os.path.join(output_dir, experiments[args.experiment]['name'] + '_journal.jsonl')
+        journal = [record for record in read_journal(journal_path) if record['repetition'] > 0]
+        attempts = [record['inf_attempts'] for record in journal]
+        backoff_s = sum(record['inf_backoff_ms'] for record in journal) / 1000
+        hedged = sum(record['inf_hedged'] for record in journal)
+        failed = sum(record['inf_api_error'] is not None for record in journal)
+    finally:
+        server.terminate()
+        server.wait()
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"Experiment {args.experiment}, mode {args.mode}, latency {args.latency}, "
+          f"{args.records} NLQs x {args.repetitions} repetitions")
+    print(f"Startup (shared artifacts): {startup_s:8.2f} s")
+    print(f"Experiment wall clock:      {total_s:8.2f} s")
+    print(f"Throughput:                 {args.records / total_s:8.2f} NLQs/s")
+    print(f"Loop overhead p50:          {np.percentile(overheads_ms, 50):8.2f} ms")
+    print(f"Loop overhead p95:          {np.percentile(overheads_ms, 95):8.2f} ms")
+    print(f"Peak Python memory:         {peak_python_bytes / 1024 / 1024:8.2f} MB")
+    print(f"Max RSS:                    {max_rss_mb:8.2f} MB")
+    print(f"Requests sent:              {sum(attempts):8d} for {len(attempts)} inferences (max {max(attempts)} attempts)")
+    print(f"Backoff:                    {backoff_s:8.2f} s")
+    print(f"Hedged answers:             {hedged:8d}")
+    print(f"Failed after retries:       {failed:8d}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import os
+import re
+import sys
+import json
+import time
+
+sys.path.insert(0, '.')
+from analysis.sql_extraction import extract_sql, canonical_sql
+
+# Benchmark parameters
+num_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+corpus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql_extraction_corpus.jsonl')
+
+def legacy_extract(response):
+    # Cleanup used before the extraction module: five passes over the whole response
+    inferred_sql = response.strip().replace('\n', ' ')
+    inferred_sql = re.sub(r'[`]+', '', inferred_sql)
+    inferred_sql = re.sub(r'\bsql\b', '', inferred_sql)
+    inferred_sql = re.sub(r'\bsqlite\b', '', inferred_sql)
+    inferred_sql = re.sub(r'\s+', ' ', inferred_sql).strip()
+    return re.sub(r';\s*;', ';', inferred_sql)
+
+def timed(function, responses):
+    start_time = time.perf_counter()
+    for _ in range(num_rounds):
+        for response in responses:
+            function(response)
+    return (time.perf_counter() - start_time) * 1e6 / (num_rounds * len(responses))
+
+with open(corpus_path, 'r', encoding='utf-8') as f:
+    corpus = [json.loads(line) for line in f if line.strip()]
+responses = [case['response'] for case in corpus]
+
+# Every response of the corpus must give its expected statement
+failures = [case for case in corpus if extract_sql(case['response']) != case['sql']]
+for case in failures:
+    print(f"Mismatch ({case['note']}): {extract_sql(case['response'])!r} != {case['sql']!r}")
+assert not failures
+
+legacy_wrong = [case['note'] for case in corpus if legacy_extract(case['response']) != case['sql']]
+legacy_us = timed(legacy_extract, responses)
+extract_us = timed(extract_sql, responses)
+canonical_us = timed(canonical_sql, [case['sql'] for case in corpus])
+
+print(f"Responses: {len(corpus)}, rounds: {num_rounds}")
+print(f"Legacy re.sub passes: {legacy_us:8.2f} us per response ({len(legacy_wrong)} of {len(corpus)} responses wrong)")
+print(f"extract_sql:          {extract_us:8.2f} us per response")
+print(f"canonical_sql:        {canonical_us:8.2f} us per statement")
+for note in legacy_wrong:
+    print(f"  Legacy wrong: {note}")
@@ -0,0 +1,330 @@
+"""
+Local stand-in for the OpenAI chat completions API, used to benchmark and test the
+experiment pipeline without spending API money.
+
+Completions are replayed from a recorded corpus (JSONL lines with "nlq" and "content")
+or, by default, answered with the expected SQL of the dataset. Latency follows a
+configurable distribution and a fraction of the requests can be rejected with 429.
+Faults can also be injected to test the retries of the pipeline: server errors (500/503),
+requests that hang before answering, and an outage window where every request fails with 503.
+The files and batches endpoints of the Batch API are also served: a batch is processed
+in the background, taking one latency sample, and its failed requests go to the error file.
+
+    python -m benchmarks.mock_openai_server --port 8765 --latency lognormal:800:0.5 --error-rate 0.05
+    python -m benchmarks.mock_openai_server --server-error-rate 0.05 --hang-rate 0.01 --hang 90 --outage 20:15
+
+Then point the OpenAI client to it:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=mock python run_experiment.py
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from experiment.prompt_assembly import input_question_heading
+
+def parse_latency(spec):
+    """
+    Returns a function giving a latency in seconds from a spec such as
+    'fixed:200', 'uniform:100:400' or 'lognormal:800:0.5' (median in ms and sigma).
+    """
+    kind, *values = spec.split(':')
+    values = [float(value) for value in values]
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'lognormal':
+        median_ms, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median_ms / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+def load_answers(dataset_path, corpus_path=None):
+    """
+    Returns a dictionary mapping each NLQ to the content of its completion.
+    """
+    dataset = pd.read_excel(dataset_path)
+    answers = {nlq: f"```sql\n{sql}\n```" for nlq, sql in zip(dataset['nlq'], dataset['sql'])}
+    if corpus_path:
+        with open(corpus_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                answers[record['nlq']] = record['content']
+    return answers
+
+class MockState:
+    def __init__(self, answers, latency, error_rate, retry_after_s, server_error_rate=0.0, hang_rate=0.0, hang_s=0.0,
+                 outage=None, reject_n=False):
+        self.answers = answers
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after_s = retry_after_s
+        self.server_error_rate = server_error_rate
+        self.hang_rate = hang_rate
+        self.hang_s = hang_s
+        self.outage = outage
+        self.reject_n = reject_n
+        self.started = time.monotonic()
+        self.requests = 0
+        self.rejected = 0
+        self.faults = 0
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def reject(self):
+        with self.lock:
+            self.requests += 1
+            rejected = random.random() < self.error_rate
+            if rejected:
+                self.rejected += 1
+        return rejected
+
+    def fault(self):
+        """
+        Returns the fault injected in a chat request, if any: 'outage', 'server_error' or 'hang'.
+        """
+        fault = None
+        if self.outage is not None and self.outage[0] <= time.monotonic() - self.started < sum(self.outage):
+            fault = 'outage'
+        else:
+            draw = random.random()
+            if draw < self.server_error_rate:
+                fault = 'server_error'
+            elif draw < self.server_error_rate + self.hang_rate:
+                fault = 'hang'
+        if fault is not None:
+            with self.lock:
+                self.faults += 1
+        return fault
+
+    def add_file(self, content, filename, purpose):
+        file_id = f'file-{uuid.uuid4().hex[:24]}'
+        file_object = {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                       'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_id] = (file_object, content)
+        return file_object
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch.update(status='in_progress', in_progress_at=int(time.time()))
+        time.sleep(self.latency())
+
+        outputs = []
+        errors = []
+        for line in self.files[batch['input_file_id']][1].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            request_id = f'batch_req_{uuid.uuid4().hex[:24]}'
+            if self.reject():
+                errors.append({'id': request_id, 'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'rate_limit_exceeded', 'message': 'Rate limit reached'}})
+            elif self.reject_n and (request['body'].get('n') or 1) > 1:
+                errors.append({'id': request_id, 'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'unsupported_value', 'message': "Unsupported value: 'n' must be 1 for this model"}})
+            else:
+                body = chat_completion(request['body'], self.answer(request['body'].get('messages', [])))
+                outputs.append({'id': request_id, 'custom_id': request['custom_id'], 'error': None,
+                                'response': {'status_code': 200, 'request_id': request_id, 'body': body}})
+
+        def to_file(records, name):
+            content = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+            return self.add_file(content, name, 'batch_output')['id'] if records else None
+
+        batch.update(status='completed', completed_at=int(time.time()),
+                     output_file_id=to_file(outputs, f'{batch_id}_output.jsonl'),
+                     error_file_id=to_file(errors, f'{batch_id}_error.jsonl'),
+                     request_counts={'total': len(outputs) + len(errors), 'completed': len(outputs), 'failed': len(errors)})
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f'batch_{uuid.uuid4().hex[:24]}'
+        self.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': endpoint, 'input_file_id': input_file_id,
+            'completion_window': completion_window, 'status': 'validating', 'created_at': int(time.time()),
+            'output_file_id': None, 'error_file_id': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0}
+        }
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return self.batches[batch_id]
+
+    def answer(self, messages):
+        """
+        Returns the completion of the NLQ asked in the input question section of the last message.
+        Few-shot examples before that section may quote other NLQs of the dataset, so they are
+        left out, and the longest NLQ found wins over NLQs that are part of it.
+        """
+        prompt = messages[-1]['content'] if messages else ''
+        headings = list(input_question_heading.finditer(prompt))
+        question = prompt[headings[-1].end():] if headings else prompt
+        matches = [nlq for nlq in self.answers if nlq in question]
+        if not matches:
+            return "SELECT 1;"
+        return self.answers[max(matches, key=len)]
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def _read_json(self):
+        return json.loads(self._read_body() or b'{}')
+
+    def _read_form(self):
+        # Fields of a multipart/form-data upload, as (filename, content) for the file
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8')
+        message = BytesParser().parsebytes(header + self._read_body())
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            content = part.get_payload(decode=True)
+            fields[name] = (part.get_filename(), content) if part.get_filename() else content.decode('utf-8')
+        return fields
+
+    def _not_found(self):
+        self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        parts = path.split('/')
+        if path == '/stats':
+            self._send_json(200, {'requests': self.state.requests, 'rejected': self.state.rejected})
+        elif path.startswith('/v1/batches/') and parts[3] in self.state.batches:
+            self._send_json(200, self.state.batches[parts[3]])
+        elif path.startswith('/v1/files/') and parts[3] in self.state.files:
+            file_object, content = self.state.files[parts[3]]
+            if len(parts) > 4 and parts[4] == 'content':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self._send_json(200, file_object)
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        path = self.path.rstrip('/')
+        if path == '/v1/files':
+            form = self._read_form()
+            filename, content = form['file']
+            self._send_json(200, self.state.add_file(content, filename, form.get('purpose', 'batch')))
+            return
+        if path == '/v1/batches':
+            request = self._read_json()
+            if request.get('input_file_id') not in self.state.files:
+                self._send_json(400, {'error': {'message': 'Unknown input file'}})
+                return
+            self._send_json(200, self.state.create_batch(request['input_file_id'], request.get('endpoint'),
+                                                         request.get('completion_window', '24h')))
+            return
+        if path != '/v1/chat/completions':
+            self._not_found()
+            return
+        request = self._read_json()
+        state = self.state
+
+        if state.reject_n and (request.get('n') or 1) > 1:
+            self._send_json(400, {'error': {'message': "Unsupported value: 'n' must be 1 for this model",
+                                            'type': 'invalid_request_error', 'param': 'n', 'code': 'unsupported_value'}})
+            return
+
+        if state.reject():
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                            {'Retry-After': str(state.retry_after_s)})
+            return
+
+        fault = state.fault()
+        if fault == 'outage':
+            self._send_json(503, {'error': {'message': 'Service unavailable', 'type': 'server_error'}})
+            return
+        if fault == 'server_error':
+            self._send_json(random.choice([500, 503]), {'error': {'message': 'Internal server error', 'type': 'server_error'}})
+            return
+        if fault == 'hang':
+            time.sleep(state.hang_s)
+
+        time.sleep(state.latency())
+        self._send_json(200, chat_completion(request, state.answer(request.get('messages', []))))
+
+def chat_completion(request, content):
+    messages = request.get('messages', [])
+    prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4
+    completion_tokens = len(content) // 4
+    num_choices = request.get('n', 1) or 1
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request.get('model', 'mock'),
+        'choices': [
+            {'index': index, 'finish_reason': 'stop', 'logprobs': None,
+             'message': {'role': 'assistant', 'content': content}}
+            for index in range(num_choices)
+        ],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens * num_choices,
+            'total_tokens': prompt_tokens + completion_tokens * num_choices
+        }
+    }
+
+def make_server(port, answers, latency='fixed:0', error_rate=0.0, retry_after_s=1, server_error_rate=0.0, hang_rate=0.0,
+                hang_s=0.0, outage=None, reject_n=False):
+    """
+    Creates the mock server, call serve_forever() on it to start answering requests.
+    `outage` is (start, duration) in seconds after the server starts, and with `reject_n`
+    requests asking for more than one completion fail with 400 like for a model without `n`.
+    """
+    state = MockState(answers, parse_latency(latency), error_rate, retry_after_s, server_error_rate, hang_rate, hang_s, outage,
+                      reject_n)
+    handler = type('Handler', (MockHandler,), {'state': state})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat completions API.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dataset', default='dataset/data-nlq-sql-80.xlsx', help='dataset with the expected SQL of each NLQ')
+    parser.add_argument('--corpus', help='JSONL file of recorded completions with "nlq" and "content"')
+    parser.add_argument('--latency', default='fixed:0', help="'fixed:ms', 'uniform:min_ms:max_ms' or 'lognormal:median_ms:sigma'")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests rejected with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds sent with 429 responses')
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help='fraction of requests failing with 500 or 503')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that hang before answering')
+    parser.add_argument('--hang', type=float, default=120, help='seconds a hanging request waits before answering')
+    parser.add_argument('--outage', help="'start_s:duration_s' window after the start where every request fails with 503")
+    parser.add_argument('--reject-n', action='store_true', help='reject requests with n > 1 with 400')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    outage = tuple(float(value) for value in args.outage.split(':')) if args.outage else None
+    server = make_server(args.port, load_answers(args.dataset, args.corpus), args.latency, args.error_rate, args.retry_after,
+                         args.server_error_rate, args.hang_rate, args.hang, outage, args.reject_n)
+    print(f"Mock OpenAI server listening on http://127.0.0.1:{args.port}/v1", flush=True)
+    server.serve_forever()
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from openai import AsyncOpenAI
+from experiment.rate_limiter import RateLimiter
+from experiment.prompt_assembly import prompt_tokens_estimate
+from experiment.tracing import NullTracer, usage_attributes
+from experiment.resilience import RequestLayer, RequestFailed
+
+# Rough number of tokens reserved for the completion of each request
+completion_tokens_estimate = 256
+
+def estimate_tokens(messages, n=1):
+    return prompt_tokens_estimate(messages) + completion_tokens_estimate * n
+
+async def _infer(client, request_layer, model_name, key, messages, limiter, on_result, tracer, n=1):
+    estimated_tokens = estimate_tokens(messages, n)
+    # Several completions of the prompt are only asked for when needed, as not every model accepts `n`
+    options = {'n': n} if n > 1 else {}
+
+    # One attempt: every attempt, including retries and hedged copies, goes through the rate limiter
+    async def send():
+        queued_time = time.perf_counter()
+        await limiter.acquire(estimated_tokens)
+        start_time = time.perf_counter()
+        completion = await client.chat.completions.create(model=model_name, messages=messages, **options)
+        end_time = time.perf_counter()
+
+        # The requests run concurrently, so their spans are recorded once they end
+        tracer.record('rate_limit_wait', (start_time - queued_time) * 1000, index=key[0], repetition=key[1])
+        tracer.record('api_call', (end_time - start_time) * 1000, index=key[0], repetition=key[1], **usage_attributes(completion))
+        if completion.usage is not None:
+            limiter.reconcile(estimated_tokens, completion.usage.total_tokens)
+        return completion, (end_time - start_time) * 1000  # Convert to milliseconds
+
+    try:
+        (completion, inf_time_ms), stats = await request_layer.call_async(model_name, send)
+    except RequestFailed as e:
+        # Left out of the results so the experiment sends it again on its own
+        return key, None, None, e.stats, e.__cause__
+
+    # Persist each completion as soon as it arrives so a crash does not lose it
+    if on_result is not None:
+        on_result(key, completion, inf_time_ms)
+
+    return key, completion, inf_time_ms, stats, None
+
+async def _infer_all(model_name, prompts, request_layer, requests_per_minute, tokens_per_minute, on_result, tracer, stats,
+                     timeout_s, samples, errors):
+    # Retries are left to the request layer
+    client = AsyncOpenAI(max_retries=0, timeout=timeout_s)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    try:
+        tasks = [_infer(client, request_layer, model_name, key, messages, limiter, on_result, tracer, samples.get(key, 1))
+                 for key, messages in prompts.items()]
+        completed = await asyncio.gather(*tasks)
+    finally:
+        await client.close()
+    if stats is not None:
+        stats.update({key: call_stats for key, _, _, call_stats, _ in completed})
+    if errors is not None:
+        errors.update({key: error for key, completion, _, _, error in completed if completion is None})
+    return {key: (completion, inf_time_ms) for key, completion, inf_time_ms, _, _ in completed if completion is not None}
+
+def run_inferences(model_name, prompts, max_concurrency, requests_per_minute, tokens_per_minute, on_result=None,
+                   tracer=NullTracer(), request_layer=None, stats=None, timeout_s=60, samples=None, errors=None):
+    """
+    Runs every prompt concurrently with the async OpenAI client.
+    `prompts` maps a key such as (nlq_index, repetition) to the chat messages of the prompt.
+    Requests go through `request_layer`, which retries them and limits the requests in flight,
+    starting from `max_concurrency`, and `stats` is filled with the stats of each request.
+    A request without an answer after `timeout_s` seconds is abandoned and retried.
+    `samples` maps a key to the number of completions (`n`) to request for its prompt, 1 by default.
+    `errors` is filled with the error of each request that still failed after its retries.
+    `on_result(key, completion, inf_time_ms)` is called as each completion arrives, and the
+    rate-limit wait and call of each request are recorded as spans of `tracer`.
+    Returns a dictionary mapping each key to (completion, inference time in ms), without the
+    requests that still failed after their retries.
+    """
+    if request_layer is None:
+        request_layer = RequestLayer(max_concurrency)
+    return asyncio.run(_infer_all(model_name, prompts, request_layer, requests_per_minute, tokens_per_minute, on_result,
+                                  tracer, stats, timeout_s, samples or {}, errors))
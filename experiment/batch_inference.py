@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import hashlib
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+
+# Endpoint and completion window of every batch request
+batch_endpoint = '/v1/chat/completions'
+completion_window = '24h'
+
+# Requests accepted by the Batch API in a single input file
+max_batch_requests = 50000
+
+# Batch statuses after which the batch does not change anymore
+final_statuses = ('completed', 'failed', 'expired', 'cancelled')
+
+def make_custom_id(id_experiment, index, repetition):
+    return f"{id_experiment}:{index}:{repetition}"
+
+def parse_custom_id(custom_id):
+    """
+    Returns (experiment ID, NLQ index, repetition) from a custom_id.
+    """
+    id_experiment, index, repetition = custom_id.rsplit(':', 2)
+    return id_experiment, int(index), int(repetition)
+
+def render_batch_lines(requests):
+    """
+    Renders the JSONL lines of a batch input file from a dictionary mapping each custom_id
+    to (model name, chat messages), or to (model name, chat messages, n) to ask for n completions.
+    """
+    lines = []
+    for custom_id, (model_name, messages, *n) in requests.items():
+        body = {'model': model_name, 'messages': messages}
+        if n and n[0] > 1:
+            body['n'] = n[0]
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': batch_endpoint, 'body': body}))
+    return lines
+
+def write_batch_file(lines, batch_dir):
+    """
+    Writes a batch input file named after the hash of its content and returns its path.
+    """
+    content = '\n'.join(lines) + '\n'
+    os.makedirs(batch_dir, exist_ok=True)
+    path = os.path.join(batch_dir, f"batch_{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}.jsonl")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return path
+
+def submit_batch(client, input_path):
+    """
+    Uploads a batch input file and creates its batch. The batch ID is stored next to the input file,
+    so running the same requests again waits for this batch instead of paying for a new one.
+    """
+    state_path = input_path[:-len('.jsonl')] + '.json'
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            batch = client.batches.retrieve(json.load(f)['batch_id'])
+        if batch.status not in ('failed', 'expired', 'cancelled'):
+            return batch
+
+    with open(input_path, 'rb') as f:
+        batch_file = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint=batch_endpoint, completion_window=completion_window)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({'batch_id': batch.id, 'input_file_id': batch_file.id}, f)
+    return batch
+
+def wait_for_batch(client, batch_id, poll_interval_s=30, show_progress=True):
+    """
+    Polls a batch until it reaches a final status and returns it.
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in final_statuses:
+            return batch
+        if show_progress and batch.request_counts is not None:
+            counts = batch.request_counts
+            print(f"\rBatch {batch_id} {batch.status}: {counts.completed + counts.failed}/{counts.total} requests...", end='', flush=True)
+        time.sleep(poll_interval_s)
+
+def read_batch_results(client, batch):
+    """
+    Returns the completions of a finished batch keyed by custom_id,
+    and the error message of each request that failed.
+    """
+    completions = {}
+    failures = {}
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                completions[record['custom_id']] = ChatCompletion.model_validate(response['body'])
+            else:
+                failures[record['custom_id']] = json.dumps(record.get('error') or response.get('body'))
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            failures[record['custom_id']] = json.dumps(record.get('error') or (record.get('response') or {}).get('body'))
+    return completions, failures
+
+def run_batch(requests, batch_dir, poll_interval_s=30, show_progress=True):
+    """
+    Runs a dictionary mapping each custom_id to (model name, chat messages[, n]) with the Batch API,
+    split in input files of at most `max_batch_requests` requests.
+    Returns the completions keyed by custom_id as (completion, turnaround of its batch in ms)
+    and the error message of each failed request.
+    """
+    client = OpenAI()
+    lines = render_batch_lines(requests)
+    batches = [submit_batch(client, write_batch_file(lines[start:start + max_batch_requests], batch_dir))
+               for start in range(0, len(lines), max_batch_requests)]
+
+    completions = {}
+    failures = {}
+    for batch in batches:
+        batch = wait_for_batch(client, batch.id, poll_interval_s, show_progress)
+        if show_progress:
+            print(f"\rBatch {batch.id} {batch.status}")
+
+        # There is no latency per request, the batch turnaround is recorded instead
+        turnaround_ms = ((batch.completed_at or time.time()) - batch.created_at) * 1000
+        batch_completions, batch_failures = read_batch_results(client, batch)
+        completions.update({custom_id: (completion, turnaround_ms) for custom_id, completion in batch_completions.items()})
+        failures.update(batch_failures)
+
+    # Requests of a failed, expired or cancelled batch without a result
+    for custom_id in requests:
+        if custom_id not in completions and custom_id not in failures:
+            failures[custom_id] = "No result in the batch output."
+
+    return completions, failures
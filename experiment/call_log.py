@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+from experiment.prompt_assembly import prompt_text
+from experiment.tracing import usage_attributes
+from experiment.journal import drop_partial_line
+
+# Records kept in memory before they are appended to the file
+buffer_size = 64
+
+def prompt_hash(messages):
+    """
+    Returns a short hash identifying the rendered prompt, stored instead of the prompt itself.
+    """
+    return hashlib.sha256(prompt_text(messages).encode('utf-8')).hexdigest()[:16]
+
+def call_record(index, repetition, model_name, messages, completion, inf_time_ms):
+    """
+    Returns the fields of a completion read from the response object: ID, model, creation time,
+    finish reason, content and token counts, with the NLQ, repetition, prompt hash and inference time.
+    """
+    choice = completion.choices[0]
+    return {
+        'index': index,
+        'repetition': repetition,
+        'requested_model': model_name,
+        'prompt_hash': prompt_hash(messages),
+        'prompt_chars': sum(len(message['content']) for message in messages),
+        'id': completion.id,
+        'model': completion.model,
+        'created': completion.created,
+        'system_fingerprint': getattr(completion, 'system_fingerprint', None),
+        'finish_reason': choice.finish_reason,
+        'content': choice.message.content,
+        'inf_time_ms': inf_time_ms,
+        **usage_attributes(completion)
+    }
+
+def format_call(record):
+    # Readable form of a logged call, for the experiment log
+    lines = ["ChatCompletion Response", f"ID: {record['id']}", f"Model: {record['model']}", f"Created: {record['created']}",
+             f"Prompt hash: {record['prompt_hash']}", "Choices:", "  Content:", str(record['content']), "Usage:"]
+    if record.get('total_tokens') is not None:
+        lines += [f"  Completion Tokens: {record['completion_tokens']}", f"  Prompt Tokens: {record['prompt_tokens']}",
+                  f"  Total Tokens: {record['total_tokens']}"]
+    return "\n".join(lines)
+
+class CallLog:
+    """
+    Append-only JSONL log with one record per completion. Records are buffered and appended
+    `buffer_size` at a time, so the cost of logging a call does not depend on the size of the log.
+    The journal remains the durable record of the results: a crash loses at most the
+    buffered calls of the log.
+    """
+    def __init__(self, path, resume=False):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.calls = 0
+        self.last_record = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        if resume:
+            drop_partial_line(path)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._buffer.append(line)
+            self.calls += 1
+            self.last_record = record
+            if len(self._buffer) >= buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._file.flush()
+            self._buffer = []
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+def iter_call_log(path):
+    """
+    Yields the records of a call log, skipping a last line left incomplete by a crash.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def read_call_log(path, columns=None):
+    """
+    Returns the records of a call log as a DataFrame, with only `columns` when given.
+    """
+    records = iter_call_log(path)
+    if columns is not None:
+        records = ({column: record.get(column) for column in columns} for record in records)
+    return pd.DataFrame(list(records))
@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Rows read or converted at a time
+batch_size = 1024
+
+def normalize_sql(sql_values):
+    """
+    Returns the SQL queries on a single line, without consecutive spaces.
+    """
+    return sql_values.str.split().str.join(' ')
+
+def _excel_batches(path):
+    # Streams the rows of the first sheet without loading the whole workbook
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(name) for name in next(rows)]
+        batch = []
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield pd.DataFrame.from_records(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame.from_records(batch, columns=header)
+    finally:
+        workbook.close()
+
+def _source_batches(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        return _excel_batches(path)
+    if extension == '.csv':
+        return pd.read_csv(path, chunksize=batch_size)
+    if extension in ('.jsonl', '.ndjson'):
+        return pd.read_json(path, lines=True, chunksize=batch_size)
+    raise ValueError(f"Unsupported dataset format: {path}")
+
+# Text columns are stored as strings, whatever their values look like
+text_columns = ('nlq', 'sql')
+
+def _column_type(values):
+    try:
+        return pa.Array.from_pandas(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Values of several types in one batch
+        return pa.string()
+
+def _unify_types(types):
+    # Integers and floats promote to floats, columns missing in a batch to the type of the others,
+    # and columns whose types cannot be unified are stored as strings
+    try:
+        return pa.unify_schemas([pa.schema([('value', value_type)]) for value_type in types],
+                                promote_options='permissive').field('value').type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.string()
+
+def _dataset_schema(batches):
+    """
+    Returns one schema for every batch of a source: the types each column has in the batches, unified.
+    """
+    types = {}
+    for batch in batches:
+        for column in batch.columns:
+            types.setdefault(column, []).append(pa.string() if column in text_columns else _column_type(batch[column]))
+    fields = []
+    for column, column_types in types.items():
+        column_type = _unify_types(column_types)
+        fields.append(pa.field(column, pa.string() if pa.types.is_null(column_type) else column_type))
+    return pa.schema(fields)
+
+def _to_table(batch, schema):
+    # Columns stored as strings keep the text of each value, and missing values stay null
+    for field in schema:
+        if field.name not in batch:
+            batch[field.name] = None
+        elif pa.types.is_string(field.type) and batch[field.name].dtype != 'string':
+            batch[field.name] = [None if pd.isna(value) else str(value) for value in batch[field.name]]
+    return pa.Table.from_pandas(batch[schema.names], schema=schema, preserve_index=False)
+
+class DatasetLoader:
+    """
+    Reads a dataset of NLQs and expected SQL queries stored as Excel, CSV, JSONL or Parquet.
+    Other formats are converted once to a Parquet copy in `cache_path`, keyed on the path, size and
+    modification time of the source, and rows are then streamed from Parquet in batches.
+    """
+    def __init__(self, path, cache_path='cache/'):
+        self.path = path
+        self.cache_path = cache_path
+
+    def parquet_path(self):
+        if self.path.lower().endswith('.parquet'):
+            return self.path
+        stat = os.stat(self.path)
+        key = json.dumps([os.path.abspath(self.path), stat.st_size, stat.st_mtime_ns])
+        return os.path.join(self.cache_path, f"dataset_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.parquet")
+
+    def _convert(self, parquet_path):
+        # The source is streamed twice: once to find the type of each column over all its rows, then to write them
+        schema = _dataset_schema(_source_batches(self.path))
+        if not schema.names:
+            raise ValueError(f"Empty dataset: {self.path}")
+
+        # Write to a temporary file first so an interrupted conversion is not taken as the copy
+        os.makedirs(self.cache_path, exist_ok=True)
+        temporary_path = parquet_path + '.tmp'
+        try:
+            with pq.ParquetWriter(temporary_path, schema) as writer:
+                for batch in _source_batches(self.path):
+                    writer.write_table(_to_table(batch, schema))
+            os.replace(temporary_path, parquet_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _parquet_file(self):
+        parquet_path = self.parquet_path()
+        if not os.path.exists(parquet_path):
+            self._convert(parquet_path)
+        return pq.ParquetFile(parquet_path)
+
+    def __len__(self):
+        return self._parquet_file().metadata.num_rows
+
+    def iter_batches(self, start=0, stop=None, shard=0, num_shards=1, columns=None):
+        """
+        Yields DataFrames with the rows from `start` to `stop` (by position in the dataset)
+        that belong to `shard` out of `num_shards`, indexed by their position.
+        A row belongs to the shard given by its position modulo `num_shards`.
+        """
+        if not 0 <= shard < num_shards:
+            raise ValueError(f"Shard {shard} out of range for {num_shards} shards")
+        position = 0
+        for record_batch in self._parquet_file().iter_batches(batch_size=batch_size, columns=columns):
+            if stop is not None and position >= stop:
+                return
+            batch = record_batch.to_pandas()
+            batch.index = pd.RangeIndex(position, position + len(batch))
+            position += len(batch)
+
+            selected = (batch.index >= start) & (batch.index % num_shards == shard)
+            if stop is not None:
+                selected &= batch.index < stop
+            if selected.any():
+                yield batch[selected]
+
+    def iter_rows(self, start=0, stop=None, shard=0, num_shards=1):
+        """
+        Yields (position, nlq, sql) for each selected row, reading the dataset lazily.
+        """
+        for batch in self.iter_batches(start, stop, shard, num_shards, ['nlq', 'sql']):
+            yield from zip(batch.index, batch['nlq'], batch['sql'])
+
+    def load(self, start=0, stop=None, shard=0, num_shards=1):
+        """
+        Returns the selected rows as a DataFrame indexed by their position in the dataset.
+        """
+        batches = list(self.iter_batches(start, stop, shard, num_shards))
+        if not batches:
+            return pd.DataFrame(columns=pq.read_schema(self.parquet_path()).names)
+        return pd.concat(batches)
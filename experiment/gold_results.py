@@ -0,0 +1,51 @@
+import os
+import json
+import hashlib
+import statistics
+from experiment.journal import encode_value, decode_value
+
+def file_hash(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def dataset_hash(sql_values):
+    return hashlib.sha256(json.dumps(list(sql_values)).encode('utf-8')).hexdigest()
+
+def gold_results_path(cache_path, sql_values, database_path):
+    return os.path.join(cache_path, f"gold_{dataset_hash(sql_values)[:16]}_{file_hash(database_path)[:16]}.json")
+
+def compute_gold_results(sql_values, execute_query, warm_runs):
+    """
+    Executes each expected query once to get its result and then `warm_runs` more times,
+    keeping the median of the warm execution times.
+    """
+    gold_results = []
+    for sql in sql_values:
+        exp_result, exp_error, exp_time = execute_query(sql)
+        warm_times = [execute_query(sql)[2] for _ in range(warm_runs)]
+        gold_results.append([exp_result, exp_error, statistics.median(warm_times) if warm_times else exp_time])
+    return gold_results
+
+def load_gold_results(sql_values, database_path, cache_path, execute_query, warm_runs=5):
+    """
+    Returns a list of (exp_response, exp_error, exp_time_ms) for each expected query.
+    The results are stored per (dataset hash, database file hash) and only computed
+    when the dataset or the database changes.
+    """
+    path = gold_results_path(cache_path, sql_values, database_path)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [tuple(entry) for entry in json.load(f, object_hook=decode_value)]
+
+    gold_results = compute_gold_results(sql_values, execute_query, warm_runs)
+
+    os.makedirs(cache_path, exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(gold_results, f, default=encode_value)
+    os.replace(temporary_path, path)
+
+    return [tuple(entry) for entry in gold_results]
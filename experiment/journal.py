@@ -0,0 +1,119 @@
+import os
+import json
+import base64
+import decimal
+import datetime
+import pandas as pd
+from analysis.fingerprint import fingerprint_fields
+
+# Columns recorded for each repetition, suffixed with the repetition number in the results table
+repetition_columns = ['inf_sql', 'inf_response', 'inf_error', 'inf_time_ms', 'inf_exec_time_ms',
+                      'inf_prompt_tokens', 'inf_cached_tokens', 'inf_attempts', 'inf_backoff_ms', 'inf_hedged',
+                      'inf_api_error'] + [f'inf_{field}' for field in fingerprint_fields]
+
+# Values of result sets without a JSON type, stored as {'__type__': <name>, 'value': <text>} objects
+typed_values = {
+    bytes: ('bytes', lambda value: base64.b64encode(value).decode('ascii'), base64.b64decode),
+    decimal.Decimal: ('decimal', str, decimal.Decimal),
+    datetime.datetime: ('datetime', datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    datetime.date: ('date', datetime.date.isoformat, datetime.date.fromisoformat),
+    datetime.time: ('time', datetime.time.isoformat, datetime.time.fromisoformat)
+}
+decoders = {name: decode for name, _, decode in typed_values.values()}
+
+def encode_value(value):
+    """
+    JSON `default` hook keeping the type of the values of result sets that JSON cannot hold,
+    such as blobs, so they are read back unchanged by `decode_value`. Other values become strings.
+    """
+    if type(value) in typed_values:
+        name, encode, _ = typed_values[type(value)]
+        return {'__type__': name, 'value': encode(value)}
+    return str(value)
+
+def decode_value(obj):
+    # JSON `object_hook` reading back the values written by encode_value
+    if len(obj) == 2 and obj.get('__type__') in decoders and 'value' in obj:
+        return decoders[obj['__type__']](obj['value'])
+    return obj
+
+def read_journal(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line, object_hook=decode_value)
+            except json.JSONDecodeError:
+                # Skip a line truncated by a crash while it was being written
+                continue
+
+def drop_partial_line(path):
+    """
+    Truncates a last line left incomplete by a crash, so records appended to a JSONL file start on a fresh line.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+
+def journal_completed(path):
+    """
+    Returns the set of (nlq_index, repetition) pairs in the journal at `path`, without opening it for writing.
+    """
+    return {(record['index'], record['repetition']) for record in read_journal(path)}
+
+class ResultJournal:
+    """
+    Append-only JSONL journal of experiment results.
+    Each line holds either the expected results of an NLQ (repetition 0)
+    or the inferred results of one repetition, so an interrupted run can be resumed.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        drop_partial_line(path)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def read(self):
+        return read_journal(self.path)
+
+    def completed(self):
+        """
+        Returns the set of (nlq_index, repetition) pairs already in the journal.
+        """
+        return journal_completed(self.path)
+
+    def write_expected(self, index, entry):
+        self._write({'index': index, 'repetition': 0, **entry})
+
+    def write_repetition(self, index, repetition, entry):
+        self._write({'index': index, 'repetition': repetition, **entry})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, default=encode_value) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def to_dataframe(self):
+        """
+        Builds the wide results table with one row per NLQ and the
+        inf_*_<repetition> columns, keeping the last record of each pair.
+        """
+        records = {(record['index'], record['repetition']): record for record in self.read()}
+
+        entries = {}
+        for (index, repetition), record in sorted(records.items()):
+            entry = entries.setdefault(index, {})
+            values = {key: value for key, value in record.items() if key not in ('index', 'repetition')}
+            if repetition == 0:
+                entry.update(values)
+            else:
+                entry.update({f'{column}_{repetition}': values.get(column) for column in repetition_columns})
+
+        return pd.DataFrame([entries[index] for index in sorted(entries)])
@@ -0,0 +1,80 @@
+import re
+import json
+
+# Heading of the input question section, where the per-NLQ part of a template starts
+input_question_heading = re.compile(r'^(?:### )?Input question:?[ \t]*$', re.IGNORECASE | re.MULTILINE)
+
+def split_template(template):
+    """
+    Splits a prompt template into a static prefix (instructions, schema, table info and examples)
+    and a per-NLQ suffix starting at the input question heading.
+    """
+    nlq_position = template.index('{nlq}')
+    headings = [match for match in input_question_heading.finditer(template, 0, nlq_position)]
+    if headings:
+        split_position = headings[-1].start()
+    else:
+        # Without a heading, split at the last paragraph before the NLQ
+        split_position = template.rfind('\n\n', 0, nlq_position) + 2
+    return template[:split_position], template[split_position:]
+
+class PromptAssembler:
+    """
+    Renders the prompts of an experiment. The static prefix is rendered once,
+    and each NLQ only renders the small suffix.
+    With the 'single' layout the prompt is one user message, identical to formatting the whole template.
+    With the 'split' layout the prefix is sent as a system message and the suffix as the user message,
+    so every request starts with the same messages and benefits from provider prompt caching.
+    `nlq_context(nlq)` optionally returns values that replace the context for a given NLQ,
+    such as the schema of its relevant tables, in which case the prefix is rendered for that NLQ.
+    """
+    def __init__(self, template, layout='single', nlq_context=None, **context):
+        if layout not in ('single', 'split'):
+            raise ValueError(f"Unknown prompt layout: {layout}")
+        self.layout = layout
+        self.context = context
+        self.nlq_context = nlq_context
+        self.prefix_template, self.suffix_template = split_template(template)
+        self.prefix = self.prefix_template.format(**context)
+
+    def render(self, nlq, use_nlq_context=True):
+        """
+        Returns the chat messages for an NLQ.
+        """
+        context = self.context
+        prefix = self.prefix
+        if self.nlq_context is not None and use_nlq_context:
+            context = {**self.context, **self.nlq_context(nlq)}
+            prefix = self.prefix_template.format(**context)
+
+        suffix = self.suffix_template.format(nlq=nlq, **context)
+        if self.layout == 'split':
+            return [{"role": "system", "content": prefix.rstrip()}, {"role": "user", "content": suffix}]
+        return [{"role": "user", "content": prefix + suffix}]
+
+def prompt_text(messages):
+    """
+    Returns the text identifying a prompt: the content of a single user message,
+    or the JSON of the messages for the split layout.
+    """
+    if len(messages) == 1:
+        return messages[0]['content']
+    return json.dumps(messages)
+
+def prompt_tokens_estimate(messages):
+    # About four characters per token for English text and SQL
+    return sum(len(message['content']) for message in messages) // 4
+
+def usage_tokens(completion):
+    """
+    Returns the prompt tokens and the cached prompt tokens reported in the usage of a completion.
+    """
+    usage = getattr(completion, 'usage', None)
+    if usage is None:
+        return None, None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        cached_tokens = details.get('cached_tokens')
+    else:
+        cached_tokens = getattr(details, 'cached_tokens', None)
+    return usage.prompt_tokens, cached_tokens or 0
@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+    The bucket holds at most one minute worth of tokens.
+    """
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Returns the seconds to wait until `amount` tokens are available.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        # The balance may go negative when actual usage exceeds the estimate
+        self.tokens -= amount
+
+class RateLimiter:
+    """
+    Asyncio limiter combining a requests/min and a tokens/min bucket.
+    Waiters are served in arrival order.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens):
+        async with self._lock:
+            while True:
+                delay = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.consume(1)
+            self.tokens.consume(min(estimated_tokens, self.tokens.capacity))
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        # Correct the token balance with the usage reported by the API
+        self.tokens.consume(actual_tokens - min(estimated_tokens, self.tokens.capacity))
@@ -0,0 +1,417 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import openai
+
+# Status codes worth retrying: request timeout, conflict, rate limit and server errors
+retryable_status_codes = {408, 409, 429, 500, 502, 503, 504}
+
+# Seconds a call waits before retrying while another call probes a half-open circuit
+half_open_wait_s = 1.0
+
+class CircuitOpenError(Exception):
+    def __init__(self, model_name, remaining_s):
+        super().__init__(f"Circuit open for {model_name}, retry in {remaining_s:.1f} s")
+        self.remaining_s = remaining_s
+
+class RequestFailed(Exception):
+    """
+    Raised when a request still fails after every retry, or fails with an API error that
+    cannot be retried such as a bad request, with the stats of its attempts.
+    """
+    def __init__(self, error, stats):
+        super().__init__(f"{type(error).__name__}: {error}")
+        self.stats = stats
+
+def new_call_stats():
+    # Stats of a request: attempts sent, seconds of backoff (in ms), answered by a hedged copy, last error
+    return {'attempts': 0, 'backoff_ms': 0.0, 'hedged': False, 'api_error': None}
+
+def combine_call_stats(earlier, later):
+    """
+    Returns the stats of a request sent again after `earlier` attempts failed, such as
+    an inference the async engine gave up on and the experiment sent on its own.
+    """
+    if earlier is None:
+        return later
+    return {'attempts': earlier['attempts'] + later['attempts'], 'backoff_ms': earlier['backoff_ms'] + later['backoff_ms'],
+            'hedged': earlier['hedged'] or later['hedged'], 'api_error': later['api_error']}
+
+def is_retryable(error):
+    if isinstance(error, (CircuitOpenError, openai.APIConnectionError)):
+        # APITimeoutError is an APIConnectionError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in retryable_status_codes or error.status_code >= 500
+    return False
+
+def is_rate_limit(error):
+    return isinstance(error, openai.APIStatusError) and error.status_code == 429
+
+def retry_after_s(error):
+    """
+    Returns the wait in seconds asked by the Retry-After or retry-after-ms header of an error response, if any.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # Retry-After can also be an HTTP date, an invalid retry-after-ms has no fallback
+        try:
+            return max(0.0, parsedate_to_datetime(headers['retry-after']).timestamp() - time.time())
+        except (KeyError, TypeError, ValueError):
+            return None
+    return None
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time up to
+    `base_delay_s` * 2^n, capped at `max_delay_s`. A Retry-After header from the server
+    is followed instead, with a little jitter so waiting requests do not all come back at once.
+    """
+    def __init__(self, max_retries=5, base_delay_s=0.5, max_delay_s=30.0, max_retry_after_s=120.0):
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.max_retry_after_s = max_retry_after_s
+
+    def delay_s(self, retry, error):
+        jitter = random.uniform(0, self.base_delay_s)
+        if isinstance(error, CircuitOpenError):
+            return error.remaining_s + jitter
+        wait_s = retry_after_s(error)
+        if wait_s is not None:
+            return min(wait_s, self.max_retry_after_s) + jitter
+        return random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** retry))
+
+class CircuitBreaker:
+    """
+    Stops calling a model after `failure_threshold` consecutive failures (server errors,
+    timeouts and connection errors). After `reset_timeout_s` a single probe call is let
+    through: its success closes the circuit and its failure opens it again.
+    """
+    def __init__(self, model_name, failure_threshold=5, reset_timeout_s=30.0):
+        self.model_name = model_name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'open':
+                remaining_s = self.opened_at + self.reset_timeout_s - time.monotonic()
+                if remaining_s > 0:
+                    raise CircuitOpenError(self.model_name, remaining_s)
+                self.state = 'half_open'
+                return
+            if self.state == 'half_open':
+                # Only the probe call goes through until it ends
+                raise CircuitOpenError(self.model_name, half_open_wait_s)
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class AdaptiveConcurrency:
+    """
+    Limit on the requests in flight to a model, adapted to the rate limits observed:
+    each success raises the limit by 1 / limit (about one more request per full window)
+    and a 429 multiplies it by `decrease_factor`, at most once per `cooldown_s`.
+    Threads wait on a condition and coroutines on a future of their event loop, both woken by `release`.
+    """
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, cooldown_s=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown_s = cooldown_s
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # (event loop, future) of each coroutine waiting for room, in arrival order
+        self._async_waiters = deque()
+
+    def _has_room(self):
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    def try_acquire(self):
+        with self._condition:
+            if not self._has_room():
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self._condition:
+            while not self._has_room():
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        first_wait = True
+        while True:
+            with self._condition:
+                if self._has_room():
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                # A coroutine woken without room, as a thread took it first, keeps its place in the queue
+                if first_wait:
+                    self._async_waiters.append((loop, waiter))
+                else:
+                    self._async_waiters.appendleft((loop, waiter))
+            first_wait = False
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    else:
+                        # It was woken for a free slot, which goes to the next coroutine instead
+                        self._wake_async_waiters()
+                raise
+
+    def _wake_async_waiters(self):
+        # Wakes as many waiting coroutines as there are free slots, called with the condition held
+        room = max(self.min_limit, int(self.limit)) - self.in_flight
+        while room > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_wake, waiter)
+            room -= 1
+
+    def release(self, error=None):
+        with self._condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if is_rate_limit(error):
+                self.rate_limited += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown_s:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif error is None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+    def rate_limited_share(self):
+        return self.rate_limited / self.requests if self.requests else 0.0
+
+class HedgePolicy:
+    """
+    Delay after which a second copy of a slow request is sent: the `quantile` of the
+    latencies of the last `window` successful requests, once `min_samples` are known.
+    """
+    def __init__(self, quantile=0.95, window=200, min_samples=20):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, latency_s):
+        with self._lock:
+            self._latencies.append(latency_s)
+
+    def delay_s(self):
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return float(np.quantile(self._latencies, self.quantile))
+
+class RequestLayer:
+    """
+    Sends requests to the API with retries, a circuit breaker, an adaptive concurrency
+    limit and latency statistics kept for each model, and optionally hedges slow requests.
+    `call` and `call_async` return the result and the stats of the request: the number
+    of attempts, the time spent in backoff and whether a hedged copy answered.
+    """
+    def __init__(self, max_concurrency=8, retry_policy=None, hedge=False, failure_threshold=5, reset_timeout_s=30.0):
+        self.max_concurrency = max_concurrency
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge = hedge
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._models = {}
+        self._lock = threading.Lock()
+        self._hedge_pool = None
+
+    def model_state(self, model_name):
+        """
+        Returns the circuit breaker, concurrency limit and hedge policy of a model.
+        """
+        with self._lock:
+            if model_name not in self._models:
+                self._models[model_name] = (CircuitBreaker(model_name, self.failure_threshold, self.reset_timeout_s),
+                                            AdaptiveConcurrency(self.max_concurrency), HedgePolicy())
+            return self._models[model_name]
+
+    def _after_error(self, model_name, error, retry, stats):
+        # Returns the backoff before the next attempt, or raises RequestFailed when the request cannot be retried
+        breaker = self.model_state(model_name)[0]
+        circuit_open = isinstance(error, CircuitOpenError)
+        if not is_retryable(error) or is_rate_limit(error):
+            # The server answered, so it is up even if the request cannot be retried or was rate limited
+            breaker.record_success()
+        elif not circuit_open:
+            breaker.record_failure()
+        if not is_retryable(error) and not isinstance(error, openai.APIError):
+            # Not an error of the API, such as a bug in `create`
+            raise error
+        # Waiting for an open circuit sends nothing, so it does not use up a retry
+        if not is_retryable(error) or (not circuit_open and retry >= self.retry_policy.max_retries):
+            stats['api_error'] = f"{type(error).__name__}: {error}"
+            raise RequestFailed(error, stats) from error
+        delay_s = self.retry_policy.delay_s(retry, error)
+        stats['backoff_ms'] += delay_s * 1000
+        return delay_s
+
+    def _after_success(self, model_name, latency_s):
+        breaker, _, hedge_policy = self.model_state(model_name)
+        breaker.record_success()
+        hedge_policy.observe(latency_s)
+
+    def call(self, model_name, create):
+        """
+        Calls `create()`, which sends one request, until it succeeds or runs out of retries.
+        """
+        breaker, concurrency, hedge_policy = self.model_state(model_name)
+        stats = new_call_stats()
+        retry = 0
+        while True:
+            try:
+                breaker.before_call()
+                concurrency.acquire()
+                error = None
+                try:
+                    stats['attempts'] += 1
+                    start_time = time.perf_counter()
+                    result, hedged = self._send(create, hedge_policy.delay_s() if self.hedge else None)
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    concurrency.release(error)
+                self._after_success(model_name, time.perf_counter() - start_time)
+                stats['hedged'] = hedged
+                return result, stats
+            except Exception as e:
+                delay_s = self._after_error(model_name, e, retry, stats)
+                if not isinstance(e, CircuitOpenError):
+                    retry += 1
+                time.sleep(delay_s)
+
+    def _send(self, create, hedge_delay_s):
+        if hedge_delay_s is None:
+            return create(), False
+        if self._hedge_pool is None:
+            with self._lock:
+                if self._hedge_pool is None:
+                    self._hedge_pool = ThreadPoolExecutor(max_workers=2 * self.max_concurrency)
+        primary = self._hedge_pool.submit(create)
+        done, _ = wait([primary], timeout=hedge_delay_s)
+        if done:
+            return primary.result(), False
+
+        # The request is slower than usual, the first copy to succeed answers it
+        pending = {primary, self._hedge_pool.submit(create)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), future is not primary
+                error = future.exception()
+        raise error
+
+    async def call_async(self, model_name, create):
+        """
+        Awaits `create()`, which sends one request, until it succeeds or runs out of retries.
+        """
+        breaker, concurrency, hedge_policy = self.model_state(model_name)
+        stats = new_call_stats()
+        retry = 0
+        while True:
+            try:
+                breaker.before_call()
+                await concurrency.acquire_async()
+                error = None
+                try:
+                    stats['attempts'] += 1
+                    start_time = time.perf_counter()
+                    result, hedged = await self._send_async(create, hedge_policy.delay_s() if self.hedge else None)
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    concurrency.release(error)
+                self._after_success(model_name, time.perf_counter() - start_time)
+                stats['hedged'] = hedged
+                return result, stats
+            except Exception as e:
+                delay_s = self._after_error(model_name, e, retry, stats)
+                if not isinstance(e, CircuitOpenError):
+                    retry += 1
+                await asyncio.sleep(delay_s)
+
+    async def _send_async(self, create, hedge_delay_s):
+        if hedge_delay_s is None:
+            return await create(), False
+        primary = asyncio.ensure_future(create())
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay_s)
+        if done:
+            return primary.result(), False
+
+        # The request is slower than usual, the first copy to succeed answers it and the other is cancelled
+        pending = {primary, asyncio.ensure_future(create())}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result(), task is not primary
+                error = task.exception()
+        raise error
+
+    def format_stats(self):
+        lines = []
+        for model_name, (breaker, concurrency, hedge_policy) in sorted(self._models.items()):
+            lines.append(f"Requests to {model_name}: {concurrency.requests}, "
+                         f"rate limited {round(concurrency.rate_limited_share() * 100, 2)}%, "
+                         f"concurrency limit {concurrency.limit:.1f}, circuit {breaker.state} "
+                         f"(opened {breaker.times_opened} times)")
+        return "\n".join(lines)
@@ -0,0 +1,40 @@
+import threading
+
+class LazyResources:
+    """
+    Mapping of shared resources, such as the API client, the database engine or the dataset,
+    each one built by its factory on first access and kept for the following ones.
+    Factories receive the resources so they can use the ones they depend on.
+    """
+    def __init__(self, **factories):
+        self._factories = factories
+        self._values = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            # Only one thread builds a resource, the others wait for it
+            with self._lock:
+                if name not in self._values:
+                    self._values[name] = self._factories[name](self)
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._factories
+
+    def keys(self):
+        return self._factories.keys()
+
+    def built(self):
+        """
+        Returns the names of the resources built so far.
+        """
+        return list(self._values)
+
+    def reset(self, *names):
+        """
+        Drops the given resources, or all of them, so they are built again on their next access.
+        """
+        with self._lock:
+            for name in names or list(self._values):
+                self._values.pop(name, None)
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from openai.types.chat import ChatCompletion
+
+class ResponseCache:
+    """
+    Persistent cache of chat completions stored in a SQLite file.
+    Entries are keyed by a hash of the model, the completed prompt and the repetition,
+    and the least recently used ones are evicted once the cache exceeds `max_bytes`.
+    """
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, inf_time_ms REAL NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+
+        # Size of the cache, read once and kept up to date by put and the evictions
+        self._total_bytes = self._size()
+
+    @staticmethod
+    def make_key(model_name, prompt_completed, repetition):
+        content = json.dumps([model_name, prompt_completed, repetition])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, model_name, prompt_completed, repetition):
+        """
+        Returns (completion, inference time in ms) or None if the response is not cached.
+        """
+        key = self.make_key(model_name, prompt_completed, repetition)
+        with self._lock:
+            row = self._connection.execute("SELECT value, inf_time_ms FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+        return ChatCompletion.model_validate_json(row[0]), row[1]
+
+    def put(self, model_name, prompt_completed, repetition, completion, inf_time_ms):
+        key = self.make_key(model_name, prompt_completed, repetition)
+        value = completion.model_dump_json()
+        with self._lock:
+            # A replaced entry no longer counts towards the size of the cache
+            replaced = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, inf_time_ms, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, inf_time_ms, len(value), time.time())
+            )
+            self._total_bytes += len(value) - (replaced[0] if replaced is not None else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._connection.commit()
+
+    def _size(self):
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        # Other processes sharing the file may have added entries, so the size is read again before evicting
+        self._total_bytes = self._size()
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        with self._lock:
+            entries, total_bytes = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': total_bytes}
+
+    def format_stats(self):
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = round(stats['hits'] / lookups * 100, 2) if lookups else 0.0
+        return (f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate}% hit rate), "
+                f"{stats['entries']} entries, {stats['bytes']} bytes")
@@ -0,0 +1,190 @@
+import os
+import re
+import ast
+import json
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from analysis.fingerprint import fingerprint_fields, add_result_fingerprints
+
+# Findings read at a time by iter_findings
+findings_batch_size = 1000
+
+# Columns holding result sets, stored in the result-set table instead of the findings table
+def response_columns(num_repetitions):
+    return ['exp_response'] + [f'inf_response_{i}' for i in range(1, num_repetitions + 1)]
+
+def findings_paths(output_path, experiment_name):
+    """
+    Returns the paths of the findings table and of the result-set table of an experiment.
+    """
+    prefix = os.path.join(output_path, experiment_name)
+    return prefix + '_res.parquet', prefix + '_resultsets.parquet'
+
+def findings_signature(output_path, experiment_name):
+    """
+    Returns a hash of the path, size and modification time of the findings files of an experiment,
+    which changes whenever the findings are written again.
+    """
+    paths = list(findings_paths(output_path, experiment_name)) + [os.path.join(output_path, experiment_name + '_res.xlsx')]
+    parts = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def encode_result(result):
+    """
+    Encodes a result set (list of rows) as an Arrow IPC stream, keeping the type of each column.
+    Columns whose values do not share a type are stored as JSON-encoded strings.
+    """
+    num_columns = len(result[0]) if result else 0
+    arrays = []
+    fields = []
+    for position in range(num_columns):
+        values = [row[position] for row in result]
+        try:
+            array = pa.array(values)
+            metadata = None
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = pa.array([json.dumps(value, default=str) for value in values], type=pa.string())
+            metadata = {'encoding': 'json'}
+        arrays.append(array)
+        fields.append(pa.field(f'c{position}', array.type, metadata=metadata))
+    table = pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def decode_result(data):
+    table = pa.ipc.open_stream(data).read_all()
+    columns = []
+    for field, column in zip(table.schema, table.columns):
+        values = column.to_pylist()
+        if field.metadata and field.metadata.get(b'encoding') == b'json':
+            values = [json.loads(value) for value in values]
+        columns.append(values)
+    return [list(row) for row in zip(*columns)]
+
+def normalize_error(error):
+    # Errors are either "No error." or the first lines of the exception message
+    if isinstance(error, list):
+        return '\n'.join(str(line) for line in error)
+    return str(error)
+
+def write_findings(summary_table, output_path, experiment_name, num_repetitions, store_result_sets=True):
+    """
+    Writes the findings of an experiment as Parquet: one row per NLQ without the result sets,
+    and a result-set table keyed by (nlq_id, repetition), where repetition 0 is the expected query.
+    Without `store_result_sets` only the findings table, with the result fingerprints, is written.
+    """
+    findings_path, resultsets_path = findings_paths(output_path, experiment_name)
+    columns = response_columns(num_repetitions)
+
+    findings = summary_table.drop(columns=columns, errors='ignore').copy()
+    for column in findings.columns:
+        if column == 'exp_error' or column.startswith('inf_error_'):
+            findings[column] = findings[column].apply(normalize_error)
+    findings.insert(0, 'nlq_id', range(len(findings)))
+    findings.to_parquet(findings_path, index=False)
+
+    if not store_result_sets:
+        # Remove the result sets of a previous run so they are not mixed with these findings
+        if os.path.exists(resultsets_path):
+            os.remove(resultsets_path)
+        return findings_path
+
+    resultsets = pd.DataFrame({
+        'nlq_id': [nlq_id for nlq_id in range(len(summary_table)) for _ in columns],
+        'repetition': [repetition for _ in range(len(summary_table)) for repetition in range(len(columns))],
+        'result': [encode_result(result) for results in summary_table[columns].itertuples(index=False) for result in results]
+    })
+    pq.write_table(pa.Table.from_pandas(resultsets, preserve_index=False), resultsets_path)
+
+    return findings_path
+
+def read_resultsets(output_path, experiment_name):
+    """
+    Returns the result-set table with the decoded result of each (nlq_id, repetition).
+    """
+    resultsets = pd.read_parquet(findings_paths(output_path, experiment_name)[1])
+    resultsets['result'] = resultsets['result'].apply(decode_result)
+    return resultsets
+
+# Function to convert strings to lists of lists
+def str_to_list(s):
+    try:
+        return ast.literal_eval(s)
+    except (ValueError, SyntaxError) as e:
+        print(f"Error converting string to list: {e}")
+        return []
+
+def read_findings(output_path, experiment_name, num_repetitions):
+    """
+    Reads the findings of an experiment in the wide layout with one row per NLQ,
+    with exp_response and inf_response_<i> as lists of rows.
+    Falls back to the Excel findings written by older runs.
+    """
+    findings_path, resultsets_path = findings_paths(output_path, experiment_name)
+    columns = response_columns(num_repetitions)
+
+    if not os.path.exists(findings_path):
+        data = pd.read_excel(os.path.join(output_path, experiment_name + '_res.xlsx'))
+        for column in columns:
+            data[column] = data[column].apply(str_to_list)
+        return data
+
+    data = pd.read_parquet(findings_path)
+    if os.path.exists(resultsets_path):
+        resultsets = read_resultsets(output_path, experiment_name)
+        wide = resultsets.pivot(index='nlq_id', columns='repetition', values='result')
+        for repetition, column in enumerate(columns):
+            data[column] = data['nlq_id'].map(wide[repetition])
+    else:
+        # Findings written without result sets only have their fingerprints
+        for column in columns:
+            data[column] = [[] for _ in range(len(data))]
+
+    # Keep the column order of the Excel findings
+    ordered = ['nlq', 'exp_sql', 'exp_response', 'exp_error', 'exp_time_ms']
+    for i in range(1, num_repetitions + 1):
+        ordered += [f'inf_sql_{i}', f'inf_response_{i}', f'inf_error_{i}', f'inf_time_ms_{i}', f'inf_exec_time_ms_{i}']
+    return data[ordered + [column for column in data.columns if column not in ordered]]
+
+def findings_repetitions(output_path, experiment_name):
+    """
+    Returns the number of repetitions of the findings of an experiment, read from the names of their columns.
+    """
+    findings_path = findings_paths(output_path, experiment_name)[0]
+    if os.path.exists(findings_path):
+        columns = pq.read_schema(findings_path).names
+    else:
+        columns = pd.read_excel(os.path.join(output_path, experiment_name + '_res.xlsx'), nrows=0).columns
+    return len([column for column in columns if re.fullmatch(r'inf_sql_\d+', column)])
+
+def iter_findings(output_path, experiment_name, batch_size=findings_batch_size):
+    """
+    Yields the findings of an experiment in batches of `batch_size` NLQs in the wide layout,
+    with their result fingerprints and without the result sets. Findings with fingerprints
+    are streamed from Parquet; older findings are read at once to compute them.
+    """
+    findings_path = findings_paths(output_path, experiment_name)[0]
+    num_repetitions = findings_repetitions(output_path, experiment_name)
+    prefixes = [('exp', '')] + [('inf', f'_{i}') for i in range(1, num_repetitions + 1)]
+    fingerprints = [f'{prefix}_{field}{suffix}' for prefix, suffix in prefixes for field in fingerprint_fields]
+
+    if os.path.exists(findings_path):
+        findings_file = pq.ParquetFile(findings_path)
+        if all(column in findings_file.schema_arrow.names for column in fingerprints):
+            for batch in findings_file.iter_batches(batch_size=batch_size):
+                yield batch.to_pandas()
+            return
+
+    data = add_result_fingerprints(read_findings(output_path, experiment_name, num_repetitions), num_repetitions)
+    data = data.drop(columns=response_columns(num_repetitions))
+    for start in range(0, len(data), batch_size):
+        yield data.iloc[start:start + batch_size]
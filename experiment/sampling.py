@@ -0,0 +1,53 @@
+from experiment.resilience import new_call_stats
+
+def group_samples(prompts):
+    """
+    Groups prompts keyed by (NLQ index, repetition) into one prompt per NLQ, keyed by
+    (NLQ index, first repetition), as (chat messages, repetitions it must produce).
+    The prompt of every repetition of an NLQ is the same, so one request with `n` set
+    to the number of repetitions samples them all.
+    """
+    groups = {}
+    for (index, repetition), messages in prompts.items():
+        if index not in groups:
+            groups[index] = ((index, repetition), messages, [])
+        groups[index][2].append(repetition)
+    return {key: (messages, repetitions) for key, messages, repetitions in groups.values()}
+
+def split_choices(completion, repetitions):
+    """
+    Returns the completion of each repetition from a completion with several choices,
+    each with a single choice. The usage of the call is kept on the first repetition
+    only, so the tokens of the call are counted once. Repetitions without a choice,
+    when the model returned fewer than requested, are left out.
+    """
+    choices = sorted(completion.choices, key=lambda choice: choice.index)
+    return {
+        repetition: completion.model_copy(update={
+            'choices': [choice.model_copy(update={'index': 0})],
+            'usage': completion.usage if position == 0 else None
+        })
+        for position, (repetition, choice) in enumerate(zip(repetitions, choices))
+    }
+
+def spread_samples(results, groups):
+    """
+    Returns the (completion, inference time in ms) of each (NLQ index, repetition) from the
+    results of grouped requests. Every sample of a call gets the time of the call.
+    """
+    spread = {}
+    for key, (completion, inf_time_ms) in results.items():
+        for repetition, sample in split_choices(completion, groups[key][1]).items():
+            spread[(key[0], repetition)] = (sample, inf_time_ms)
+    return spread
+
+def spread_stats(stats, groups):
+    """
+    Returns the request stats of each (NLQ index, repetition) from those of grouped requests.
+    The requests of a call are recorded on its first repetition, the others sent none.
+    """
+    spread = {}
+    for key, call_stats in stats.items():
+        for position, repetition in enumerate(groups[key][1]):
+            spread[(key[0], repetition)] = call_stats if position == 0 else new_call_stats()
+    return spread
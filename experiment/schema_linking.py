@@ -0,0 +1,122 @@
+import re
+import math
+from collections import defaultdict
+from experiment.schema_snapshot import select_tables, format_tables, format_schema, format_table_info
+
+# Weight of a match on a table name, on the name of one of its columns and on one of its sample values
+table_name_weight = 3.0
+column_name_weight = 2.0
+sample_value_weight = 1.0
+
+# Share of the score of a table added to the tables linked to it by a foreign key
+foreign_key_share = 0.5
+
+# Words of the questions that say nothing about the tables
+stop_words = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'by', 'do', 'does', 'each', 'for', 'from', 'give', 'has', 'have',
+    'how', 'i', 'id', 'in', 'is', 'it', 'list', 'many', 'me', 'of', 'on', 'or', 'show', 'that', 'the',
+    'their', 'them', 'there', 'they', 'to', 'was', 'were', 'what', 'when', 'where', 'which', 'who', 'with'
+}
+
+def stem(word):
+    # Light suffix stripping so "categories", "released" and "rental" meet "category", "release" and "rent"
+    if len(word) > 4 and word.endswith('ies'):
+        word = word[:-3] + 'i'
+    elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    if len(word) > 3 and word.endswith('y'):
+        word = word[:-1] + 'i'
+    for suffix in ('ing', 'ed', 'al', 'e'):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text):
+    """
+    Returns the stems of the lowercase words of a text, splitting identifiers on
+    underscores and camel case.
+    """
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text))
+    words = re.findall(r'[a-z]+|\d+', text.lower())
+    return [stem(word) for word in words if word not in stop_words]
+
+class SchemaLinker:
+    """
+    Inverted index over the table names, column names and sample values of a schema snapshot.
+    For each NLQ it selects the `top_k` most relevant tables, adding the tables linked
+    by foreign keys to the matching ones so the joins between them stay possible.
+    """
+    def __init__(self, snapshot, top_k):
+        self.snapshot = snapshot
+        self.top_k = top_k
+        self.table_names = [table['name'] for table in snapshot['tables']]
+        # Position of each table in the schema, which breaks ties between equal scores
+        self.table_positions = {table_name: position for position, table_name in enumerate(self.table_names)}
+        self._contexts = {}
+
+        # Weight of each token for each table, keeping the strongest kind of match
+        postings = defaultdict(dict)
+        for table in snapshot['tables']:
+            sources = [(table['name'], table_name_weight)]
+            sources += [(column, column_name_weight) for column in table['columns']]
+            sources += [(value, sample_value_weight) for row in table['rows'] for value in row]
+            for text, weight in sources:
+                for token in tokenize(text):
+                    if not token.isdigit():
+                        postings[token][table['name']] = max(postings[token].get(table['name'], 0.0), weight)
+
+        # Tokens found in few tables are more informative than those found everywhere
+        num_tables = len(self.table_names)
+        self.index = {
+            token: {table_name: weight * math.log(1 + num_tables / len(tables)) for table_name, weight in tables.items()}
+            for token, tables in postings.items()
+        }
+
+        # Foreign keys link tables in both directions
+        self.neighbors = {table_name: set() for table_name in self.table_names}
+        for table in snapshot['tables']:
+            for referenced in table.get('foreign_keys', []):
+                if referenced in self.neighbors and referenced != table['name']:
+                    self.neighbors[table['name']].add(referenced)
+                    self.neighbors[referenced].add(table['name'])
+
+    def rank(self, nlq):
+        """
+        Returns the tables matching the NLQ, the most relevant first.
+        """
+        scores = defaultdict(float)
+        for token in set(tokenize(nlq)):
+            for table_name, weight in self.index.get(token, {}).items():
+                scores[table_name] += weight
+
+        linked = defaultdict(float)
+        for table_name, score in scores.items():
+            for neighbor in self.neighbors[table_name]:
+                linked[neighbor] += score * foreign_key_share
+        for table_name, score in linked.items():
+            scores[table_name] += score
+
+        return sorted(scores, key=lambda table_name: (-scores[table_name], self.table_positions[table_name]))
+
+    def link(self, nlq):
+        """
+        Returns the names of the `top_k` tables relevant to the NLQ in the order of the database,
+        or every table when none of them matches.
+        """
+        ranked = self.rank(nlq)[:self.top_k]
+        if not ranked:
+            return list(self.table_names)
+        return [table_name for table_name in self.table_names if table_name in ranked]
+
+    def prompt_context(self, nlq):
+        """
+        Returns the {tables}, {schema} and {table_info} values of the prompt with only the linked tables.
+        """
+        if nlq not in self._contexts:
+            snapshot = select_tables(self.snapshot, self.link(nlq))
+            self._contexts[nlq] = {
+                'tables': format_tables(snapshot),
+                'schema': format_schema(snapshot),
+                'table_info': format_table_info(snapshot)
+            }
+        return self._contexts[nlq]
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+from sqlalchemy import MetaData, select, text
+from sqlalchemy.schema import CreateTable
+
+# Rows of each table shown in the table info of the prompts
+sample_rows = 3
+
+# Version of the snapshot content, part of the cache key so older snapshots are rebuilt
+snapshot_format = 2
+
+def schema_version(engine):
+    """
+    Returns a string identifying the current state of the database: the path, size and
+    modification time of a SQLite file, plus the schema version counter of the database.
+    """
+    parts = [str(snapshot_format), str(engine.url)]
+    database_path = engine.url.database
+    if engine.dialect.name == 'sqlite' and database_path and os.path.exists(database_path):
+        stat = os.stat(database_path)
+        parts += [str(stat.st_size), str(stat.st_mtime_ns)]
+        with engine.connect() as connection:
+            parts.append(str(connection.execute(text("PRAGMA schema_version")).scalar()))
+    return '|'.join(parts)
+
+def build_snapshot(engine):
+    """
+    Reflects the database once and returns the table names, the creation statement,
+    the column names, first rows and tables referenced by foreign keys of each table.
+    """
+    metadata = MetaData()
+    metadata.reflect(engine)
+
+    tables = []
+    with engine.connect() as connection:
+        for table_name, table in metadata.tables.items():
+            rows = connection.execute(select(table.c).limit(sample_rows)).fetchall()
+            tables.append({
+                'name': table_name,
+                'ddl': str(CreateTable(table).compile(engine)),
+                'columns': [column.name for column in table.c],
+                'rows': [[str(value) for value in row] for row in rows],
+                'foreign_keys': sorted({foreign_key.column.table.name for foreign_key in table.foreign_keys})
+            })
+    return {'dialect': engine.dialect.name, 'tables': tables}
+
+def snapshot_path(cache_path, version):
+    return os.path.join(cache_path, f"schema_{hashlib.sha256(version.encode('utf-8')).hexdigest()[:16]}.json")
+
+def load_schema_snapshot(engine, cache_path):
+    """
+    Returns the schema snapshot of the database, reflected only when the database changed
+    since the last snapshot stored in `cache_path`.
+    """
+    path = snapshot_path(cache_path, schema_version(engine))
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    snapshot = build_snapshot(engine)
+    os.makedirs(cache_path, exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary_path, path)
+    return snapshot
+
+def select_tables(snapshot, table_names):
+    """
+    Returns a snapshot with only the given tables, in the order of the database.
+    """
+    table_names = set(table_names)
+    return {'dialect': snapshot['dialect'], 'tables': [table for table in snapshot['tables'] if table['name'] in table_names]}
+
+def format_tables(snapshot):
+    return ', '.join(table['name'] for table in snapshot['tables'])
+
+def format_schema(snapshot):
+    # Join all construction statements, with only one newline between them
+    schema = '\n\n'.join(table['ddl'] for table in snapshot['tables'])
+    return '\n'.join(filter(None, schema.split('\n\n')))
+
+def format_table_info(snapshot):
+    # Creation statement, header with the column names and first rows of each table
+    output_string = ""
+    for table in snapshot['tables']:
+        output_string += f"\nTable schema for {table['name']}:\n{table['ddl']}\n"
+        output_string += f"First {sample_rows} rows of {table['name']}:\n" + "\t".join(table['columns']) + "\n"
+        for row in table['rows']:
+            output_string += "\t".join(row) + "\n"
+    return output_string
@@ -0,0 +1,108 @@
+import sys
+import time
+import sqlite3
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+class QueryTimeout(Exception):
+    pass
+
+class QueryTruncated(Exception):
+    pass
+
+# Number of SQLite virtual machine instructions between timeout checks
+progress_handler_instructions = 1000
+
+# Rows fetched from the cursor at a time while enforcing the limits
+fetch_size = 500
+
+def value_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return sys.getsizeof(value) if value is not None else 0
+
+class SQLExecutor:
+    """
+    Executes queries on a pool of worker threads, each one with its own read-only
+    SQLite connection. Every query has a wall-clock timeout and a limit on the number
+    of rows and bytes fetched.
+    """
+    def __init__(self, database_path, num_workers=4, timeout_s=30, max_rows=100000, max_bytes=64 * 1024 * 1024):
+        self.database_path = database_path
+        self.timeout_s = timeout_s
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='sql')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.database_path}?mode=ro', uri=True)
+            self._local.connection = connection
+        return connection
+
+    def _fetch(self, query):
+        connection = self._connection()
+        deadline = time.perf_counter() + self.timeout_s
+
+        # Returning a non-zero value from the handler interrupts the running statement
+        connection.set_progress_handler(lambda: 1 if time.perf_counter() > deadline else 0, progress_handler_instructions)
+        try:
+            cursor = connection.execute(query)
+            columns = [column[0] for column in cursor.description] if cursor.description else []
+            rows = []
+            fetched_bytes = 0
+            while True:
+                chunk = cursor.fetchmany(fetch_size)
+                if not chunk:
+                    break
+                for row in chunk:
+                    rows.append(row)
+                    fetched_bytes += sum(value_size(value) for value in row)
+                    if len(rows) > self.max_rows or fetched_bytes > self.max_bytes:
+                        cursor.close()
+                        raise QueryTruncated(rows[:self.max_rows], columns)
+            return rows, columns
+        except sqlite3.OperationalError as e:
+            if time.perf_counter() > deadline and 'interrupted' in str(e):
+                raise QueryTimeout() from e
+            raise
+        finally:
+            connection.set_progress_handler(None, 0)
+
+    def execute(self, query):
+        """
+        Executes a query and returns its result, error and execution time in ms,
+        with the same format as pd.read_sql_query(...).values.tolist().
+        """
+        start_time = time.perf_counter()
+        try:
+            rows, columns = self._fetch(query)
+            result = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True).values.tolist()
+            error = "No error."
+        except QueryTimeout:
+            result = [[-1]]
+            error = [f"Timeout: query exceeded {self.timeout_s} s"]
+        except QueryTruncated as e:
+            rows, columns = e.args
+            result = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True).values.tolist()
+            error = [f"Truncated: result exceeded {self.max_rows} rows or {self.max_bytes} bytes"]
+        except Exception as e:
+            result = [[-1]]
+            # Same message format as pd.read_sql_query on a SQLAlchemy engine
+            message = f"Execution failed on sql '{query}': ({type(e).__module__}.{type(e).__name__}) {e}\n[SQL: {query}]"
+            error = message.strip().splitlines()[:2]
+        end_time = time.perf_counter()
+        execution_time_ms = (end_time - start_time) * 1000  # Convert to milliseconds
+        return result, error, execution_time_ms
+
+    def submit(self, query):
+        return self._executor.submit(self.execute, query)
+
+    def map(self, queries):
+        return list(self._executor.map(self.execute, queries))
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+import pandas as pd
+from experiment.prompt_assembly import usage_tokens
+
+def usage_attributes(completion):
+    """
+    Returns the token counts reported in the usage of a completion.
+    """
+    usage = getattr(completion, 'usage', None)
+    if usage is None:
+        return {}
+    prompt_tokens, cached_tokens = usage_tokens(completion)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'total_tokens': usage.total_tokens,
+        'cached_tokens': cached_tokens
+    }
+
+class Tracer:
+    """
+    Writes the spans of a run to a JSONL file, one line per span with the field names of
+    OpenTelemetry spans: trace and span IDs, parent span ID, start and end times in
+    nanoseconds since the epoch and attributes. Spans opened in a thread are nested under
+    the span that thread has open, and the stages of every NLQ and repetition are kept apart
+    by their `index` and `repetition` attributes.
+    """
+    def __init__(self, path, resume=False):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.trace_id = uuid.uuid4().hex
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the block as a span. The attributes dictionary is yielded so the block can add
+        values only known at the end, such as token counts.
+        """
+        stack = self._stack()
+        span_id = uuid.uuid4().hex[:16]
+        parent_span_id = stack[-1] if stack else None
+        stack.append(span_id)
+        start_ns = time.time_ns()
+        start_counter = time.perf_counter_ns()
+        try:
+            yield attributes
+        finally:
+            stack.pop()
+            end_ns = start_ns + time.perf_counter_ns() - start_counter
+            self._write(name, span_id, parent_span_id, start_ns, end_ns, attributes)
+
+    def record(self, name, duration_ms, **attributes):
+        """
+        Records a span measured elsewhere, such as an inference run by the async engine,
+        ending now and nested under the span open in the current thread.
+        """
+        stack = self._stack()
+        end_ns = time.time_ns()
+        self._write(name, uuid.uuid4().hex[:16], stack[-1] if stack else None,
+                    end_ns - int(duration_ms * 1e6), end_ns, attributes)
+
+    def _write(self, name, span_id, parent_span_id, start_ns, end_ns, attributes):
+        line = json.dumps({
+            'trace_id': self.trace_id,
+            'span_id': span_id,
+            'parent_span_id': parent_span_id,
+            'name': name,
+            'start_time_unix_nano': start_ns,
+            'end_time_unix_nano': end_ns,
+            'attributes': attributes
+        }, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class NullTracer:
+    """
+    Tracer used when tracing is disabled, its spans cost a context manager and nothing is written.
+    """
+    path = None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        yield attributes
+
+    def record(self, name, duration_ms, **attributes):
+        pass
+
+    def close(self):
+        pass
+
+def read_spans(path):
+    """
+    Returns the spans of a trace file as a DataFrame with their duration in ms.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        spans = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    spans['duration_ms'] = (spans['end_time_unix_nano'] - spans['start_time_unix_nano']) / 1e6
+    return spans
+
+def _merge_intervals(intervals):
+    # Union of (start, end) intervals, as sorted disjoint intervals
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _subtract_intervals(start, end, holes):
+    # Parts of [start, end) outside the sorted disjoint `holes`
+    parts = []
+    for hole_start, hole_end in holes:
+        if hole_end <= start or hole_start >= end:
+            continue
+        if hole_start > start:
+            parts.append((start, hole_start))
+        start = max(start, hole_end)
+    if start < end:
+        parts.append((start, end))
+    return parts
+
+def _length(intervals):
+    return sum(end - start for start, end in intervals)
+
+def summarize_trace(path):
+    """
+    Returns the time spent in each stage of a trace file: number of spans, total, mean,
+    median and 95th percentile duration, self time and the tokens reported by the completions
+    of the stage. The self time of a span is the part of its duration not covered by any span
+    nested in it, so children running concurrently, such as the requests of the async engine,
+    are only subtracted once. `self_ms` adds up the self time of the spans of a stage, while
+    `self_wall_ms` only counts the time during which at least one of them was running, which
+    gives the share of the wall clock of the runs taken by the stage (`self_share`) and, with
+    `self_ms`, the average number of its spans running at once (`concurrency`).
+    """
+    spans = read_spans(path)
+    spans['tokens'] = spans['attributes'].map(lambda attributes: attributes.get('total_tokens') or 0)
+
+    intervals = list(zip(spans['start_time_unix_nano'] / 1e6, spans['end_time_unix_nano'] / 1e6))
+    children = {}
+    for parent_span_id, interval in zip(spans['parent_span_id'], intervals):
+        if isinstance(parent_span_id, str):
+            children.setdefault(parent_span_id, []).append(interval)
+    self_intervals = [_subtract_intervals(start, end, _merge_intervals(children.get(span_id, [])))
+                      for span_id, (start, end) in zip(spans['span_id'], intervals)]
+    spans['self_ms'] = [_length(parts) for parts in self_intervals]
+
+    # Time during which at least one span of each stage was running outside its children
+    stage_intervals = {}
+    for name, parts in zip(spans['name'], self_intervals):
+        stage_intervals.setdefault(name, []).extend(parts)
+    self_wall_ms = {name: _length(_merge_intervals(parts)) for name, parts in stage_intervals.items()}
+
+    wall_clock_ms = spans.loc[spans['parent_span_id'].isna(), 'duration_ms'].sum()
+    summary = spans.groupby('name').agg(
+        spans=('duration_ms', 'size'),
+        total_ms=('duration_ms', 'sum'),
+        mean_ms=('duration_ms', 'mean'),
+        p50_ms=('duration_ms', 'median'),
+        p95_ms=('duration_ms', lambda durations: durations.quantile(0.95)),
+        self_ms=('self_ms', 'sum'),
+        tokens=('tokens', 'sum')
+    )
+    summary['self_wall_ms'] = summary.index.map(self_wall_ms)
+    summary['self_share'] = summary['self_wall_ms'] / wall_clock_ms * 100 if wall_clock_ms else 0.0
+    summary['concurrency'] = (summary['self_ms'] / summary['self_wall_ms']).where(summary['self_wall_ms'] > 0)
+    summary = summary[['spans', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'self_ms', 'self_wall_ms', 'self_share',
+                       'concurrency', 'tokens']]
+    return summary.sort_values('self_wall_ms', ascending=False).round(2)
+
+def format_trace_summary(summary):
+    return ("Time per stage (ms, self share in % of the wall clock; stages running concurrently may add up to more than 100%):\n"
+            + summary.to_string() + "\n")
+
+if __name__ == '__main__':
+    print(format_trace_summary(summarize_trace(sys.argv[1])))
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import sqlite3
+
+class WorkQueue:
+    """
+    Queue of (experiment, NLQ range) tasks stored in a SQLite file shared by the processes of a run.
+    A worker claims a task with a lease that it renews while the task runs. A task whose lease
+    expires, because its worker died, is claimed again, and a failed task is retried until
+    it reaches `max_attempts`.
+    """
+    def __init__(self, path, max_attempts=3):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_attempts = max_attempts
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_id INTEGER PRIMARY KEY, id_experiment TEXT NOT NULL, start INTEGER NOT NULL, stop INTEGER NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "owner TEXT, lease_expires REAL, error TEXT, UNIQUE (id_experiment, start, stop))"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def close(self):
+        self._connection.close()
+
+    def set_settings(self, **settings):
+        self._connection.executemany("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                                     [(name, json.dumps(value)) for name, value in settings.items()])
+
+    def settings(self):
+        return {name: json.loads(value) for name, value in self._connection.execute("SELECT name, value FROM settings")}
+
+    def add_tasks(self, tasks):
+        """
+        Adds (experiment ID, start, stop) tasks, keeping the ones already in the queue.
+        """
+        self._connection.executemany("INSERT OR IGNORE INTO tasks (id_experiment, start, stop) VALUES (?, ?, ?)", tasks)
+
+    def retry_failed(self):
+        """
+        Puts the tasks that ran out of attempts back in the queue with their attempts reset,
+        and returns how many there were.
+        """
+        cursor = self._connection.execute(
+            "UPDATE tasks SET status = 'pending', attempts = 0, owner = NULL, lease_expires = NULL, error = NULL "
+            "WHERE status = 'failed' OR (status = 'leased' AND lease_expires < ? AND attempts >= ?)",
+            (time.time(), self.max_attempts)
+        )
+        return cursor.rowcount
+
+    def claim(self, owner, lease_s):
+        """
+        Claims a pending task, or one whose lease expired, and returns (task_id, experiment ID, start, stop),
+        or None when there is nothing to claim.
+        """
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, so two workers never claim the same task
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._connection.execute(
+                "SELECT task_id, id_experiment, start, stop FROM tasks "
+                "WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY attempts, task_id LIMIT 1",
+                (now, self.max_attempts)
+            ).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE task_id = ?",
+                    (owner, now + lease_s, row[0])
+                )
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        return row
+
+    def renew(self, task_id, owner, lease_s):
+        """
+        Extends the lease of a task, returns False if the task is no longer leased by `owner`.
+        """
+        cursor = self._connection.execute(
+            "UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND owner = ? AND status = 'leased'",
+            (time.time() + lease_s, task_id, owner)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, owner):
+        self._connection.execute("UPDATE tasks SET status = 'done', error = NULL WHERE task_id = ? AND owner = ?", (task_id, owner))
+
+    def fail(self, task_id, owner, error):
+        # The task goes back to the queue until it runs out of attempts
+        self._connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ?, lease_expires = NULL "
+            "WHERE task_id = ? AND owner = ?",
+            (self.max_attempts, str(error), task_id, owner)
+        )
+
+    def counts(self):
+        """
+        Returns the number of tasks in each status. Leased tasks whose lease expired on their
+        last attempt are counted as failed.
+        """
+        self._connection.execute(
+            "UPDATE tasks SET status = 'failed', error = COALESCE(error, 'Lease expired') "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (time.time(), self.max_attempts)
+        )
+        return dict(self._connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def finished(self):
+        counts = self.counts()
+        return counts.get('pending', 0) == 0 and counts.get('leased', 0) == 0
+
+    def tasks(self, id_experiment=None):
+        """
+        Returns (experiment ID, start, stop, status, attempts, error) for each task.
+        """
+        query = "SELECT id_experiment, start, stop, status, attempts, error FROM tasks"
+        if id_experiment is not None:
+            return self._connection.execute(query + " WHERE id_experiment = ? ORDER BY start", (id_experiment,)).fetchall()
+        return self._connection.execute(query + " ORDER BY id_experiment, start").fetchall()
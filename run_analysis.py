@@ -1,176 +1,228 @@
+import os
+import argparse
 import pandas as pd
 import numpy as np
-import ast
 
 from experiments import experiments
-from analysis.error_analysis import classify_sqlite_error
-from analysis.match_analysis import calculate_sql_matches, calculate_result_matches, calculate_record_matches, calculate_column_matches
-from analysis.consistency import compare_inf_sql
+from experiment.results_store import iter_findings, findings_signature, findings_repetitions
+from analysis.metrics_store import MetricsStore
+from analysis.long_analysis import RepetitionAnalysis, to_long, mean_interval, wilson_interval, match_names, error_types
 
-NUM_ITERATIONS = 3
 id_experiment = "6-2"
-experiment_name = experiments[id_experiment]["name"]
-input_excel_path = 'findings/' + experiment_name + '_res.xlsx'
-output_analysis_path = 'results/' + experiment_name + '_analysis.xlsx'
-
-# Read the input Excel file
-data = pd.read_excel(input_excel_path)
-
-# Function to convert strings to lists of lists
-def str_to_list(s):
-    try:
-        return ast.literal_eval(s)
-    except (ValueError, SyntaxError) as e:
-        print(f"Error converting string to list: {e}")
-        return []
-
-# Convert response columns from strings to lists of lists
-response_columns = ['exp_response', 'inf_response_1', 'inf_response_2', 'inf_response_3']
-for col in response_columns:
-    data[col] = data[col].apply(str_to_list)
-
-# Calculate matches, errors, and times
-for i in range(1, NUM_ITERATIONS + 1):
-    # Calculate match columns
-    data[f'match_sql_{i}'] = data.apply(lambda row: calculate_sql_matches(row, f'inf_sql_{i}', 'exp_sql'), axis=1)
-    data[f'match_result_{i}'] = data.apply(lambda row: calculate_result_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
-    data[f'match_rows_{i}'] = data.apply(lambda row: calculate_record_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
-    data[f'match_columns_{i}'] = data.apply(lambda row: calculate_column_matches(row, f'inf_response_{i}', 'exp_response'), axis=1)
-
-    # Classify errors and create new columns for them
-    data[f'category_error_{i}'] = data[f'inf_error_{i}'].apply(classify_sqlite_error)
-
-# Calculate consistency
-data['consistency'] = data.apply(compare_inf_sql, axis=1)
-
-# Calculate and export metrics
-match_metrics = {
-    'match_sql': [data[f'match_sql_{i}'].sum() for i in range(1, NUM_ITERATIONS + 1)],
-    'match_result': [data[f'match_result_{i}'].sum() for i in range(1, NUM_ITERATIONS + 1)],
-    'match_rows': [data[f'match_rows_{i}'].sum() for i in range(1, NUM_ITERATIONS + 1)],
-    'match_columns': [data[f'match_columns_{i}'].sum() for i in range(1, NUM_ITERATIONS + 1)]
-}
-
-# Calculate percentages
-total_rows = len(data)
-match_metrics_percent = {
-    'match_sql_percent': [round((m / total_rows) * 100, 2) for m in match_metrics['match_sql']],
-    'match_result_percent': [round((m / total_rows) * 100, 2) for m in match_metrics['match_result']],
-    'match_rows_percent': [round((m / total_rows) * 100, 2) for m in match_metrics['match_rows']],
-    'match_columns_percent': [round((m / total_rows) * 100, 2) for m in match_metrics['match_columns']]
-}
-
-# Prepare error analysis data
-error_combined = {
-    'Iteration': [f'Iteration {i}' for i in range(1, NUM_ITERATIONS + 1)]
-}
-
-error_types = ['Syntactic', 'Semantic', 'Unknown', 'No error.']
-error_counts = {f'Iteration {i}': {error: 0 for error in error_types} for i in range(1, NUM_ITERATIONS + 1)}
-
-for i in range(1, NUM_ITERATIONS + 1):
-    error_series = data[f'category_error_{i}']
-    for error in error_series:
-        if error in error_counts[f'Iteration {i}']:
-            error_counts[f'Iteration {i}'][error] += 1
-
-for error in error_types:
-    error_combined[f'{error} Count'] = [error_counts[f'Iteration {i}'][error] for i in range(1, NUM_ITERATIONS + 1)]
-    error_combined[f'{error} Percentage'] = [round((error_counts[f'Iteration {i}'][error] / total_rows) * 100, 2) for i in range(1, NUM_ITERATIONS + 1)]
+
+# SQLite file with the metrics of every analyzed experiment, read by the general analysis
+metrics_store_path = 'results/metrics.sqlite'
+
+# Values of k reported as pass@k (those above the number of repetitions are left out)
+pass_at_k_values = [1, 5, 10]
+
+# Write the (NLQ, repetition) rows to the 'Original Data' sheet of the workbook
+write_original_data = True
 
 # Function to calculate statistics
 def calculate_statistics(times):
+    # Inferences that failed after every retry have no time and are left out
+    times = pd.Series(times, dtype=float).dropna()
     return {
         'mean': round(np.mean(times), 2),
         'median': round(np.median(times), 2),
         'std_dev': round(np.std(times), 2)
     }
 
-# Calculate statistics for times
-inf_times = [data[f'inf_time_ms_{i}'] for i in range(1, NUM_ITERATIONS + 1)]
-exec_times = [data[f'inf_exec_time_ms_{i}'] for i in range(1, NUM_ITERATIONS + 1)]
-
-inf_stats = [calculate_statistics(times) for times in inf_times]
-exec_stats = [calculate_statistics(times) for times in exec_times]
-
-# Calculate averages across iterations
-avg_metrics = {
-    # Match metrics (average of percentages)
-    'avg_match_sql': round(np.mean(match_metrics_percent['match_sql_percent']), 2),
-    'avg_match_result': round(np.mean(match_metrics_percent['match_result_percent']), 2),
-    'avg_match_rows': round(np.mean(match_metrics_percent['match_rows_percent']), 2),
-    'avg_match_columns': round(np.mean(match_metrics_percent['match_columns_percent']), 2),
-    
-    # Error metrics (average of percentages)
-    'avg_syntactic_error': round(np.mean(error_combined['Syntactic Percentage']), 2),
-    'avg_semantic_error': round(np.mean(error_combined['Semantic Percentage']), 2),
-    'avg_unknown_error': round(np.mean(error_combined['Unknown Percentage']), 2),
-    'avg_no_error': round(np.mean(error_combined['No error. Percentage']), 2),
-    
-    # Time statistics (average of averages)
-    'avg_inference_mean': round(np.mean([stat['mean'] for stat in inf_stats]), 2),
-    'avg_execution_mean': round(np.mean([stat['mean'] for stat in exec_stats]), 2),
-    
-    # Consistency (count of each category)
-    'count_consistency_all_equal': sum(data['consistency'].apply(lambda x: 1 if x == 'all_equal' else 0)),
-    'count_consistency_two_equal': sum(data['consistency'].apply(lambda x: 1 if x == 'two_equal' else 0)),
-    'count_consistency_all_different': sum(data['consistency'].apply(lambda x: 1 if x == 'all_different' else 0))
-}
-
-# Prepare summary data
-summary_data = pd.DataFrame({
-    'Metric': [
-        'Average Match SQL (%)', 'Average Match Result (%)', 'Average Match Rows (%)', 'Average Match Columns (%)',
-        'Average Syntactic Errors (%)', 'Average Semantic Errors (%)', 'Average Unknown Errors (%)', 'Average No Errors (%)',
-        'Average Inference Mean', 'Average Execution Mean',
-        'Count Consistency (All Equal)', 'Count Consistency (Two Equal)', 'Count Consistency (All Different)'
-    ],
-    id_experiment: [
-        avg_metrics['avg_match_sql'], avg_metrics['avg_match_result'], avg_metrics['avg_match_rows'], avg_metrics['avg_match_columns'],
-        avg_metrics['avg_syntactic_error'], avg_metrics['avg_semantic_error'], avg_metrics['avg_unknown_error'], avg_metrics['avg_no_error'],
-        avg_metrics['avg_inference_mean'], avg_metrics['avg_execution_mean'],
-        avg_metrics['count_consistency_all_equal'], avg_metrics['count_consistency_two_equal'], avg_metrics['count_consistency_all_different']
-    ]
-})
-
-# Export to Excel with separate sheets for matches, errors, times, consistency, and summary metrics
-with pd.ExcelWriter(output_analysis_path) as writer:
-    # Write the original data to the first sheet
-    data.to_excel(writer, sheet_name='Original Data', index=False)
-    
-    # Write match metrics to a new sheet
-    match_data = pd.DataFrame({
-        'Iteration': [f'Iteration {i}' for i in range(1, NUM_ITERATIONS + 1)],
-        'Match SQL': match_metrics['match_sql'],
-        'Match SQL %': match_metrics_percent['match_sql_percent'],
-        'Match Result': match_metrics['match_result'],
-        'Match Result %': match_metrics_percent['match_result_percent'],
-        'Match Rows': match_metrics['match_rows'],
-        'Match Rows %': match_metrics_percent['match_rows_percent'],
-        'Match Columns': match_metrics['match_columns'],
-        'Match Columns %': match_metrics_percent['match_columns_percent']
-    })
-    match_data.to_excel(writer, sheet_name='Matches', index=False)
-
-    # Write error metrics to a new sheet
-    error_df = pd.DataFrame(error_combined)
-    error_df.to_excel(writer, sheet_name='Errors', index=False)
-
-    # Write time statistics to a new sheet
-    times_df = pd.DataFrame({
-        'Iteration': [f'Iteration {i}' for i in range(1, NUM_ITERATIONS + 1)],
-        'Inference Mean': [stat['mean'] for stat in inf_stats],
-        'Execution Mean': [stat['mean'] for stat in exec_stats]
-    })
-    times_df.to_excel(writer, sheet_name='Times', index=False)
-    
-   # Write consistency analysis to a new sheet
-    consistency_data = pd.DataFrame(data['consistency'].value_counts()).reset_index()
-    consistency_data.columns = ['Consistency', 'Count']
-    consistency_data['Percentage'] = round((consistency_data['Count'] / total_rows) * 100, 2)
-    consistency_data.to_excel(writer, sheet_name='Consistency', index=False)
-    
-    # Write summary metrics to a new sheet
-    summary_data.to_excel(writer, sheet_name='Summary Metrics', index=False)
-
-print(f"Analysis exported to {output_analysis_path}")
+def percent(value):
+    return round(value * 100, 2)
+
+def run_analysis(id_experiment, num_iterations=None, force=False):
+    """
+    Analyzes the findings of an experiment, writes its analysis workbook and stores its
+    summary and per-iteration metrics in the metrics store used by the general analysis.
+    The findings are read in batches and analyzed in long format, one row per (NLQ, repetition),
+    so any number of repetitions is supported; `num_iterations` keeps only the first ones.
+    Findings already analyzed with the same number of iterations are skipped unless `force`.
+    Returns the summary metrics.
+    """
+    experiment_name = experiments[id_experiment]["name"]
+    output_analysis_path = 'results/' + experiment_name + '_analysis.xlsx'
+
+    available = findings_repetitions('findings', experiment_name)
+    num_iterations = available if num_iterations is None else min(num_iterations, available)
+
+    store = MetricsStore(metrics_store_path)
+    signature = findings_signature('findings', experiment_name)
+    if not force and os.path.exists(output_analysis_path) and store.findings_signature(id_experiment) == (signature, num_iterations):
+        print(f"Findings of {experiment_name} unchanged since their analysis, skipped")
+        summary_data = store.summary_metrics([id_experiment]).reset_index()
+        store.close()
+        return summary_data
+
+    # Calculate matches, errors, agreement and times batch by batch
+    ks = [k for k in pass_at_k_values if k <= num_iterations] or [1]
+    analysis = RepetitionAnalysis(ks, keep_rows=write_original_data)
+    for data in iter_findings('findings', experiment_name):
+        analysis.add(to_long(data, num_iterations))
+
+    nlqs = analysis.nlq_table()
+    counts = analysis.repetition_table()
+    times = analysis.time_table()
+    total_rows = len(nlqs)
+    iterations = list(counts.index)
+
+    # Match counts and percentages of each iteration
+    match_metrics = {name: counts[name].astype(int).tolist() for name in match_names}
+    match_metrics_percent = {f'{name}_percent': [round((m / total_rows) * 100, 2) for m in match_metrics[name]]
+                             for name in match_names}
+
+    # Error counts and percentages of each iteration
+    error_combined = {'Iteration': [f'Iteration {i}' for i in iterations]}
+    for error in error_types:
+        error_combined[f'{error} Count'] = counts[error].astype(int).tolist()
+        error_combined[f'{error} Percentage'] = [round((count / total_rows) * 100, 2) for count in counts[error]]
+
+    # Calculate statistics for times
+    inf_stats = [calculate_statistics(times.loc[times['repetition'] == i, 'time_ms']) for i in iterations]
+    exec_stats = [calculate_statistics(times.loc[times['repetition'] == i, 'exec_time_ms']) for i in iterations]
+
+    # Accuracy and pass@k over NLQs, with 95% confidence intervals clustered by NLQ
+    accuracy, accuracy_low, accuracy_high = mean_interval(nlqs['match_result_count'] / nlqs['samples'])
+    pass_at = {k: mean_interval(nlqs[f'pass@{k}']) for k in ks}
+
+    # Execution-guided accuracy: share of NLQs whose answer chosen by majority vote over the samples is correct
+    vote_correct = int(nlqs['vote_match_result'].sum())
+    vote_low, vote_high = wilson_interval(vote_correct, total_rows)
+
+    # Calculate averages across iterations
+    avg_metrics = {
+        # Match metrics (average of percentages)
+        'avg_match_sql': round(np.mean(match_metrics_percent['match_sql_percent']), 2),
+        'avg_match_result': round(np.mean(match_metrics_percent['match_result_percent']), 2),
+        'avg_match_result_unordered': round(np.mean(match_metrics_percent['match_result_unordered_percent']), 2),
+        'avg_match_rows': round(np.mean(match_metrics_percent['match_rows_percent']), 2),
+        'avg_match_columns': round(np.mean(match_metrics_percent['match_columns_percent']), 2),
+
+        # Error metrics (average of percentages)
+        'avg_syntactic_error': round(np.mean(error_combined['Syntactic Percentage']), 2),
+        'avg_semantic_error': round(np.mean(error_combined['Semantic Percentage']), 2),
+        'avg_timeout_error': round(np.mean(error_combined['Timeout Percentage']), 2),
+        'avg_truncated_error': round(np.mean(error_combined['Truncated Percentage']), 2),
+        'avg_unknown_error': round(np.mean(error_combined['Unknown Percentage']), 2),
+        'avg_no_error': round(np.mean(error_combined['No error. Percentage']), 2),
+
+        # Time statistics (average of averages)
+        'avg_inference_mean': round(np.mean([stat['mean'] for stat in inf_stats]), 2),
+        'avg_execution_mean': round(np.mean([stat['mean'] for stat in exec_stats]), 2),
+
+        # Consistency (count of each category)
+        'count_consistency_all_equal': int((nlqs['consistency'] == 'all_equal').sum()),
+        'count_consistency_two_equal': int((nlqs['consistency'] == 'two_equal').sum()),
+        'count_consistency_all_different': int((nlqs['consistency'] == 'all_different').sum())
+    }
+
+    # Prepare summary data
+    summary_metrics = {
+        'Average Match SQL (%)': avg_metrics['avg_match_sql'],
+        'Average Match Result (%)': avg_metrics['avg_match_result'],
+        'Average Match Result Unordered (%)': avg_metrics['avg_match_result_unordered'],
+        'Average Match Rows (%)': avg_metrics['avg_match_rows'],
+        'Average Match Columns (%)': avg_metrics['avg_match_columns'],
+        'Average Syntactic Errors (%)': avg_metrics['avg_syntactic_error'],
+        'Average Semantic Errors (%)': avg_metrics['avg_semantic_error'],
+        'Average Timeout Errors (%)': avg_metrics['avg_timeout_error'],
+        'Average Truncated Errors (%)': avg_metrics['avg_truncated_error'],
+        'Average Unknown Errors (%)': avg_metrics['avg_unknown_error'],
+        'Average No Errors (%)': avg_metrics['avg_no_error'],
+        'Average Inference Mean': avg_metrics['avg_inference_mean'],
+        'Average Execution Mean': avg_metrics['avg_execution_mean'],
+        'Count Consistency (All Equal)': avg_metrics['count_consistency_all_equal'],
+        'Count Consistency (Two Equal)': avg_metrics['count_consistency_two_equal'],
+        'Count Consistency (All Different)': avg_metrics['count_consistency_all_different'],
+        'Match Result 95% CI Low (%)': percent(accuracy_low),
+        'Match Result 95% CI High (%)': percent(accuracy_high),
+        'Average Modal Agreement (%)': percent(nlqs['modal_agreement'].mean()),
+        'Average SQL Entropy (bits)': round(nlqs['sql_entropy'].mean(), 3),
+        'Majority Vote Match Result (%)': percent(vote_correct / total_rows),
+        'Majority Vote Match Result 95% CI Low (%)': percent(vote_low),
+        'Majority Vote Match Result 95% CI High (%)': percent(vote_high),
+        'Majority Vote Match Result Unordered (%)': percent(nlqs['vote_match_result_unordered'].mean()),
+        'Average Vote Share (%)': percent(nlqs['vote_share'].mean())
+    }
+    for k, (value, low, high) in pass_at.items():
+        summary_metrics[f'Pass@{k} (%)'] = percent(value)
+        summary_metrics[f'Pass@{k} 95% CI Low (%)'] = percent(low)
+        summary_metrics[f'Pass@{k} 95% CI High (%)'] = percent(high)
+    summary_data = pd.DataFrame({'Metric': list(summary_metrics), id_experiment: list(summary_metrics.values())})
+
+    # Export to Excel with separate sheets for matches, errors, times, consistency, pass@k and summary metrics
+    with pd.ExcelWriter(output_analysis_path) as writer:
+        # Write the (NLQ, repetition) rows to the first sheet
+        if write_original_data:
+            analysis.rows().to_excel(writer, sheet_name='Original Data', index=False)
+
+        # Write the agreement, correct samples and pass@k of each NLQ
+        nlqs.reset_index().to_excel(writer, sheet_name='NLQs', index=False)
+
+        # Write match metrics to a new sheet, with the 95% Wilson interval of each rate
+        match_data = pd.DataFrame({'Iteration': [f'Iteration {i}' for i in iterations]})
+        for name in match_names:
+            title = name.replace('match_', 'Match ').replace('_', ' ').title().replace('Sql', 'SQL')
+            match_data[title] = match_metrics[name]
+            match_data[f'{title} %'] = match_metrics_percent[f'{name}_percent']
+        intervals = [wilson_interval(m, total_rows) for m in match_metrics['match_result']]
+        match_data['Match Result % 95% CI Low'] = [percent(low) for low, _ in intervals]
+        match_data['Match Result % 95% CI High'] = [percent(high) for _, high in intervals]
+        match_data.to_excel(writer, sheet_name='Matches', index=False)
+
+        # Write error metrics to a new sheet
+        error_df = pd.DataFrame(error_combined)
+        error_df.to_excel(writer, sheet_name='Errors', index=False)
+
+        # Write time statistics to a new sheet
+        times_df = pd.DataFrame({
+            'Iteration': [f'Iteration {i}' for i in iterations],
+            'Inference Mean': [stat['mean'] for stat in inf_stats],
+            'Execution Mean': [stat['mean'] for stat in exec_stats]
+        })
+        times_df.to_excel(writer, sheet_name='Times', index=False)
+
+        # Write consistency analysis to a new sheet
+        consistency_data = pd.DataFrame(nlqs['consistency'].value_counts()).reset_index()
+        consistency_data.columns = ['Consistency', 'Count']
+        consistency_data['Percentage'] = round((consistency_data['Count'] / total_rows) * 100, 2)
+        consistency_data.to_excel(writer, sheet_name='Consistency', index=False)
+
+        # Write pass@k with its 95% confidence interval to a new sheet
+        pass_data = pd.DataFrame({
+            'k': list(pass_at),
+            'Pass@k %': [percent(value) for value, _, _ in pass_at.values()],
+            '95% CI Low': [percent(low) for _, low, _ in pass_at.values()],
+            '95% CI High': [percent(high) for _, _, high in pass_at.values()]
+        })
+        pass_data.to_excel(writer, sheet_name='Pass@k', index=False)
+
+        # Write summary metrics to a new sheet
+        summary_data.to_excel(writer, sheet_name='Summary Metrics', index=False)
+
+    # Store the summary and per-iteration metrics for the general analysis
+    iteration_metrics = pd.DataFrame({
+        **match_metrics, **match_metrics_percent,
+        **{column.lower().replace(' ', '_').replace('.', ''): values for column, values in error_combined.items() if column != 'Iteration'},
+        **{f'inference_{stat}': [stats[stat] for stats in inf_stats] for stat in ('mean', 'median', 'std_dev')},
+        **{f'execution_{stat}': [stats[stat] for stats in exec_stats] for stat in ('mean', 'median', 'std_dev')}
+    }, index=iterations)
+    store.upsert_experiment(id_experiment, experiment_name, summary_metrics, iteration_metrics, signature, num_iterations, total_rows)
+    store.close()
+
+    print(f"Analysis exported to {output_analysis_path}")
+
+    return summary_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze the findings of Text-to-SQL experiments.')
+    parser.add_argument('--experiment', nargs='+', default=[id_experiment],
+                        help='IDs of the experiments to analyze, "all" for every experiment in experiments.py')
+    parser.add_argument('--repetitions', type=int, default=None,
+                        help='analyze only the first repetitions of each NLQ (default: every repetition in the findings)')
+    parser.add_argument('--force', action='store_true', help='analyze the findings again even if they did not change')
+    args = parser.parse_args()
+
+    for id_experiment in (list(experiments.keys()) if args.experiment == ['all'] else args.experiment):
+        run_analysis(id_experiment, args.repetitions, args.force)
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import run_experiment
+from experiments import experiments
+from experiment.work_queue import WorkQueue
+from run_experiment import config, load_shared_artifacts, merge_shards, shard_name, shard_files, resources
+
+# NLQs of each task and local worker processes started by the coordinator
+shard_size = 20
+num_workers = 4
+
+# Seconds a claimed task stays leased without being renewed, and seconds between the renewals
+lease_s = 120
+renew_interval_s = 30
+
+# Seconds a worker waits before looking again for a task when the remaining ones are leased
+poll_interval_s = 2
+
+queue_path = config['cache_path'] + 'queue.sqlite'
+
+def make_tasks(ids_experiments, records, size):
+    return [(id_experiment, start, min(start + size, records))
+            for id_experiment in ids_experiments for start in range(0, records, size)]
+
+def remove_shard_files(id_experiment, records, size):
+    # Leftovers of an earlier run would be resumed as if they belonged to this one
+    prefix = config['output_path'] + experiments[id_experiment]["name"]
+    for _, start, stop in make_tasks([id_experiment], records, size):
+        for suffix in shard_files:
+            path = prefix + shard_name((start, stop)) + suffix
+            if os.path.exists(path):
+                os.remove(path)
+
+def merge_finished(queue):
+    """
+    Merges the shards of every experiment whose tasks are all done.
+    """
+    ids_experiments = sorted({task[0] for task in queue.tasks()})
+    for id_experiment in ids_experiments:
+        tasks = queue.tasks(id_experiment)
+        failed = [task for task in tasks if task[3] != 'done']
+        if failed:
+            print(f"Experiment {id_experiment} not merged, {len(failed)} tasks not done:")
+            for _, start, stop, status, attempts, error in failed:
+                print(f"  NLQs {start}-{stop}: {status} after {attempts} attempts ({error})")
+            continue
+        output_path = merge_shards(id_experiment, [(start, stop) for _, start, stop, *_ in tasks])
+        print(f"Experiment {id_experiment} finished: {output_path}")
+
+def renew_lease(path, task_id, owner, stop_event):
+    # Runs in its own thread, with its own connection to the queue
+    queue = WorkQueue(path)
+    try:
+        while not stop_event.wait(renew_interval_s):
+            if not queue.renew(task_id, owner, lease_s):
+                print(f"Worker {owner} lost the lease of task {task_id}")
+                return
+    finally:
+        queue.close()
+
+def run_worker(path):
+    """
+    Claims tasks from the queue and runs them until none are left.
+    Each task runs the NLQs of one experiment in a shard journal, resumed when
+    the task is retried after a failure or after its previous worker stopped.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(path)
+    settings = queue.settings()
+    run_experiment.num_records = settings['records']
+    run_experiment.num_repetitions = settings['repetitions']
+    artifacts = load_shared_artifacts()
+
+    while True:
+        task = queue.claim(owner, lease_s)
+        if task is None:
+            if queue.finished():
+                break
+            # The remaining tasks are leased by other workers, wait in case a lease expires
+            time.sleep(poll_interval_s)
+            continue
+
+        task_id, id_experiment, start, stop = task
+        print(f"Worker {owner} running experiment {id_experiment}, NLQs {start}-{stop}")
+        stop_event = threading.Event()
+        renewer = threading.Thread(target=renew_lease, args=(path, task_id, owner, stop_event), daemon=True)
+        renewer.start()
+        try:
+            # The workers split the per-minute limits of the model
+            run_experiment.run_experiment(id_experiment, artifacts, 1.0 / settings['workers'], show_progress=False,
+                                          resume=True, nlq_range=(start, stop))
+            queue.complete(task_id, owner)
+        except Exception as e:
+            print(f"Worker {owner} failed experiment {id_experiment}, NLQs {start}-{stop}: {e}")
+            queue.fail(task_id, owner, e)
+        finally:
+            stop_event.set()
+            renewer.join()
+
+    if resources['response_cache'] is not None:
+        print(f"Worker {owner}: {resources['response_cache'].format_stats()}")
+    queue.close()
+
+def run_coordinator(ids_experiments, path, records, repetitions, size, workers, resume=False):
+    """
+    Splits the experiments into tasks of `size` NLQs, starts `workers` local worker processes
+    and merges the shards of each experiment into its findings once its tasks are done.
+    With `resume`, the tasks already done in the queue are kept and the failed ones are tried again.
+    """
+    if not resume:
+        if os.path.exists(path):
+            os.remove(path)
+        for id_experiment in ids_experiments:
+            remove_shard_files(id_experiment, records, size)
+
+    # Build the cached schema snapshot, dataset copy and expected results once, before the workers read them
+    run_experiment.num_records = records
+    run_experiment.num_repetitions = repetitions
+    artifacts = load_shared_artifacts()
+    artifacts['schema_snapshot']
+    artifacts['expected_results']
+
+    queue = WorkQueue(path)
+    queue.set_settings(records=records, repetitions=repetitions, workers=workers)
+    queue.add_tasks(make_tasks(ids_experiments, records, size))
+    if resume:
+        retried = queue.retry_failed()
+        if retried:
+            print(f"Queue {path}: {retried} failed tasks queued again")
+    print(f"Queue {path}: {queue.counts()}")
+
+    start_time = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--queue', path])
+                 for _ in range(workers)]
+    for process in processes:
+        process.wait()
+
+    print(f"Workers finished in {time.perf_counter() - start_time:.2f} s: {queue.counts()}")
+    merge_finished(queue)
+    queue.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Text-to-SQL experiments split into shards by several worker processes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = subparsers.add_parser('coordinator', help='queue the shards, start local workers and merge their results')
+    coordinator.add_argument('--experiment', nargs='+', default=[run_experiment.id_experiment],
+                             help='IDs of the experiments to run, "all" for every experiment in experiments.py')
+    coordinator.add_argument('--records', type=int, default=run_experiment.num_records, help='number of NLQs of the dataset to run')
+    coordinator.add_argument('--repetitions', type=int, default=run_experiment.num_repetitions, help='inferences of each NLQ')
+    coordinator.add_argument('--shard-size', type=int, default=shard_size, help='NLQs of each task')
+    coordinator.add_argument('--workers', type=int, default=num_workers, help='local worker processes')
+    coordinator.add_argument('--resume', action='store_true', help='keep the tasks already done in the queue and retry the failed ones')
+
+    worker = subparsers.add_parser('worker', help='run tasks from the queue until none are left')
+
+    merge = subparsers.add_parser('merge', help='merge the shards of the experiments whose tasks are all done')
+
+    for subparser in (coordinator, worker, merge):
+        subparser.add_argument('--queue', default=queue_path, help='SQLite file of the work queue')
+
+    args = parser.parse_args(argv)
+    if args.command == 'coordinator':
+        ids_experiments = list(experiments.keys()) if args.experiment == ['all'] else args.experiment
+        run_coordinator(ids_experiments, args.queue, args.records, args.repetitions, args.shard_size, args.workers,
+                        args.resume)
+    elif args.command == 'worker':
+        run_worker(args.queue)
+    else:
+        queue = WorkQueue(args.queue)
+        settings = queue.settings()
+        run_experiment.num_repetitions = settings['repetitions']
+        merge_finished(queue)
+        queue.close()
+
+if __name__ == '__main__':
+    main()
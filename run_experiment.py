@@ -1,252 +1,743 @@
-import re
+import os
 import time
+import shutil
+import argparse
 import json
-import pandas as pd
-from openai import OpenAI 
-from sqlalchemy import create_engine, MetaData, Table, select
-from sqlalchemy.schema import CreateTable
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import OpenAI, BadRequestError
+from experiment.async_inference import run_inferences
+from experiment.batch_inference import run_batch, make_custom_id, parse_custom_id
+from experiment.response_cache import ResponseCache
+from experiment.resources import LazyResources
+from experiment.journal import ResultJournal, journal_completed
+from experiment.gold_results import load_gold_results
+from experiment.dataset import DatasetLoader, normalize_sql
+from experiment.sql_executor import SQLExecutor
+from experiment.results_store import write_findings
+from experiment.prompt_assembly import PromptAssembler, prompt_text, prompt_tokens_estimate, usage_tokens
+from experiment.schema_linking import SchemaLinker
+from experiment.resilience import RequestLayer, RetryPolicy, RequestFailed, new_call_stats, combine_call_stats
+from experiment.call_log import CallLog, call_record, format_call
+from experiment.sampling import group_samples, split_choices, spread_samples, spread_stats
+from experiment.tracing import Tracer, NullTracer, usage_attributes, summarize_trace, format_trace_summary
+from analysis.fingerprint import fingerprint_columns
+from analysis.sql_extraction import extract_sql
+from analysis.long_analysis import to_long
+from analysis.self_consistency import add_majority_vote
+from experiment.schema_snapshot import load_schema_snapshot, format_tables, format_schema, format_table_info
+from sqlalchemy import create_engine
 from prompts_to_use import prompts
 from experiments import experiments
 
 id_experiment = "5-2"
-experiment_name = experiments[id_experiment]["name"]
-
-client = OpenAI()
 
 # Load configuration from JSON file
 with open('config.json', 'r') as f:
     config = json.load(f)
 
 # Configuration variables
-log_file_path = config['output_path'] + experiment_name + '_log.txt'
-output_excel_path = config['output_path'] + experiment_name + '_res.xlsx'
 num_records = 80
 num_repetitions = 3
-max_retries = 2
-time_delay_between_retries = 2
-time_delay_between_inferences = 3
+
+# Request layer: API calls failing with a rate limit, timeout, connection or server error are retried up to
+# `max_retries` times with exponential backoff and jitter, waiting as asked by Retry-After when the server sends it.
+# After `circuit_failure_threshold` consecutive failures a model is left alone for `circuit_reset_timeout_s`,
+# and the requests in flight to each model adapt to the 429 responses observed. With `hedge_requests`, a request
+# slower than the 95th percentile of the recent latencies is sent a second time and the first answer is kept.
+max_retries = 5
+retry_base_delay_s = 0.5
+retry_max_delay_s = 30
+request_timeout_s = 60
+circuit_failure_threshold = 5
+circuit_reset_timeout_s = 30
+hedge_requests = False
+
+# Execution mode: 'sync' calls the API one request at a time,
+# 'async' runs all inferences concurrently under a requests/tokens per minute limit,
+# 'batch' submits all inferences as one Batch API job and waits for its results
+execution_mode = 'async'
+max_concurrency = 8
+requests_per_minute = 500
+tokens_per_minute = 30000
+batch_poll_interval_s = 30
+
+# Sampling: with `n_sampling`, the repetitions of each NLQ are requested as `n` completions of a single call,
+# for the models listed in `n_sampling_models` of the config, instead of one call per repetition, so the prompt
+# is sent once per NLQ. A model that rejects a request with `n` gets one call per repetition for the rest of the run.
+# The findings record every sample and the answer chosen by majority vote over their result fingerprints.
+n_sampling = False
+
+# Prompt layout: 'single' sends the whole prompt as one user message, 'split' sends the
+# static prefix (schema, table info, examples) as a system message and the NLQ as the user message
+prompt_layout = 'single'
+
+# Schema linking: only the `schema_linking_top_k` tables most relevant to each NLQ are given in
+# {tables}, {schema} and {table_info}, None gives the whole database in every prompt
+schema_linking_top_k = None
+
+# Response cache: completions already paid for are replayed instead of calling the API again
+use_response_cache = True
+response_cache_max_bytes = 512 * 1024 * 1024
+
+# Warm executions of each expected query, the median time is recorded as exp_time_ms
+gold_warm_runs = 5
+
+# SQL execution pool: read-only connections with a timeout and a limit on fetched rows/bytes
+sql_workers = 4
+sql_timeout_s = 30
+sql_max_rows = 100000
+sql_max_bytes = 64 * 1024 * 1024
+
+# Findings are stored as Parquet, the Excel copy is an optional report
+export_excel = False
+
+# Result sets are only needed to inspect the results, matches are computed from their fingerprints
+store_result_sets = True
+
+# Tracing: the time of each stage of each NLQ and repetition is written as spans to <name>_trace.jsonl,
+# and a summary of where the time goes is written to the log
+trace_stages = True
 
 # Configuration from JSON
-model_name = config[experiments[id_experiment]["model"]]
 connection_string = config['connection_string']
-
-# Prompt template for generating SQL queries
-prompt_to_use = prompts[experiments[id_experiment]["prompt"]]
-
-# Connect to the SQLite database using SQLAlchemy
-engine = create_engine(connection_string)
-metadata = MetaData()
-metadata.reflect(engine)
-tables = ', '.join(metadata.tables.keys())
-dialect = engine.dialect.name
-
-# Get the construction statements for each table
-schema_statements = []
-for table_name in metadata.tables:
-    table = Table(table_name, metadata, autoload_with=engine)
-    ddl = CreateTable(table).compile(engine)
-    schema_statements.append(str(ddl))
-
-# Join all construction statements into a single string
-schema = '\n\n'.join(schema_statements)
-
-# Ensure there is only two newline between each statement
-schema = '\n'.join(filter(None, schema.split('\n\n')))
-
-def get_table_info(engine_url):
-    # Create the database engine
-    engine = create_engine(engine_url)
-    
-    # Reflect the database tables
-    metadata = MetaData()
-    metadata.reflect(engine)
-    
-    output_string = ""
-
-    # Retrieve table creation statements and the first 3 rows of each table
-    with engine.connect() as connection:
-        for table_name in metadata.tables:
-            table = Table(table_name, metadata, autoload_with=engine)
-            
-            # Get the table creation statement
-            ddl = CreateTable(table).compile(engine)
-            output_string += f"\nTable schema for {table_name}:\n{ddl}\n"
-            
-            # Get column names
-            columns = table.c
-            
-            # Build header with column names
-            column_names = [column.name for column in columns]
-            header = "\t".join(column_names)
-            output_string += f"First 3 rows of {table_name}:\n{header}\n"
-            
-            # Get the first 3 rows of the table
-            query = select(columns).limit(3)
-            result = connection.execute(query).fetchall()
-            
-            # Append rows to the output string
-            for row in result:
-                row_values = "\t".join(str(value) for value in row)
-                output_string += f"{row_values}\n"
-    
-    return output_string
-
-table_info = get_table_info(connection_string)
-
-# Function to extract information using regular expressions and format it
-def extract_and_format(text):
-    id_match = re.search(r"id='(.*?)'", text)
-    model_match = re.search(r"model='(.*?)'", text)
-    created_match = re.search(r"created=(\d+)", text)
-    content_match = re.search(r"content='(.*?)'", text, re.DOTALL)
-    completion_tokens_match = re.search(r"completion_tokens=(\d+)", text)
-    prompt_tokens_match = re.search(r"prompt_tokens=(\d+)", text)
-    total_tokens_match = re.search(r"total_tokens=(\d+)", text)
-
-    formatted_response = []
-    formatted_response.append("ChatCompletion Response")
-    if id_match:
-        formatted_response.append(f"ID: {id_match.group(1)}")
-    if model_match:
-        formatted_response.append(f"Model: {model_match.group(1)}")
-    if created_match:
-        formatted_response.append(f"Created: {created_match.group(1)}")
-    formatted_response.append("Choices:")
-    if content_match:
-        formatted_response.append("  Content:")
-        formatted_response.append(content_match.group(1).replace('\\n', '\n'))
-    formatted_response.append("Usage:")
-    if completion_tokens_match:
-        formatted_response.append(f"  Completion Tokens: {completion_tokens_match.group(1)}")
-    if prompt_tokens_match:
-        formatted_response.append(f"  Prompt Tokens: {prompt_tokens_match.group(1)}")
-    if total_tokens_match:
-        formatted_response.append(f"  Total Tokens: {total_tokens_match.group(1)}")
-
-    return "\n".join(formatted_response)
-
-# Read the Excel dataset with NLQs and expected SQL queries
-data = pd.read_excel(config['dataset_excel_path']).head(num_records)
-#data = pd.read_excel(config['dataset_excel_path'], nrows=9).tail(1)
-
-# Extract NLQs and SQL queries from the dataset
-nlq_values = data['nlq']
-sql_values = data['sql'].apply(lambda sql: ' '.join(sql.replace('\n', ' ').split()))
-
-# Function to execute SQL query and return results with timing
-def execute_query(query, engine):
-    start_time = time.perf_counter()
-    try:
-        result_df = pd.read_sql_query(query, engine)
-        result = result_df.values.tolist()
-        error = "No error."
-    except Exception as e:
-        result = [[-1]]
-        error = str(e).strip().splitlines()[:2]
-    end_time = time.perf_counter()
-    execution_time_ms = (end_time - start_time) * 1000  # Convert to milliseconds
-    return result, error, execution_time_ms
-
-# List to store experiment results
-results = []
-
-# Open a log file to record details of the experiment
-with open(log_file_path, 'w') as log_file:
-    log_file.write(f"Experiment started at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-    log_file.write(f"Experiment ID: {id_experiment}\n")
-    log_file.write(f"Experiment name: {experiment_name}\n")
-    log_file.write(f"Model used: {model_name}\n")
-    log_file.write(f"Number of records: {num_records}\n")
-    log_file.write(f"Number of repetitions: {num_repetitions}\n\n")
-
-    print(f"Running experiment {id_experiment}: {experiment_name}")
-
-    # Iterate over each row in the DataFrame
-    for index, (nlq, sql) in enumerate(zip(nlq_values, sql_values)):
-        print(f"\rProcessing NLQ {index + 1}/{num_records}...", end='', flush=True)
-
-        result_entry = {'nlq': nlq, 'exp_sql': sql}
-
-        # Execute the expected SQL query and get the result
-        exp_result, exp_error, exp_time = execute_query(sql, engine)
-        result_entry.update({
-            'exp_response': exp_result,
-            'exp_error': exp_error,
-            'exp_time_ms': exp_time
-        })
-
-        # Repeat the inference and execution process
+n_sampling_models = set(config.get('n_sampling_models', []))
+
+# Models that rejected a request with `n` during this run
+models_rejecting_n = set()
+
+# Resources shared by every experiment of the process, created on first use
+resources = LazyResources(
+    # Retries are left to the request layer
+    client=lambda resources: OpenAI(max_retries=0, timeout=request_timeout_s),
+    request_layer=lambda resources: RequestLayer(max_concurrency, RetryPolicy(max_retries, retry_base_delay_s, retry_max_delay_s),
+                                                 hedge_requests, circuit_failure_threshold, circuit_reset_timeout_s),
+    response_cache=lambda resources: ResponseCache(config['cache_path'] + 'responses.sqlite', response_cache_max_bytes)
+    if use_response_cache else None
+)
+
+def load_dataset(artifacts):
+    # Read the first NLQs and expected SQL queries, streamed from a cached Parquet copy of the dataset
+    return DatasetLoader(config['dataset_excel_path'], config['cache_path']).load(stop=num_records)
+
+def load_shared_artifacts():
+    """
+    Returns everything that does not depend on the experiment: the database engine,
+    the reflected schema and table info, the dataset and the expected query results.
+    Each artifact is only built when an experiment first uses it.
+    """
+    return LazyResources(
+        # Connect to the SQLite database using SQLAlchemy
+        engine=lambda artifacts: create_engine(connection_string),
+
+        # Pool of read-only connections used to execute the expected and inferred queries
+        sql_executor=lambda artifacts: SQLExecutor(artifacts['engine'].url.database, sql_workers, sql_timeout_s,
+                                                   sql_max_rows, sql_max_bytes),
+
+        # Tables, creation statements and sample rows, reflected only when the database changes
+        schema_snapshot=lambda artifacts: load_schema_snapshot(artifacts['engine'], config['cache_path']),
+        tables=lambda artifacts: format_tables(artifacts['schema_snapshot']),
+        dialect=lambda artifacts: artifacts['schema_snapshot']['dialect'],
+        schema=lambda artifacts: format_schema(artifacts['schema_snapshot']),
+        table_info=lambda artifacts: format_table_info(artifacts['schema_snapshot']),
+        schema_linker=lambda artifacts: SchemaLinker(artifacts['schema_snapshot'], schema_linking_top_k)
+        if schema_linking_top_k else None,
+
+        # Extract NLQs and SQL queries from the dataset
+        dataset=load_dataset,
+        nlq_values=lambda artifacts: artifacts['dataset']['nlq'],
+        sql_values=lambda artifacts: normalize_sql(artifacts['dataset']['sql']),
+
+        # Load the expected query results, computed once per dataset and database file
+        expected_results=lambda artifacts: load_gold_results(artifacts['sql_values'], artifacts['engine'].url.database,
+                                                             config['cache_path'], artifacts['sql_executor'].execute,
+                                                             gold_warm_runs)
+    )
+
+def make_prompt_assembler(id_experiment, artifacts):
+    # Prompt template for generating SQL queries, its static prefix is rendered only once
+    schema_linker = artifacts['schema_linker']
+    return PromptAssembler(prompts[experiments[id_experiment]["prompt"]], prompt_layout,
+                           schema_linker.prompt_context if schema_linker is not None else None,
+                           dialect=artifacts['dialect'], tables=artifacts['tables'],
+                           schema=artifacts['schema'], table_info=artifacts['table_info'])
+
+def pending_prompts(model_name, prompt_assembler, nlq_values, completed):
+    """
+    Returns the completions found in the response cache and the prompts still to be sent,
+    both keyed by (NLQ index, repetition), skipping the pairs already in the journal.
+    """
+    response_cache = resources['response_cache']
+    cached_completions = {}
+    prompts_to_send = {}
+    for index, nlq in nlq_values.items():
         for i in range(1, num_repetitions + 1):
-            print(f"\rProcessing NLQ {index + 1}/{num_records}, Repetition {i}/{num_repetitions}...", end='', flush=True)
+            if (index, i) in completed:
+                continue
+            messages = prompt_assembler.render(nlq)
+            cached = response_cache.get(model_name, prompt_text(messages), i) if response_cache is not None else None
+            if cached is not None:
+                cached_completions[(index, i)] = cached
+            else:
+                prompts_to_send[(index, i)] = messages
+    return cached_completions, prompts_to_send
+
+def samples_in_one_call(model_name):
+    # Whether the repetitions of an NLQ are requested as `n` completions of a single call to this model
+    return n_sampling and model_name in n_sampling_models and model_name not in models_rejecting_n
+
+def record_rejected_n(model_name, error):
+    # A bad request answering a call with `n`, such as from a model that does not accept it
+    if isinstance(error, BadRequestError) and model_name not in models_rejecting_n:
+        models_rejecting_n.add(model_name)
+        print(f"{model_name} rejected a request with n, its repetitions are sent one call each: {error}")
+
+def run_batch_inferences(batch_prompts, show_progress=True):
+    """
+    Sends the prompts of one or more experiments as a single Batch API job.
+    `batch_prompts` maps each experiment ID to (model name, prompts keyed by (NLQ index, repetition)).
+    Returns the completions of each experiment keyed by (NLQ index, repetition); requests that
+    failed in the batch are left out and sent one at a time when the experiment runs.
+    """
+    # With n sampling, one request per NLQ asks for the completions of all its pending repetitions
+    groups = {id_experiment: group_samples(prompts_to_send) if samples_in_one_call(model_name) else None
+              for id_experiment, (model_name, prompts_to_send) in batch_prompts.items()}
+    requests = {}
+    for id_experiment, (model_name, prompts_to_send) in batch_prompts.items():
+        if groups[id_experiment] is None:
+            requests.update({make_custom_id(id_experiment, index, i): (model_name, messages)
+                             for (index, i), messages in prompts_to_send.items()})
+        else:
+            requests.update({make_custom_id(id_experiment, index, i): (model_name, messages, len(repetitions))
+                             for (index, i), (messages, repetitions) in groups[id_experiment].items()})
+    if not requests:
+        return {id_experiment: {} for id_experiment in batch_prompts}
+
+    if show_progress:
+        print(f"Submitting {len(requests)} inferences as a batch job...")
+    completions, failures = run_batch(requests, config['cache_path'] + 'batches/', batch_poll_interval_s, show_progress)
+    if failures and show_progress:
+        print(f"{len(failures)} batch requests failed and will be sent one at a time")
+
+    response_cache = resources['response_cache']
+    batch_completions = {id_experiment: {} for id_experiment in batch_prompts}
+    for custom_id, (completion, inf_time_ms) in completions.items():
+        id_experiment, index, i = parse_custom_id(custom_id)
+        model_name, prompts_to_send = batch_prompts[id_experiment]
+        if groups[id_experiment] is None:
+            samples = {(index, i): (completion, inf_time_ms)}
+        else:
+            samples = spread_samples({(index, i): (completion, inf_time_ms)}, groups[id_experiment])
+        for key, (sample, sample_time_ms) in samples.items():
+            batch_completions[id_experiment][key] = (sample, sample_time_ms)
+            if response_cache is not None:
+                response_cache.put(model_name, prompt_text(prompts_to_send[key]), key[1], sample, sample_time_ms)
+    return batch_completions
+
+# Function to generate a completion and measure the inference time
+def generate_completion(model_name, messages, precomputed, key, tracer=NullTracer(), precomputed_stats=None):
+    """
+    Returns (completion, inference time in ms, request stats) for the (NLQ index, repetition) `key`.
+    Completions produced beforehand and cached ones are reused, others are sent through the request
+    layer, which raises RequestFailed when the API still fails after the retries.
+    """
+    # Stats of the attempts the async engine already made for this key
+    stats = precomputed_stats.pop(key, None) if precomputed_stats is not None else None
+
+    # Reuse the completion produced by the async engine when available
+    if key in precomputed:
+        return (*precomputed.pop(key), stats or new_call_stats())
+
+    # Replay the completion from the cache when available
+    repetition = key[1]
+    prompt_completed = prompt_text(messages)
+    response_cache = resources['response_cache']
+    if response_cache is not None:
+        with tracer.span('response_cache_get', index=key[0], repetition=repetition):
+            cached = response_cache.get(model_name, prompt_completed, repetition)
+        if cached is not None:
+            return (*cached, stats or new_call_stats())
+
+    # One attempt, the request layer retries it when it fails
+    def send():
+        with tracer.span('api_call', index=key[0], repetition=repetition) as span:
+            start_time = time.perf_counter()
+            completion = resources['client'].chat.completions.create(model=model_name,messages=messages)
+            end_time = time.perf_counter()
+            span.update(usage_attributes(completion))
+        return completion, (end_time - start_time) * 1000  # Convert to milliseconds
 
-            # Complete the prompt with dialect and table names
-            prompt_completed = prompt_to_use.format(dialect=dialect, tables=tables, nlq=nlq, schema=schema, table_info=table_info)
-            
-            # Initialize retry counter
-            retries = 0
-
-            while retries < max_retries:
-                # Generate content using the prompt and measure time
-                start_time = time.perf_counter()
-                completion = client.chat.completions.create(model=model_name,messages=[{"role": "user", "content": prompt_completed}])
-                end_time = time.perf_counter()
-                inf_time_ms = (end_time - start_time) * 1000  # Convert to milliseconds
-                response = str(completion.choices[0].message.content)
-
-                # Add inference time delay
-                time.sleep(time_delay_between_inferences)
+    try:
+        (completion, inf_time_ms), call_stats = resources['request_layer'].call(model_name, send)
+    except RequestFailed as e:
+        e.stats = combine_call_stats(stats, e.stats)
+        raise
+
+    if response_cache is not None:
+        with tracer.span('response_cache_put', index=key[0], repetition=repetition):
+            response_cache.put(model_name, prompt_completed, repetition, completion, inf_time_ms)
+
+    return completion, inf_time_ms, combine_call_stats(stats, call_stats)
+
+def generate_samples(model_name, messages, keys, tracer=NullTracer()):
+    """
+    Returns the completions and request stats of the (NLQ index, repetition) `keys` of one NLQ,
+    replayed from the cache or sampled as `n` completions of a single call. When the call still
+    fails after its retries or is rejected, only the cached ones are returned and the others are
+    later sent one at a time, with the stats of the failed call recorded on the first of them.
+    """
+    prompt_completed = prompt_text(messages)
+    response_cache = resources['response_cache']
+    completions = {}
+    missing = []
+    for key in keys:
+        cached = response_cache.get(model_name, prompt_completed, key[1]) if response_cache is not None else None
+        if cached is not None:
+            completions[key] = cached
+        else:
+            missing.append(key)
+    if not missing:
+        return completions, {}
+
+    # One attempt asking for every missing repetition, the request layer retries it when it fails
+    def send():
+        with tracer.span('api_call', index=missing[0][0], repetition=missing[0][1], n=len(missing)) as span:
+            start_time = time.perf_counter()
+            completion = resources['client'].chat.completions.create(model=model_name, messages=messages, n=len(missing))
+            end_time = time.perf_counter()
+            span.update(usage_attributes(completion))
+        return completion, (end_time - start_time) * 1000  # Convert to milliseconds
+
+    groups = {missing[0]: (messages, [key[1] for key in missing])}
+    try:
+        (completion, inf_time_ms), call_stats = resources['request_layer'].call(model_name, send)
+    except RequestFailed as e:
+        record_rejected_n(model_name, e.__cause__)
+        return completions, {missing[0]: e.stats}
+
+    samples = spread_samples({missing[0]: (completion, inf_time_ms)}, groups)
+    if response_cache is not None:
+        for key, (sample, sample_time_ms) in samples.items():
+            response_cache.put(model_name, prompt_completed, key[1], sample, sample_time_ms)
+    completions.update(samples)
+    return completions, spread_stats({missing[0]: call_stats}, groups)
+
+# Files written by each shard of an experiment, concatenated when the shards are merged
+shard_files = ('_journal.jsonl', '_log.txt', '_trace.jsonl', '_calls.jsonl')
+
+def shard_name(nlq_range):
+    return f"_shard_{nlq_range[0]}_{nlq_range[1]}"
+
+def make_tracer(path, resume):
+    return Tracer(path, resume) if trace_stages else NullTracer()
+
+def export_findings(experiment_name, summary_table, tracer=NullTracer()):
+    # With n sampling, the findings also hold the answer chosen by majority vote among the samples
+    if n_sampling and num_repetitions > 1:
+        with tracer.span('majority_vote', rows=len(summary_table)):
+            summary_table = add_majority_vote(summary_table, to_long(summary_table, num_repetitions))
+
+    # Export the DataFrame to Parquet and optionally to a new Excel file
+    with tracer.span('write_findings', rows=len(summary_table)):
+        output_path = write_findings(summary_table, config['output_path'], experiment_name, num_repetitions, store_result_sets)
+    if export_excel:
+        with tracer.span('write_excel', rows=len(summary_table)):
+            summary_table.to_excel(config['output_path'] + experiment_name + '_res.xlsx', index=False)
+    return output_path
+
+def write_trace_summary(trace_path, log_file_path, show_progress=False):
+    # Summary of where the time of the experiment went, from its spans
+    if not trace_stages or not os.path.exists(trace_path):
+        return
+    trace_summary = format_trace_summary(summarize_trace(trace_path))
+    with open(log_file_path, 'a') as log_file:
+        log_file.write(f"\n{trace_summary}\n")
+    if show_progress:
+        print(trace_summary)
+
+def merge_shards(id_experiment, nlq_ranges):
+    """
+    Merges the journals and logs of the shards of an experiment, in the order of their NLQs,
+    into the journal, log and findings of a single-process run. Returns the findings path.
+    """
+    experiment_name = experiments[id_experiment]["name"]
+    prefix = config['output_path'] + experiment_name
+    shard_prefixes = [prefix + shard_name(nlq_range) for nlq_range in sorted(nlq_ranges)]
+
+    for suffix in shard_files:
+        with open(prefix + suffix, 'w', encoding='utf-8') as merged:
+            for shard_prefix in shard_prefixes:
+                if os.path.exists(shard_prefix + suffix):
+                    with open(shard_prefix + suffix, 'r', encoding='utf-8') as f:
+                        shutil.copyfileobj(f, merged)
+
+    journal = ResultJournal(prefix + '_journal.jsonl', resume=True)
+    journal.close()
+    tracer = make_tracer(prefix + '_trace.jsonl', resume=True)
+    output_path = export_findings(experiment_name, journal.to_dataframe(), tracer)
+    tracer.close()
+    with open(prefix + '_log.txt', 'a') as log_file:
+        log_file.write(f"Shards merged: {len(shard_prefixes)}\n")
+    write_trace_summary(prefix + '_trace.jsonl', prefix + '_log.txt')
+    with open(prefix + '_log.txt', 'a') as log_file:
+        log_file.write(f"Experiment ended at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+    for shard_prefix in shard_prefixes:
+        for suffix in shard_files:
+            if os.path.exists(shard_prefix + suffix):
+                os.remove(shard_prefix + suffix)
+    return output_path
+
+def run_experiment(id_experiment, artifacts, rate_share=1.0, show_progress=True, resume=False, precomputed=None,
+                   nlq_range=None):
+    """
+    Runs a single experiment against the shared artifacts and writes its log and results.
+    `rate_share` is the fraction of the per-minute limits available to this experiment
+    when several experiments use the same model at once.
+    With `resume`, the (NLQ, repetition) pairs already in the journal are skipped.
+    `precomputed` holds completions keyed by (NLQ index, repetition) produced beforehand,
+    such as the results of a batch job shared by several experiments.
+    With `nlq_range` = (start, stop), only the NLQs at those positions of the dataset are run,
+    as a shard with its own journal and log, and the journal path is returned instead of the findings.
+    """
+    experiment_name = experiments[id_experiment]["name"]
+    shard_suffix = shard_name(nlq_range) if nlq_range is not None else ''
+    log_file_path = config['output_path'] + experiment_name + shard_suffix + '_log.txt'
+    journal_path = config['output_path'] + experiment_name + shard_suffix + '_journal.jsonl'
+    trace_path = config['output_path'] + experiment_name + shard_suffix + '_trace.jsonl'
+    calls_path = config['output_path'] + experiment_name + shard_suffix + '_calls.jsonl'
+
+    # Configuration from JSON
+    model_name = config[experiments[id_experiment]["model"]]
+
+    prompt_assembler = make_prompt_assembler(id_experiment, artifacts)
+
+    sql_executor = artifacts['sql_executor']
+    response_cache = resources['response_cache']
+    nlq_values = artifacts['nlq_values']
+    sql_values = artifacts['sql_values']
+    if nlq_range is not None:
+        nlq_values = nlq_values.iloc[nlq_range[0]:nlq_range[1]]
+        sql_values = sql_values.iloc[nlq_range[0]:nlq_range[1]]
+
+    # Completions produced ahead of time by the async engine or a batch job, keyed by (NLQ index, repetition),
+    # and the stats of the requests the async engine sent
+    async_completions = dict(precomputed) if precomputed is not None else {}
+    async_stats = {}
+
+    # Results are streamed to the journal after each NLQ and repetition
+    journal = ResultJournal(journal_path, resume)
+    completed = journal.completed()
+
+    # Spans of each stage of the experiment
+    tracer = make_tracer(trace_path, resume)
+
+    # Fields of every completion, with the hash of its prompt
+    call_log = CallLog(calls_path, resume)
+
+    # Prompt tokens sent and prompt tokens served from the provider cache
+    total_prompt_tokens = 0
+    total_cached_tokens = 0
+
+    # Estimated prompt tokens with the whole schema and with the tables given by schema linking
+    full_schema_tokens = 0
+    linked_schema_tokens = 0
+
+    # Open a log file to record details of the experiment
+    with open(log_file_path, 'a' if resume else 'w') as log_file, \
+            tracer.span('experiment', id_experiment=id_experiment, nlq_range=nlq_range):
+        if resume and completed:
+            log_file.write(f"Experiment resumed with {len(completed)} journal entries\n")
+        log_file.write(f"Experiment started at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        log_file.write(f"Experiment ID: {id_experiment}\n")
+        log_file.write(f"Experiment name: {experiment_name}\n")
+        log_file.write(f"Model used: {model_name}\n")
+        log_file.write(f"Number of records: {num_records}\n")
+        log_file.write(f"Number of repetitions: {num_repetitions}\n")
+        if nlq_range is not None:
+            log_file.write(f"Shard NLQs: {nlq_range[0]}-{nlq_range[1]}\n")
+        log_file.write("\n")
+
+        print(f"Running experiment {id_experiment}: {experiment_name}")
+
+        if precomputed is None and execution_mode == 'batch':
+            # Send every inference as a batch job before executing the queries
+            with tracer.span('pending_prompts'):
+                cached_completions, batch_prompts = pending_prompts(model_name, prompt_assembler, nlq_values, completed)
+            async_completions.update(cached_completions)
+            with tracer.span('batch_inferences', requests=len(batch_prompts)):
+                async_completions.update(run_batch_inferences({id_experiment: (model_name, batch_prompts)}, show_progress)[id_experiment])
+
+        if precomputed is None and execution_mode == 'async':
+            # Run every inference concurrently before executing the queries
+            with tracer.span('pending_prompts'):
+                cached_completions, async_prompts = pending_prompts(model_name, prompt_assembler, nlq_values, completed)
+            async_completions.update(cached_completions)
+
+            if show_progress:
+                print(f"Running {len(async_prompts)} inferences with up to {max_concurrency} concurrent requests...")
+
+            # With n sampling, one request per NLQ asks for the completions of all its pending repetitions
+            in_one_call = samples_in_one_call(model_name)
+            groups = group_samples(async_prompts) if in_one_call else None
+            requests = {key: messages for key, (messages, _) in groups.items()} if in_one_call else async_prompts
+            samples = {key: len(repetitions) for key, (_, repetitions) in groups.items()} if in_one_call else None
+
+            # Store each completion in the cache as soon as it arrives
+            def cache_completion(key, completion, inf_time_ms):
+                if response_cache is None:
+                    return
+                repetitions = split_choices(completion, groups[key][1]) if in_one_call else {key[1]: completion}
+                for repetition, sample in repetitions.items():
+                    response_cache.put(model_name, prompt_text(requests[key]), repetition, sample, inf_time_ms)
+
+            request_stats = {}
+            request_errors = {}
+            with tracer.span('async_inferences', requests=len(requests)):
+                results = run_inferences(model_name, requests, max_concurrency,
+                                         requests_per_minute * rate_share, tokens_per_minute * rate_share,
+                                         cache_completion, tracer, resources['request_layer'], request_stats,
+                                         request_timeout_s, samples, request_errors)
+            async_completions.update(spread_samples(results, groups) if in_one_call else results)
+            async_stats.update(spread_stats(request_stats, groups) if in_one_call else request_stats)
+            # The repetitions of rejected calls are then sent one at a time
+            if in_one_call:
+                for error in request_errors.values():
+                    record_rejected_n(model_name, error)
+
+        # Iterate over each row in the DataFrame
+        for index, nlq, sql in zip(nlq_values.index, nlq_values, sql_values):
+            if show_progress:
+                print(f"\rProcessing NLQ {index + 1}/{num_records}...", end='', flush=True)
+
+            # Tables given in the prompt of this NLQ and the prompt tokens saved by schema linking
+            schema_linker = artifacts['schema_linker']
+            if schema_linker is not None:
+                with tracer.span('schema_linking', index=index):
+                    linked_tables = {'linked_tables': ', '.join(schema_linker.link(nlq))}
+                    full_schema_tokens += prompt_tokens_estimate(prompt_assembler.render(nlq, use_nlq_context=False)) * num_repetitions
+                    linked_schema_tokens += prompt_tokens_estimate(prompt_assembler.render(nlq)) * num_repetitions
+            else:
+                linked_tables = {}
+
+            # Record the result of the expected SQL query
+            if (index, 0) not in completed:
+                exp_result, exp_error, exp_time = artifacts['expected_results'][index]
+                with tracer.span('journal_write', index=index, repetition=0):
+                    journal.write_expected(index, {
+                        'nlq': nlq,
+                        'exp_sql': sql,
+                        'exp_response': exp_result if store_result_sets else None,
+                        'exp_error': exp_error,
+                        'exp_time_ms': exp_time,
+                        **linked_tables,
+                        **fingerprint_columns('exp', exp_result)
+                    })
+
+            # With n sampling, the repetitions of this NLQ still without a completion are sampled in one call
+            if samples_in_one_call(model_name):
+                keys = [(index, i) for i in range(1, num_repetitions + 1)
+                        if (index, i) not in completed and (index, i) not in async_completions]
+                if len(keys) > 1:
+                    with tracer.span('sample_inferences', index=index, samples=len(keys)):
+                        sampled, sampled_stats = generate_samples(model_name, prompt_assembler.render(nlq), keys, tracer)
+                    async_completions.update(sampled)
+                    for key, call_stats in sampled_stats.items():
+                        async_stats[key] = combine_call_stats(async_stats.get(key), call_stats)
+
+            # Inferred queries of this NLQ, executed concurrently on the SQL pool
+            pending_executions = {}
+
+            # Repeat the inference and execution process
+            for i in range(1, num_repetitions + 1):
+                if (index, i) in completed:
+                    continue
+
+                if show_progress:
+                    print(f"\rProcessing NLQ {index + 1}/{num_records}, Repetition {i}/{num_repetitions}...", end='', flush=True)
+
+                # Complete the prompt with the NLQ
+                with tracer.span('render_prompt', index=index, repetition=i):
+                    messages = prompt_assembler.render(nlq)
 
                 try:
-                    # Extract inferred SQL query without `sql` at the beginning and end, and without consecutive spaces
-                    inferred_sql = response.strip().replace('\n', ' ')
-
-                    # Remove backticks, 'sql', 'sqlite', and extra spaces
-                    inferred_sql = re.sub(r'[`]+', '', inferred_sql)
-                    inferred_sql = re.sub(r'\bsql\b', '', inferred_sql)
-                    inferred_sql = re.sub(r'\bsqlite\b', '', inferred_sql)
-
-                    # Remove extra spaces and double semicolons
-                    inferred_sql = re.sub(r'\s+', ' ', inferred_sql).strip()
-                    inferred_sql = re.sub(r';\s*;', ';', inferred_sql)
-                    break  # Exit the loop if a valid value is obtained
-
-                except ValueError as e:
-                    # Increment retry counter
-                    retries += 1
-                    # Add retry time delay
-                    time.sleep(time_delay_between_retries)
-
-            # If no valid value is obtained after the retries, assign an error message
-            if retries == max_retries:
-                inferred_sql = "Error: No valid SQL generated."
-            
-            # Execute the inferred SQL query and get the result
-            inf_result, inf_error, inf_exec_time_ms = execute_query(inferred_sql, engine)
-            
-            # Add inferred SQL and results to the entry
-            result_entry.update({
-                f'inf_sql_{i}': inferred_sql,
-                f'inf_response_{i}': inf_result,
-                f'inf_error_{i}': inf_error,
-                f'inf_time_ms_{i}': inf_time_ms,
-                f'inf_exec_time_ms_{i}': inf_exec_time_ms
-            })
-        
-        results.append(result_entry)
-
-    # Call the function to get the formatted text
-    pretty_completion_text = extract_and_format(str(completion))
-    log_file.write(f"NLQ: {nlq}\n\n")
-    log_file.write(f"Prompt: {prompt_completed}\n\n")
-    log_file.write(f"{pretty_completion_text}\n\n")
-
-# Create a DataFrame with the results
-summary_table = pd.DataFrame(results)
-
-# Export the DataFrame to a new Excel file
-summary_table.to_excel(output_excel_path, index=False)
-print("\nSuccessful experiment...")
-
-# Log the end time of the experiment
-with open(log_file_path, 'a') as log_file:
-    log_file.write(f"Experiment ended at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+                    # Generate content using the prompt and measure time, failed API calls are retried by the request layer
+                    with tracer.span('inference', index=index, repetition=i) as span:
+                        completion, inf_time_ms, call_stats = generate_completion(model_name, messages, async_completions, (index, i),
+                                                                                  tracer, async_stats)
+                        # The tokens are recorded on the api_call span of the request, so they are counted once
+                        span.update(inf_time_ms=inf_time_ms, attempts=call_stats['attempts'])
+                except RequestFailed as e:
+                    completion, inf_time_ms, call_stats = None, None, e.stats
+
+                if completion is not None:
+                    with tracer.span('call_log_write', index=index, repetition=i):
+                        call_log.write(call_record(index, i, model_name, messages, completion, inf_time_ms))
+                    response = str(completion.choices[0].message.content)
+
+                    with tracer.span('sql_postprocess', index=index, repetition=i):
+                        # Extract the first SQL statement of the response on a single line
+                        inferred_sql = extract_sql(response)
+
+                    # Record the prompt tokens and the prompt tokens served from the provider cache
+                    prompt_tokens, cached_tokens = usage_tokens(completion)
+                    total_prompt_tokens += prompt_tokens or 0
+                    total_cached_tokens += cached_tokens or 0
+                else:
+                    # The API still failed after the retries, the error is kept in inf_api_error
+                    inferred_sql = "Error: No valid SQL generated."
+                    prompt_tokens, cached_tokens = None, None
+
+                # Submit the inferred SQL query for execution
+                pending_executions[i] = (inferred_sql, inf_time_ms, prompt_tokens, cached_tokens, call_stats,
+                                         sql_executor.submit(inferred_sql))
+
+            for i, (inferred_sql, inf_time_ms, prompt_tokens, cached_tokens, call_stats, execution) in pending_executions.items():
+                # Get the result of the inferred SQL query
+                with tracer.span('sql_wait', index=index, repetition=i) as span:
+                    inf_result, inf_error, inf_exec_time_ms = execution.result()
+                    span['exec_time_ms'] = inf_exec_time_ms
+
+                # Add inferred SQL and results to the journal
+                with tracer.span('journal_write', index=index, repetition=i):
+                    journal.write_repetition(index, i, {
+                        'inf_sql': inferred_sql,
+                        'inf_response': inf_result if store_result_sets else None,
+                        'inf_error': inf_error,
+                        'inf_time_ms': inf_time_ms,
+                        'inf_exec_time_ms': inf_exec_time_ms,
+                        'inf_prompt_tokens': prompt_tokens,
+                        'inf_cached_tokens': cached_tokens,
+                        'inf_attempts': call_stats['attempts'],
+                        'inf_backoff_ms': call_stats['backoff_ms'],
+                        'inf_hedged': call_stats['hedged'],
+                        'inf_api_error': call_stats['api_error'],
+                        **fingerprint_columns('inf', inf_result)
+                    })
+
+        # Every completion is in the call log, the last one is also written here
+        call_log.close()
+        log_file.write(f"Calls logged: {call_log.calls} in {calls_path}\n\n")
+        if call_log.last_record is not None:
+            log_file.write(f"Last call, NLQ {call_log.last_record['index']} repetition {call_log.last_record['repetition']}:\n")
+            log_file.write(f"{format_call(call_log.last_record)}\n\n")
+
+        if response_cache is not None:
+            log_file.write(f"{response_cache.format_stats()}\n\n")
+        if 'request_layer' in resources.built():
+            log_file.write(f"{resources['request_layer'].format_stats()}\n\n")
+        if n_sampling and model_name in models_rejecting_n:
+            log_file.write(f"{model_name} rejected n, its repetitions were sent one call each\n\n")
+
+        cached_share = round(total_cached_tokens / total_prompt_tokens * 100, 2) if total_prompt_tokens else 0.0
+        log_file.write(f"Prompt layout: {prompt_layout}\n")
+        log_file.write(f"Prompt tokens: {total_prompt_tokens}, cached prompt tokens: {total_cached_tokens} ({cached_share}%)\n\n")
+
+        if artifacts['schema_linker'] is not None:
+            saved_share = round((full_schema_tokens - linked_schema_tokens) / full_schema_tokens * 100, 2) if full_schema_tokens else 0.0
+            log_file.write(f"Schema linking: top {schema_linking_top_k} tables per NLQ\n")
+            log_file.write(f"Estimated prompt tokens: {full_schema_tokens} with the whole schema, {linked_schema_tokens} with the linked tables "
+                           f"({full_schema_tokens - linked_schema_tokens} saved, {saved_share}%)\n\n")
+
+    journal.close()
+    if nlq_range is not None:
+        # The findings are written once every shard is merged
+        tracer.close()
+        with open(log_file_path, 'a') as log_file:
+            log_file.write(f"Shard ended at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        return journal_path
+
+    # Create a DataFrame with the results from the journal
+    with tracer.span('build_findings'):
+        summary_table = journal.to_dataframe()
+    output_path = export_findings(experiment_name, summary_table, tracer)
+    tracer.close()
+    if show_progress:
+        print("\nSuccessful experiment...")
+        if response_cache is not None:
+            print(response_cache.format_stats())
+    write_trace_summary(trace_path, log_file_path, show_progress)
+
+    # Log the end time of the experiment
+    with open(log_file_path, 'a') as log_file:
+        log_file.write(f"Experiment ended at: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+    return output_path
+
+def run_experiments(ids_experiments, artifacts, num_workers=1, resume=False, batch=False):
+    """
+    Runs several experiments on the same shared artifacts, `num_workers` of them at the same time.
+    Experiments sharing a model split its per-minute limits. With `batch`, the inferences of
+    every experiment are first sent as a single Batch API job.
+    Returns the findings path of each experiment, or the exception that stopped it.
+    """
+    # Experiments sharing a model split its per-minute limits between them
+    experiments_per_model = Counter(experiments[id_experiment]["model"] for id_experiment in ids_experiments)
+
+    def rate_share(id_experiment):
+        return 1.0 / min(num_workers, experiments_per_model[experiments[id_experiment]["model"]])
+
+    # In batch mode the inferences of all the experiments are sent in one job before running them
+    precomputed = {id_experiment: None for id_experiment in ids_experiments}
+    if batch or execution_mode == 'batch':
+        batch_prompts = {}
+        for id_experiment in ids_experiments:
+            model_name = config[experiments[id_experiment]["model"]]
+            journal_path = config['output_path'] + experiments[id_experiment]["name"] + '_journal.jsonl'
+            completed = journal_completed(journal_path) if resume else set()
+            cached_completions, prompts_to_send = pending_prompts(model_name, make_prompt_assembler(id_experiment, artifacts),
+                                                                  artifacts['nlq_values'], completed)
+            precomputed[id_experiment] = cached_completions
+            batch_prompts[id_experiment] = (model_name, prompts_to_send)
+
+        for id_experiment, batch_completions in run_batch_inferences(batch_prompts).items():
+            precomputed[id_experiment].update(batch_completions)
+
+    # A single experiment shows its progress
+    show_progress = len(ids_experiments) == 1
+
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(run_experiment, id_experiment, artifacts, rate_share(id_experiment), show_progress, resume,
+                            precomputed[id_experiment]): id_experiment
+            for id_experiment in ids_experiments
+        }
+
+        # Each experiment writes its own results file as soon as it finishes
+        for future in as_completed(futures):
+            id_experiment = futures[future]
+            try:
+                outcomes[id_experiment] = future.result()
+                print(f"Experiment {id_experiment} finished: {outcomes[id_experiment]}")
+            except Exception as e:
+                outcomes[id_experiment] = e
+                print(f"Experiment {id_experiment} failed: {e}")
+    return outcomes
+
+def add_run_arguments(parser):
+    parser.add_argument('--records', type=int, default=num_records, help='number of NLQs of the dataset to run')
+    parser.add_argument('--repetitions', type=int, default=num_repetitions, help='inferences of each NLQ')
+    parser.add_argument('--resume', action='store_true', help='skip the NLQs and repetitions already in the journal')
+    parser.add_argument('--batch', action='store_true', help='send every inference as a single Batch API job')
+
+def apply_run_arguments(args):
+    # The dataset is read on first use, after these settings are applied
+    global num_records, num_repetitions
+    num_records = args.records
+    num_repetitions = args.repetitions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Text-to-SQL experiments.')
+    parser.add_argument('--experiment', nargs='+', default=[id_experiment],
+                        help='IDs of the experiments to run, "all" for every experiment in experiments.py')
+    parser.add_argument('--workers', type=int, default=1, help='experiments running at the same time')
+    add_run_arguments(parser)
+    args = parser.parse_args(argv)
+    apply_run_arguments(args)
+
+    ids_experiments = list(experiments.keys()) if args.experiment == ['all'] else args.experiment
+    run_experiments(ids_experiments, load_shared_artifacts(), args.workers, args.resume, args.batch)
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,78 @@
-import pandas as pd
+import io
+import os
 import glob
+import json
+import html
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import matplotlib
+# Figures are only saved to files, the Agg backend needs no display and is the same in every worker
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+from experiments import experiments
+from analysis.metrics_store import MetricsStore
 
 # Parametrize paradigm and experiment names
 paradigm = 'Prompt Engineering'
 
-def read_experiment_metrics(directory, experiment_name):
-    """
-    Reads the metrics of a specific experiment from Excel files in a directory.
-    Returns a DataFrame with the organized metrics.
-    """
-    excel_files = glob.glob(f'{directory}/*{experiment_name}*.xlsx')
-    
-    dfs = []
-    for file in excel_files:
-        df = pd.read_excel(file, sheet_name='Summary Metrics', index_col=0)
-        dfs.append(df)
-    
-    return pd.concat(dfs, axis=1)
-
-def plot_and_save(df, experiment_name, metrics, filename):
-    """
-    Creates an individual plot for specific metrics and saves it as an image.
-    """
-    # Create figure and axis
-    fig, ax = plt.subplots(figsize=(6, 5))
-
-    # More vibrant color palette without repetition
-    num_metrics = len(df)
-    colors = sns.color_palette("pastel", n_colors=num_metrics, desat=1)
-    
-    # Bar chart generation
-    df.loc[metrics].plot(kind='bar', rot=45, ax=ax, color=colors, edgecolor='black', linewidth=1)
-    
-    # Title, labels, and axis limits adjustment
-    ax.set_title(f'{experiment_name} - {paradigm}')
-    ax.set_xlabel('')
-    if metrics == ['Average Inference Mean']:
-        ax.set_ylabel('Time (ms)')
-    else:
-        ax.set_ylabel('Percentage (%)')
+# Processes drawing the figures, and output format: 'png' or 'svg' files, or 'html' for one report with every figure
+num_plot_workers = 4
+output_format = 'png'
 
-    ax.grid(True, axis='y', linestyle='--', alpha=0.7)
-    
-    # Set max y-axis limit to 100 for percentage metrics
-    if metrics == ['Average Inference Mean']:
-        ax.set_ylim(0, 4600)
-    else:
-        ax.set_ylim(0, 100)
-    
-    # Save the image with tight layout
-    plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close(fig)  # Close the figure to free up memory
+def import_summaries(store, directory):
+    """
+    Adds to the metrics store the experiments analyzed before it existed, read from
+    their Parquet summaries or from the 'Summary Metrics' sheet of their Excel analysis.
+    """
+    names = {experiment["name"]: id_experiment for id_experiment, experiment in experiments.items()}
+    stored = set(store.experiments())
+    for name, id_experiment in names.items():
+        if id_experiment in stored:
+            continue
+        summary_files = glob.glob(f'{directory}/{name}_summary.parquet')
+        if summary_files:
+            summary = pd.read_parquet(summary_files[0])
+        else:
+            excel_files = glob.glob(f'{directory}/{name}_analysis.xlsx')
+            if not excel_files:
+                continue
+            summary = pd.read_excel(excel_files[0], sheet_name='Summary Metrics', index_col=0)
+        store.upsert_experiment(id_experiment, name, summary.iloc[:, 0].to_dict())
+        print(f"Imported the summary metrics of {name}")
+
+def figure_job(df, colors, title, metrics_list, filename):
+    """
+    Returns the inputs of a figure with one bar chart per list of metrics: the title, the rows
+    of `df` of each chart, the palette and the file to save it to. Only these rows are sent
+    to the process drawing the figure.
+    """
+    panels = [(metrics, df.loc[metrics]) for metrics in metrics_list]
+    return {'title': title, 'panels': panels, 'colors': colors, 'filename': filename}
 
-def plot_comparison_subplot(df, experiment_name, metrics_list, filename):
+def figure_hash(job, image_format):
     """
-    Creates subplots for multiple metrics and saves them as an image.
+    Returns a hash of everything a figure is drawn from: its title, metrics, values, palette and format.
     """
-    # Create figure and axes
-    fig, axs = plt.subplots(nrows=1, ncols=3, figsize=(18, 5))
+    content = json.dumps([paradigm, job['title'], image_format, job['colors'],
+                          [(metrics, data.to_json(orient='split')) for metrics, data in job['panels']]])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-    for ax, metrics in zip(axs, metrics_list):
-        # More vibrant color palette without repetition
-        num_metrics = len(df)
-        colors = sns.color_palette("pastel", n_colors=num_metrics, desat=1)
+def draw_figure(job):
+    """
+    Draws the bar charts of a figure side by side and returns the figure.
+    """
+    panels = job['panels']
+    fig, axs = plt.subplots(nrows=1, ncols=len(panels), figsize=(6 * len(panels), 5), squeeze=False)
 
+    for ax, (metrics, data) in zip(axs[0], panels):
         # Bar chart generation
-        df.loc[metrics].plot(kind='bar', rot=45, ax=ax, color=colors, edgecolor='black', linewidth=1)
+        data.plot(kind='bar', rot=45, ax=ax, color=job['colors'], edgecolor='black', linewidth=1)
 
         # Title, labels, and axis limits adjustment
-        ax.set_title(f'{experiment_name} - {paradigm}')
+        ax.set_title(f"{job['title']} - {paradigm}")
         ax.set_xlabel('')
         if metrics == ['Average Inference Mean']:
             ax.set_ylabel('Time (ms)')
@@ -86,13 +87,50 @@ def plot_comparison_subplot(df, experiment_name, metrics_list, filename):
         else:
             ax.set_ylim(0, 100)
 
-    # Save the image with tight layout
     plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close(fig)  # Close the figure to free up memory
+    return fig
 
-# Directory where the Excel files are located
-directory = 'results'
+def render_figure(job, image_format):
+    """
+    Draws a figure and saves it to its file, or returns it as SVG markup for the HTML report.
+    Runs in the worker processes.
+    """
+    fig = draw_figure(job)
+    try:
+        if image_format == 'html':
+            buffer = io.StringIO()
+            fig.savefig(buffer, format='svg', bbox_inches='tight')
+            return buffer.getvalue()
+        fig.savefig(job['filename'], format=image_format, bbox_inches='tight')
+        return job['filename']
+    finally:
+        plt.close(fig)  # Close the figure to free up memory
+
+def render_figures(jobs, image_format, num_workers=num_plot_workers):
+    """
+    Renders the figures on a pool of `num_workers` processes, in the order of `jobs`.
+    """
+    if num_workers <= 1 or len(jobs) <= 1:
+        return [render_figure(job, image_format) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs))) as executor:
+        return list(executor.map(render_figure, jobs, [image_format] * len(jobs)))
+
+def write_report(path, sections, figures):
+    """
+    Writes a single HTML page with the metrics table of each model followed by its figures inlined as SVG.
+    """
+    parts = [f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{html.escape(paradigm)}</title></head><body>",
+             f"<h1>{html.escape(paradigm)}</h1>"]
+    for (title, table, jobs), svgs in zip(sections, figures):
+        parts.append(f"<h2>{html.escape(title)}</h2>")
+        parts.append(table.to_html(float_format='{:.2f}'.format))
+        for job, svg in zip(jobs, svgs):
+            parts.append(f"<h3>{html.escape(job['title'])}</h3>")
+            # Drop the XML prolog of each SVG so it can be inlined
+            parts.append(svg[svg.index('<svg'):])
+    parts.append("</body></html>")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(parts))
 
 # Experiment models to be used as parameters (can be changed)
 short_model_1 = 'gpt35'
@@ -100,35 +138,76 @@ complete_model_1 = 'GPT-3.5 Turbo'
 short_model_2 = 'gpt4o'
 complete_model_2 = 'GPT-4o'
 
-# Read experiment metrics for model_1
-model_1_metrics = read_experiment_metrics(directory, short_model_1)
-print(model_1_metrics)
-
-# Read experiment metrics for model_2
-model_2_metrics = read_experiment_metrics(directory, short_model_2)
-print(model_2_metrics)
-
 # Specific metrics by category
 matches_metrics = ['Average Match SQL (%)', 'Average Match Result (%)', 'Average Match Rows (%)', 'Average Match Columns (%)']
 errors_metrics = ['Average Syntactic Errors (%)', 'Average Semantic Errors (%)', 'Average Unknown Errors (%)', 'Average No Errors (%)']
 times_inferences_metrics = ['Average Inference Mean']
 
-# Save individual plots for model_1
-plot_and_save(model_1_metrics, f'Matches - {complete_model_1}', matches_metrics, f'images/{short_model_1.lower()}_matches.png')
-plot_and_save(model_1_metrics, f'Errors - {complete_model_1}', errors_metrics, f'images/{short_model_1.lower()}_errors.png')
-plot_and_save(model_1_metrics, f'Performance - {complete_model_1}', times_inferences_metrics, f'images/{short_model_1.lower()}_inferences.png')
-
-# Save individual plots for model_2
-plot_and_save(model_2_metrics, f'Matches - {complete_model_2}', matches_metrics, f'images/{short_model_2.lower()}_matches.png')
-plot_and_save(model_2_metrics, f'Errors - {complete_model_2}', errors_metrics, f'images/{short_model_2.lower()}_errors.png')
-plot_and_save(model_2_metrics, f'Performance - {complete_model_2}', times_inferences_metrics, f'images/{short_model_2.lower()}_inferences.png')
-
-# Save subplots for model_1
-plot_comparison_subplot(model_1_metrics, complete_model_1, 
-                        [matches_metrics, errors_metrics, times_inferences_metrics], 
-                        f'images/{short_model_1.lower()}_comparison.png')
-
-# Save subplots for model_2
-plot_comparison_subplot(model_2_metrics, complete_model_2, 
-                        [matches_metrics, errors_metrics, times_inferences_metrics], 
-                        f'images/{short_model_2.lower()}_comparison.png')
+def run_general_analysis(directory='results', force=False, image_format=output_format, num_workers=num_plot_workers):
+    """
+    Compares the summary metrics of the experiments of both models, read from the metrics store,
+    and saves the figures in images/, as PNG or SVG files or as a single images/report.html.
+    Figures are drawn on a pool of processes, and only those whose inputs changed are drawn again, unless `force`.
+    """
+    store = MetricsStore(os.path.join(directory, 'metrics.sqlite'))
+    import_summaries(store, directory)
+
+    sections = []
+    for short_model, complete_model in [(short_model_1, complete_model_1), (short_model_2, complete_model_2)]:
+        # Read experiment metrics for the model
+        model_metrics = store.summary_metrics(name_like=short_model)
+        print(model_metrics)
+        if model_metrics.empty:
+            continue
+
+        # Palette shared by every figure of the model
+        colors = sns.color_palette("pastel", n_colors=len(model_metrics), desat=1)
+
+        # Individual figures and the figure with the three charts side by side
+        prefix = f'images/{short_model.lower()}'
+        extension = 'svg' if image_format == 'svg' else 'png'
+        sections.append((complete_model, model_metrics, [
+            figure_job(model_metrics, colors, f'Matches - {complete_model}', [matches_metrics], f'{prefix}_matches.{extension}'),
+            figure_job(model_metrics, colors, f'Errors - {complete_model}', [errors_metrics], f'{prefix}_errors.{extension}'),
+            figure_job(model_metrics, colors, f'Performance - {complete_model}', [times_inferences_metrics], f'{prefix}_inferences.{extension}'),
+            figure_job(model_metrics, colors, complete_model, [matches_metrics, errors_metrics, times_inferences_metrics],
+                       f'{prefix}_comparison.{extension}')
+        ]))
+
+    os.makedirs('images', exist_ok=True)
+    if image_format == 'html':
+        # The report is written again as a whole when any of its figures or tables changed
+        report_path = 'images/report.html'
+        report_hash = hashlib.sha256(json.dumps(
+            [[title, table.to_json(orient='split'), [figure_hash(job, image_format) for job in jobs]] for title, table, jobs in sections]
+        ).encode('utf-8')).hexdigest()
+        if not force and os.path.exists(report_path) and store.plot_hash(report_path) == report_hash:
+            print(f"Report unchanged: {report_path}")
+        else:
+            jobs = [job for _, _, section_jobs in sections for job in section_jobs]
+            svgs = iter(render_figures(jobs, image_format, num_workers))
+            write_report(report_path, sections, [[next(svgs) for _ in section_jobs] for _, _, section_jobs in sections])
+            store.set_plot_hash(report_path, report_hash)
+            print(f"Report written: {report_path}")
+    else:
+        jobs = [job for _, _, section_jobs in sections for job in section_jobs]
+        hashes = [figure_hash(job, image_format) for job in jobs]
+        changed = [(job, inputs_hash) for job, inputs_hash in zip(jobs, hashes)
+                   if force or not os.path.exists(job['filename']) or store.plot_hash(job['filename']) != inputs_hash]
+        render_figures([job for job, _ in changed], image_format, num_workers)
+        for job, inputs_hash in changed:
+            store.set_plot_hash(job['filename'], inputs_hash)
+        print(f"Plots drawn: {len(changed)}, unchanged: {len(jobs) - len(changed)}")
+    store.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the summary metrics of every analyzed experiment.')
+    # Directory where the metrics store is located
+    parser.add_argument('--directory', default='results')
+    parser.add_argument('--force', action='store_true', help='draw every plot again even if its inputs did not change')
+    parser.add_argument('--format', choices=['png', 'svg', 'html'], default=output_format,
+                        help='PNG or SVG files, or a single HTML report with every figure')
+    parser.add_argument('--workers', type=int, default=num_plot_workers, help='processes drawing the figures')
+    args = parser.parse_args()
+
+    run_general_analysis(args.directory, args.force, args.format, args.workers)
@@ -0,0 +1,27 @@
+import time
+import argparse
+from experiments import experiments
+from run_experiment import (load_shared_artifacts, run_experiments, resources,
+                            add_run_arguments, apply_run_arguments)
+
+# Number of experiments running at the same time
+num_workers = 4
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several Text-to-SQL experiments in one process.')
+    parser.add_argument('ids', nargs='*', help='experiment IDs to run (default: all of them)')
+    parser.add_argument('--workers', type=int, default=num_workers, help='experiments running at the same time')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+    apply_run_arguments(args)
+
+    # Experiments to run, all of them unless IDs are given on the command line
+    ids_experiments = args.ids or list(experiments.keys())
+
+    # The engine, schema, table info, dataset and expected results are built once and shared
+    start_time = time.perf_counter()
+    run_experiments(ids_experiments, load_shared_artifacts(), args.workers, args.resume, args.batch)
+
+    if resources['response_cache'] is not None:
+        print(resources['response_cache'].format_stats())
+    print(f"Sweep finished in {time.perf_counter() - start_time:.2f} s")
@@ -0,0 +1,73 @@
+import time
+import asyncio
+import threading
+from experiment.resilience import AdaptiveConcurrency
+
+def run_queued(concurrency, num_callers, hold_s):
+    # Runs coroutines that each hold a slot for `hold_s`, returns the most slots held at once
+    held = [0, 0]
+
+    async def caller():
+        await concurrency.acquire_async()
+        held[0] += 1
+        held[1] = max(held[1], held[0])
+        await asyncio.sleep(hold_s)
+        held[0] -= 1
+        concurrency.release()
+
+    async def run_all():
+        await asyncio.gather(*(caller() for _ in range(num_callers)))
+
+    asyncio.run(run_all())
+    return held[1]
+
+def test_queued_callers_do_not_spin():
+    concurrency = AdaptiveConcurrency(max_limit=4)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    max_held = run_queued(concurrency, 400, 0.02)
+    wall_s, cpu_s = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    # 100 rounds of 20 ms, the queued callers sleep until a slot is released
+    assert max_held == 4
+    assert concurrency.in_flight == 0 and concurrency.requests == 400
+    assert wall_s >= 2.0
+    assert cpu_s < 0.1 * wall_s
+
+def test_threads_and_coroutines_share_the_limit():
+    concurrency = AdaptiveConcurrency(max_limit=2)
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            concurrency.acquire()
+            time.sleep(0.005)
+            concurrency.release()
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        assert run_queued(concurrency, 50, 0.005) <= 2
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert concurrency.in_flight == 0
+
+def test_cancelled_waiter_passes_its_slot_on():
+    concurrency = AdaptiveConcurrency(max_limit=1)
+
+    async def scenario():
+        await concurrency.acquire_async()
+        first = asyncio.ensure_future(concurrency.acquire_async())
+        second = asyncio.ensure_future(concurrency.acquire_async())
+        await asyncio.sleep(0)
+        # The release wakes the first waiter, which is cancelled before it takes the slot
+        concurrency.release()
+        first.cancel()
+        await asyncio.wait_for(second, timeout=1)
+        concurrency.release()
+
+    asyncio.run(scenario())
+    assert concurrency.in_flight == 0
@@ -0,0 +1,54 @@
+import pandas as pd
+from analysis.fingerprint import fingerprint_columns
+from analysis.long_analysis import RepetitionAnalysis, to_long
+
+# Result recorded for a query that failed
+error_result = [[-1]]
+error_message = "['Execution failed on sql ...: (sqlite3.OperationalError) no such function: YEAR']"
+
+def findings_row(nlq_id, exp, inferences):
+    # `exp` and each inference are (sql, result, error)
+    row = {'nlq_id': nlq_id, 'exp_sql': exp[0], 'exp_error': exp[2], **fingerprint_columns('exp', exp[1])}
+    for i, (sql, result, error) in enumerate(inferences, start=1):
+        row.update({f'inf_sql_{i}': sql, f'inf_error_{i}': error, f'inf_time_ms_{i}': 100.0, f'inf_exec_time_ms_{i}': 1.0,
+                    **fingerprint_columns('inf', result, f'_{i}')})
+    return row
+
+def analyze(rows):
+    analysis = RepetitionAnalysis([1, 3])
+    analysis.add(to_long(pd.DataFrame(rows)))
+    return analysis.nlq_table()
+
+def test_errored_gold_query_counts_as_correct_in_both_columns():
+    failing = ("SELECT YEAR(rental_date) FROM rental;", error_result, error_message)
+    nlqs = analyze([findings_row(0, failing, [failing] * 3)])
+
+    assert nlqs.loc[0, 'match_result_count'] == 3
+    assert nlqs.loc[0, 'vote_match_result']
+    assert nlqs.loc[0, 'vote_share'] == 1.0
+
+def test_majority_vote_agrees_with_match_result():
+    count = ("SELECT COUNT(*) FROM film;", [[1000]], "No error.")
+    wrong = ("SELECT COUNT(*) FROM actor;", [[200]], "No error.")
+    failing = ("SELECT YEAR(rental_date) FROM rental;", error_result, error_message)
+    nlqs = analyze([
+        # The expected query fails and one sample fails as well
+        findings_row(0, failing, [count, failing, wrong]),
+        # Most samples fail, so the failed result wins the vote
+        findings_row(1, count, [failing, count, failing]),
+        # Most samples are correct
+        findings_row(2, count, [count, failing, count]),
+    ])
+
+    assert nlqs['match_result_count'].tolist() == [1, 1, 2]
+    assert nlqs['vote_repetition'].tolist() == [1, 1, 1]
+    assert nlqs['vote_match_result'].tolist() == [False, False, True]
+    assert nlqs['vote_share'].round(2).tolist() == [0.33, 0.67, 0.67]
+
+    # The answer chosen by the vote is correct exactly when its sample counts as a match_result
+    long = to_long(pd.DataFrame([findings_row(1, failing, [failing, count, failing])]))
+    analysis = RepetitionAnalysis([1])
+    analysis.add(long)
+    rows = analysis.rows().set_index('repetition')
+    vote = analysis.nlq_table().loc[1]
+    assert vote['vote_match_result'] == rows.loc[vote['vote_repetition'], 'match_result']